@@ -6,11 +6,14 @@ Example:
 python main.py --config=config.json --output=output
 '''
 
-from simulator import simulator
-from util import util
+from concurrent.futures import ProcessPoolExecutor
+from simulator import simulator, vectorized
+from util import cache, ensemble, sweep, timeseries, transactions, util
 from tqdm import tqdm
 import argparse
 import json
+import matplotlib
+matplotlib.use('Agg') # render to files only, also in worker processes
 import matplotlib.pyplot as plt
 import numpy as np
 import os
@@ -18,20 +21,108 @@ import sys
 
 # Plots one set of results to an output file.
 # - x = list values to plot on x axis
-# - y = parallel list of {result name: value to plot on y axis}. Each
-#   result is plotted on a subplot, with the result name as the title
+# - y = {result name: 2D array of values to plot on y axis, one row per x and
+#   one column per line}. Each result is plotted on a subplot, with the result
+#   name as the title
 # - output_file = string path to file
-def plot(x, y, output_file):
-  f = plt.figure(figsize=(20, 15))
-  result_names = y[0].keys()
+# - lo, hi = optional dicts like y, with the bottom and top of a band to shade
+#   around each line (e.g. percentiles across ensemble replicates)
+# - figure = optional figure to draw on (cleared first), to reuse it across
+#   plots. If not given, a new figure is made and closed.
+def plot(x, y, output_file, lo=None, hi=None, figure=None):
+  f = plt.figure(figsize=(20, 15)) if figure is None else figure
+  f.clf()
+  result_names = y.keys()
   nresults = len(result_names)
   for i, result_name in zip(range(1, nresults+1), result_names):
     ax = f.add_subplot(nresults, 1, i)
-    y_values = [y[i][result_name] for i in range(len(y))]
-    ax.plot(x, y_values)
+    lines = ax.plot(x, y[result_name])
+    if lo is not None and hi is not None:
+      for j, line in enumerate(lines):
+        ax.fill_between(x, lo[result_name][:,j], hi[result_name][:,j], color=line.get_color(), alpha=0.2)
     ax.set_title(result_name)
     ax.grid()
-  plt.savefig(output_file)
+  f.savefig(output_file)
+  if figure is None:
+    plt.close(f)
+
+# Returns {result name: 2D array of its columns} for one group of a time series
+# table (see util/timeseries.py), or None if the table is None
+def series(columns, table, level, group=None):
+  if table is None:
+    return None
+  return {result: table[:, j] for result, j in timeseries.group_columns(columns, level, group).items()}
+
+# Returns the plots to make of a time series table's columns: a list of
+# (level, group, output file name) for overall, each income level and each
+# industry
+def plot_jobs(columns):
+  jobs = [('overall', None, 'overall.png')]
+  jobs += [('income_levels', income, 'income-%s.png' % income) for income in timeseries.groups(columns, 'income_levels')]
+  jobs += [('industries', industry, 'industry-%s.png' % industry) for industry in timeseries.groups(columns, 'industries')]
+  return jobs
+
+# Makes some of the plots (from plot_jobs()) of the time series table at
+# results_path, with the band between the tables at lo_path and hi_path if
+# given, into output_dir. The tables are memory-mapped rather than passed in,
+# so worker processes don't need a copy. Draws every plot on one figure, and
+# closes it when done.
+def render(jobs, output_dir, results_path, lo_path=None, hi_path=None):
+  columns, _, table = timeseries.read(results_path)
+  lo = None if lo_path is None else timeseries.read(lo_path)[2]
+  hi = None if hi_path is None else timeseries.read(hi_path)[2]
+  x = range(len(table))
+  f = plt.figure(figsize=(20, 15))
+  try:
+    for level, group, output_file in jobs:
+      plot(
+        x=x,
+        y=series(columns, table, level, group),
+        output_file=os.path.join(output_dir, output_file),
+        lo=series(columns, lo, level, group),
+        hi=series(columns, hi, level, group),
+        figure=f
+      )
+  finally:
+    plt.close(f)
+  return len(jobs)
+
+# Makes every plot of the time series table at results_path (see render()),
+# spread across a pool of the given number of worker processes (default: one
+# per CPU). Calls on_plots(n) as each worker finishes its n plots.
+def render_all(output_dir, results_path, lo_path=None, hi_path=None, workers=None,
+  on_plots=lambda n: None):
+  columns, _, _ = timeseries.read(results_path)
+  jobs = plot_jobs(columns)
+  nworkers = min(workers or os.cpu_count() or 1, len(jobs))
+  if nworkers <= 1:
+    on_plots(render(jobs, output_dir, results_path, lo_path, hi_path))
+    return
+  with ProcessPoolExecutor(max_workers=nworkers) as pool:
+    futures = [pool.submit(render, jobs[i::nworkers], output_dir, results_path, lo_path, hi_path)
+      for i in range(nworkers)]
+    for future in futures:
+      on_plots(future.result())
+
+# Parses a number of bytes, optionally with a unit (K, M, G or T, powers of
+# 1024, optionally followed by B), e.g. "512M" or "4GB"
+def parse_bytes(s):
+  units = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+  s = s.strip().upper()
+  s = s[:-1] if s.endswith('B') else s
+  unit = s[-1:] if s[-1:] in units else ''
+  try:
+    return int(float(s[:len(s) - len(unit)]) * units[unit])
+  except ValueError:
+    raise argparse.ArgumentTypeError('invalid size "%s"' % s)
+
+# Formats a number of bytes for people, e.g. "1.5 GB"
+def format_bytes(n):
+  for unit in ['B', 'KB', 'MB', 'GB']:
+    if n < 1024:
+      return '%.1f %s' % (n, unit)
+    n /= 1024
+  return '%.1f TB' % n
 
 def main(argv):
   # Parse config
@@ -40,40 +131,193 @@ def main(argv):
     default='config.json', help='The path to the config file')
   parser.add_argument('-o', '--output', dest='output_dir', type=str,
     default='output', help='The directory to write results to')
+  parser.add_argument('-e', '--engine', dest='engine', type=str,
+    default='legacy', choices=util.engines.keys(),
+    help='The simulator engine to run')
+  parser.add_argument('--aggregate-months', dest='aggregate_months',
+    action='store_true', help='Simulate each month of spending in one step '
+    '(faster, same results in distribution)')
+  parser.add_argument('-n', '--replicates', dest='replicates', type=int,
+    default=1, help='The number of independent replicates to run. With more '
+    'than 1, plots the mean and 5th-95th percentile band across replicates')
+  parser.add_argument('-w', '--workers', dest='workers', type=int,
+    default=None, help='The number of processes to run replicates and render '
+    'plots on (default: one per CPU)')
+  parser.add_argument('--no-plots', dest='no_plots', action='store_true',
+    help='Only write the results tables, without plotting them')
+  parser.add_argument('--profile', dest='profile', action='store_true',
+    help='Time each phase of the simulation, and report the timings when '
+    'done (also written to profile.json in the output directory). Always '
+    'runs the simulation, rather than replaying cached results')
+  parser.add_argument('--transactions', dest='transactions', action='store_true',
+    help='Log every transaction of the simulation (spending, payroll, hires, '
+    'layoffs, closures, stimulus and benefits) to transactions.bin in the '
+    'output directory (see util/transactions.py). Always runs the simulation')
+  parser.add_argument('--seed', dest='seed', type=int, default=None,
+    help='Seed for the random number generators, to make runs reproducible '
+    '(overrides the config\'s seed)')
+  parser.add_argument('-s', '--sweep', dest='sweep', type=str, default=None,
+    help='The path to a parameter sweep spec (see util/sweep.py). Runs the '
+    'sweep over the config and writes a table of results instead of plots')
+  parser.add_argument('--quantile-error', dest='epsilon', type=float,
+    default=None, help='Approximate the percentiles of money with quantile '
+    'sketches with this rank error (e.g. 0.01), instead of exactly')
+  parser.add_argument('--cache-dir', dest='cache_dir', type=str,
+    default=cache.default_directory, help='The directory to cache the '
+    'results of seeded runs in, to replay them when the same run is repeated')
+  parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+    help='Always run the simulation, without reading or writing the cache')
+  parser.add_argument('--checkpoint-months', dest='checkpoint_months', type=int,
+    default=None, help='Checkpoint the state of the simulation to the output '
+    'directory every this many months, so it can be resumed with --resume')
+  parser.add_argument('--resume', dest='resume', action='store_true',
+    help='Resume the simulation from the checkpoint in the output directory, '
+    'if there is one. Gives the same output as if it had never stopped')
+  parser.add_argument('--money-dtype', dest='money_dtype', type=str,
+    default=None, choices=vectorized.money_dtypes, help='The dtype the '
+    'vectorized engine keeps money in (overrides the config\'s money_dtype). '
+    'float32 takes less memory, but rounds large amounts')
+  parser.add_argument('--memory-budget', dest='memory_budget', type=parse_bytes,
+    default=None, help='The memory the run may take, e.g. 4G. Reports the '
+    'estimated memory of the config first, and refuses to run it if it won\'t '
+    'fit (counting each run on a worker process for replicates and sweeps)')
   args = parser.parse_args()
+  if args.profile and (args.replicates > 1 or args.sweep is not None):
+    parser.error('--profile only works for a single run')
+  if args.transactions and (args.replicates > 1 or args.sweep is not None or args.resume):
+    parser.error('--transactions only works for a single run, without --resume')
   with open(args.config, 'r') as f:
     config = json.loads(f.read())
+  if args.seed is not None:
+    config['seed'] = args.seed
+  if args.money_dtype is not None:
+    config['money_dtype'] = args.money_dtype
 
-  # Run simulator
-  total_ndays = simulator.days_per_month * sum([config['periods'][i]['duration'] for i in range(len(config['periods']))])
-  t = tqdm(total=total_ndays)
-  results = []
-  def on_day(period, day, people, companies):
-    t.update()
-    if day % simulator.days_per_month != 0:
-      return
-    results.append(util.results(people, companies))
-
-  simulator.run(config, on_day=on_day)
-  t.close()
+  # Check that the run fits in the memory budget
+  if args.memory_budget is not None:
+    estimate = util.engines[args.engine].estimate_bytes(config, args.aggregate_months)
+    nruns = 1
+    if args.replicates > 1 or args.sweep is not None:
+      nruns = args.workers or os.cpu_count() or 1
+      nruns = nruns if args.sweep is not None else min(nruns, args.replicates)
+    total = nruns * estimate['total']
+    print('Estimated memory: %s (%s of people and companies, %s working memory%s)' % (
+      format_bytes(total), format_bytes(estimate['state']), format_bytes(estimate['working']),
+      ', for each of %d concurrent runs' % nruns if nruns > 1 else ''))
+    if total > args.memory_budget:
+      parser.error('the run needs about %s, more than the memory budget of %s'
+        % (format_bytes(total), format_bytes(args.memory_budget)))
 
-  # Plot results
+  # Run a parameter sweep
+  if args.sweep is not None:
+    with open(args.sweep, 'r') as f:
+      spec = json.loads(f.read())
+    t = tqdm()
+    def on_run(ndone, ntotal):
+      t.total = ntotal
+      t.n = ndone
+      t.refresh()
+    try:
+      table_file = sweep.run(config, spec, args.output_dir, workers=args.workers,
+        engine=args.engine, aggregate_months=args.aggregate_months,
+        epsilon=args.epsilon, on_run=on_run)
+    except ValueError as e:
+      t.close()
+      parser.error(str(e))
+    t.close()
+    print('Wrote results to %s' % table_file)
+    return
+
+  # Run simulator. The results are written to a time series table in the
+  # output directory (see util/timeseries.py), and plotted from there.
   if not os.path.isdir(args.output_dir):
     os.mkdir(args.output_dir)
-  x = range(len(results))
-  plot(x, [results[i]['overall'] for i in range(len(results))], os.path.join(args.output_dir, 'overall.png'))
-  for income in results[0]['income_levels'].keys():
-    plot(
-      x=x,
-      y=[results[i]['income_levels'][income] for i in range(len(results))],
-      output_file=os.path.join(args.output_dir, 'income-%s.png' % income)
-    )
-  for industry in results[0]['industries'].keys():
-    plot(
-      x=x,
-      y=[results[i]['industries'][industry] for i in range(len(results))],
-      output_file=os.path.join(args.output_dir, 'industry-%s.png' % industry)
-    )
+  results_path = os.path.join(args.output_dir, 'results')
+  if args.replicates > 1:
+    t = tqdm(total=args.replicates)
+    replicates = ensemble.run(config, args.replicates, workers=args.workers,
+      engine=args.engine, aggregate_months=args.aggregate_months,
+      epsilon=args.epsilon, on_replicate=lambda i, results: t.update())
+    t.close()
+
+    # Write the mean, and the percentiles of the band, each to its own table
+    bands = ensemble.combine(replicates)
+    columns, table = timeseries.table(bands['mean'])
+    _, lo = timeseries.table(bands[str(ensemble.percentiles[0])])
+    _, hi = timeseries.table(bands[str(ensemble.percentiles[-1])])
+    for name, t in [('', table), ('-p%d' % ensemble.percentiles[0], lo), ('-p%d' % ensemble.percentiles[-1], hi)]:
+      with timeseries.Writer(results_path + name, columns) as writer:
+        writer.write_rows(t)
+  else:
+    # Replay the results of a seeded run if they're cached, or else run it,
+    # streaming each month's results to the table
+    result_cache = None
+    if not args.no_cache and cache.cacheable(config):
+      result_cache = cache.ResultCache(args.cache_dir)
+      key = cache.key(config, app='cli', format='table', engine=args.engine,
+        aggregate_months=args.aggregate_months, epsilon=args.epsilon)
+    cached = None if result_cache is None or args.resume or args.profile or args.transactions else result_cache.get(key)
+    if cached is not None:
+      print('Replaying cached results')
+      with timeseries.Writer(results_path, cached['columns']) as writer:
+        writer.write_rows(cached['table'])
+    else:
+      # Checkpoint the run if asked to, and resume from the checkpoint,
+      # continuing the table from the month it was taken
+      checkpoint_file = None
+      nmonths = 0
+      if args.checkpoint_months is not None or args.resume:
+        checkpoint_file = os.path.join(args.output_dir, 'checkpoint.npz')
+      if args.resume and os.path.isfile(checkpoint_file):
+        nmonths = simulator.read_checkpoint(checkpoint_file)[1]['nmonths']
+        print('Resuming from month %d' % nmonths)
+
+      # Profile the run and/or log its transactions, if asked to
+      profiler = simulator.Profiler() if args.profile else None
+      recorder = None
+      if args.transactions:
+        recorder = transactions.Recorder(os.path.join(args.output_dir, 'transactions'),
+          aggregate_months=args.aggregate_months)
+      instrument = simulator.Instruments([i for i in [recorder, profiler] if i is not None])
+      total_ndays = simulator.days_per_month * sum([config['periods'][i]['duration'] for i in range(len(config['periods']))])
+      t = tqdm(total=total_ndays, initial=simulator.days_per_month * nmonths)
+      with timeseries.Writer(results_path, nrows=nmonths) as writer:
+        def on_day(period, day, people, companies):
+          t.update(simulator.days_per_month if args.aggregate_months else 1)
+          if day % simulator.days_per_month != 0:
+            return
+          writer.write(util.results(people, companies, args.epsilon))
+
+        util.engines[args.engine].run(config, on_day=on_day, aggregate_months=args.aggregate_months,
+          checkpoint_file=checkpoint_file, checkpoint_months=args.checkpoint_months or 12,
+          resume=args.resume, instrument=instrument)
+      t.close()
+      if recorder is not None:
+        recorder.close()
+        print('Logged %d transactions' % recorder.nevents)
+
+      # Report the time spent in each phase
+      if profiler is not None:
+        print(profiler.format())
+        with open(os.path.join(args.output_dir, 'profile.json'), 'w') as f:
+          json.dump(profiler.report(), f, indent=2)
+    columns, _, table = timeseries.read(results_path)
+    if cached is None and result_cache is not None:
+      result_cache.put(key, {'columns': columns, 'table': table.tolist()})
+
+  # Plot results
+  if args.no_plots:
+    print('Wrote results to %s.npy' % results_path)
+    return
+  lo_path = None
+  hi_path = None
+  if args.replicates > 1:
+    lo_path = results_path + '-p%d' % ensemble.percentiles[0]
+    hi_path = results_path + '-p%d' % ensemble.percentiles[-1]
+  t = tqdm(total=len(plot_jobs(columns)), unit='plot')
+  render_all(args.output_dir, results_path, lo_path, hi_path, workers=args.workers,
+    on_plots=t.update)
+  t.close()
 
 if __name__ == '__main__':
   main(sys.argv[1:])
@@ -0,0 +1,235 @@
+'''
+Benchmarks the simulator. Runs each engine over a matrix of economy sizes
+(number of companies, company size, number of industries) and scenarios (a
+normal economy, or one that shuts down some industries partway through), and
+times both whole runs and each step of the simulation. Writes the timings to a
+JSON file, and can compare them to an earlier file to catch regressions
+between versions.
+
+Example:
+python -m cli.benchmark --output=before.json
+python -m cli.benchmark --output=after.json --compare=before.json
+'''
+
+from simulator import simulator
+from util import util
+import argparse
+import json
+import numpy as np
+import platform
+import sys
+import time
+
+# The steps of the simulation that are timed, as the names of the engines'
+# functions. util.results is timed too, as 'results'.
+steps = [
+  'init',
+  'spend',
+  'spend_month',
+  'rehire_people',
+  'layoff_employees',
+  'pay_employees',
+  'reset_spending_rates'
+]
+
+# The default matrix of cases
+matrix = {
+  'engine': list(util.engines.keys()),
+  'ncompanies': [100, 1000],
+  'company_size': [10, 50],
+  'nindustries': [1, 10],
+  'scenario': ['normal', 'shutdown']
+}
+
+# Returns the config of a benchmark case: ncompanies companies of company_size
+# employees each, in nindustries industries, run for nmonths months. In the
+# "shutdown" scenario, after the first half of the months, spending in half of
+# the industries stops (or, with only one industry, people spend less), and
+# the unemployed get benefits.
+def case_config(ncompanies, company_size, nindustries, scenario, nmonths, seed=0):
+  industry_names = ['industry %d' % (i+1) for i in range(nindustries)]
+  periods = [{
+    'duration': nmonths,
+    'person_stimulus': 1,
+    'company_stimulus': 1,
+    'unemployment_benefit': 0,
+    'rehire_rate': 1,
+    'spending_inclination': 0.5,
+    'spending_distribution': [industry_names, [1 / nindustries] * nindustries]
+  }]
+  if scenario == 'shutdown':
+    periods[0]['duration'] = nmonths // 2
+    nopen = nindustries - nindustries // 2
+    shutdown = {
+      'duration': nmonths - nmonths // 2,
+      'unemployment_benefit': 0.5,
+      'spending_distribution': [industry_names, [1 / nopen] * nopen + [0] * (nindustries - nopen)]
+    }
+    if nindustries == 1:
+      shutdown['spending_inclination'] = 0.2
+    periods.append(shutdown)
+  elif scenario != 'normal':
+    raise ValueError('invalid scenario %s' % json.dumps(scenario))
+  return {
+    'seed': seed,
+    'ncompanies': ncompanies,
+    'income': [[25000, 65000, 100000, 250000], [0.25, 0.25, 0.25, 0.25]],
+    'company_size': [[company_size], [1]],
+    'periods': periods
+  }
+
+# Returns the name of a case, e.g. "vectorized/ncompanies=100/company_size=10/
+# nindustries=1/scenario=normal", by which cases are matched when comparing
+def case_name(case):
+  return '/'.join([case['engine']] + ['%s=%s' % (k, case[k]) for k in ['ncompanies', 'company_size', 'nindustries', 'scenario']])
+
+# Returns the list of cases (dicts of engine, ncompanies, company_size,
+# nindustries and scenario) in a matrix like the one above
+def cases(matrix):
+  cases = [{}]
+  for k in ['engine', 'ncompanies', 'company_size', 'nindustries', 'scenario']:
+    cases = [dict(case, **{k: v}) for case in cases for v in matrix[k]]
+  return cases
+
+# Runs a config on an engine, timing every call of each step (see steps above)
+# and of util.results on the first day of each month. The engine's step
+# functions are swapped for timed ones during the run. Returns {step:
+# {'calls', 'total', 'mean'}}, in seconds, for the steps that were called.
+def time_steps(config, engine, aggregate_months=False):
+  module = sys.modules[util.engines[engine].run.__module__]
+  times = {}
+  def timed(name, f):
+    def g(*args, **kwargs):
+      start = time.perf_counter()
+      out = f(*args, **kwargs)
+      times.setdefault(name, []).append(time.perf_counter() - start)
+      return out
+    return g
+
+  originals = {name: getattr(module, name) for name in steps if hasattr(module, name)}
+  results = timed('results', util.results)
+  def on_day(period, day, people, companies):
+    if day % simulator.days_per_month == 0:
+      results(people, companies)
+  try:
+    for name, f in originals.items():
+      setattr(module, name, timed(name, f))
+    util.engines[engine].run(config, on_day=on_day, aggregate_months=aggregate_months)
+  finally:
+    for name, f in originals.items():
+      setattr(module, name, f)
+  return {
+    name: {'calls': len(t), 'total': sum(t), 'mean': sum(t) / len(t)}
+    for name, t in times.items()
+  }
+
+# Times whole runs of a config on an engine, without any work on each day.
+# Returns the fastest of repeat runs, in seconds.
+def time_run(config, engine, aggregate_months=False, repeat=3):
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    util.engines[engine].run(config, aggregate_months=aggregate_months)
+    t = time.perf_counter() - start
+    best = t if best is None else min(best, t)
+  return best
+
+# Runs the benchmark over every case of a matrix. Returns the report: the
+# options, the environment and each case's timings. Calls on_case(case) as
+# each case finishes.
+def run(matrix=matrix, nmonths=2, repeat=3, aggregate_months=False, on_case=lambda case: None):
+  report = {
+    'options': {'nmonths': nmonths, 'repeat': repeat, 'aggregate_months': aggregate_months},
+    'environment': {
+      'python': platform.python_version(),
+      'numpy': np.__version__,
+      'platform': platform.platform(),
+      'processor': platform.processor()
+    },
+    'cases': []
+  }
+  for case in cases(matrix):
+    config = case_config(case['ncompanies'], case['company_size'], case['nindustries'], case['scenario'], nmonths)
+    case = dict(case, name=case_name(case), npeople=case['ncompanies'] * case['company_size'])
+    case['run'] = time_run(config, case['engine'], aggregate_months, repeat)
+    case['steps'] = time_steps(config, case['engine'], aggregate_months)
+    report['cases'].append(case)
+    on_case(case)
+  return report
+
+# Compares two reports from run(), by the cases they both have. Returns a list
+# of (case name, timing, old seconds, new seconds, new/old) for each whole run
+# and each step's mean time, and the list of those that are more than
+# threshold (a fraction) slower in the new report.
+def compare(old, new, threshold=0.1):
+  rows = []
+  old_cases = {case['name']: case for case in old['cases']}
+  for case in new['cases']:
+    if case['name'] not in old_cases:
+      continue
+    old_case = old_cases[case['name']]
+    pairs = [('run', old_case['run'], case['run'])]
+    pairs += [(step, old_case['steps'][step]['mean'], t['mean'])
+      for step, t in case['steps'].items() if step in old_case['steps']]
+    for timing, t_old, t_new in pairs:
+      rows.append((case['name'], timing, t_old, t_new, t_new / t_old if t_old > 0 else float('inf')))
+  regressions = [row for row in rows if row[4] > 1 + threshold]
+  return rows, regressions
+
+def main(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-o', '--output', dest='output', type=str,
+    default='benchmark.json', help='The file to write the timings to')
+  parser.add_argument('--compare', dest='compare', type=str, default=None,
+    help='A file of earlier timings to compare to. Exits with status 1 if any '
+    'timing is slower by more than --threshold')
+  parser.add_argument('--threshold', dest='threshold', type=float,
+    default=0.1, help='The fraction by which a timing can be slower before '
+    'it counts as a regression (default: 0.1)')
+  parser.add_argument('-e', '--engines', dest='engine', type=str, nargs='+',
+    default=matrix['engine'], choices=util.engines.keys(),
+    help='The engines to benchmark')
+  parser.add_argument('--ncompanies', dest='ncompanies', type=int, nargs='+',
+    default=matrix['ncompanies'], help='The numbers of companies')
+  parser.add_argument('--company-size', dest='company_size', type=int, nargs='+',
+    default=matrix['company_size'], help='The numbers of employees per company')
+  parser.add_argument('--industries', dest='nindustries', type=int, nargs='+',
+    default=matrix['nindustries'], help='The numbers of industries')
+  parser.add_argument('--scenarios', dest='scenario', type=str, nargs='+',
+    default=matrix['scenario'], choices=matrix['scenario'],
+    help='The scenarios to run')
+  parser.add_argument('--months', dest='nmonths', type=int, default=2,
+    help='The number of months each case runs for')
+  parser.add_argument('--repeat', dest='repeat', type=int, default=3,
+    help='The number of whole runs to time per case (the fastest counts)')
+  parser.add_argument('--aggregate-months', dest='aggregate_months',
+    action='store_true', help='Simulate each month of spending in one step')
+  args = parser.parse_args(argv)
+
+  def on_case(case):
+    print('%-70s run %8.3fs  %s' % (case['name'], case['run'],
+      '  '.join(['%s %.2gs' % (step, t['mean']) for step, t in case['steps'].items()])))
+  report = run(
+    matrix={k: getattr(args, k) for k in matrix},
+    nmonths=args.nmonths,
+    repeat=args.repeat,
+    aggregate_months=args.aggregate_months,
+    on_case=on_case
+  )
+  with open(args.output, 'w') as f:
+    json.dump(report, f, indent=2)
+  print('Wrote timings to %s' % args.output)
+
+  if args.compare is not None:
+    with open(args.compare, 'r') as f:
+      old = json.load(f)
+    rows, regressions = compare(old, report, args.threshold)
+    for name, timing, t_old, t_new, ratio in rows:
+      flag = '  REGRESSION' if ratio > 1 + args.threshold else ''
+      print('%-70s %-22s %10.4gs -> %10.4gs  x%.2f%s' % (name, timing, t_old, t_new, ratio, flag))
+    print('%d of %d timings regressed by more than %d%%' % (len(regressions), len(rows), 100 * args.threshold))
+    if len(regressions) > 0:
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -2,7 +2,13 @@
 The simulator.
 '''
 
+import gc
+import hashlib
+import json
 import numpy as np
+import os
+import sys
+import time
 
 months_per_year = 12
 days_per_month = 30
@@ -32,8 +38,101 @@ defaults = {
   ]
 }
 
-# A person in the model
+# Returns the random number generators for a run: a dict of independent streams
+# for initialization ('init'), people's spending ('spending'), rehiring
+# ('hiring') and layoffs ('layoffs'), so that changing how one step draws random
+# numbers doesn't change the others. Takes an int seed, a SeedSequence or a
+# Generator to spawn the streams from, or None to seed them from fresh entropy.
+#
+# Every function below that draws random numbers takes one of these as an
+# optional rng argument, defaulting to NumPy's global random state.
+def make_rngs(seed=None):
+  names = ['init', 'spending', 'hiring', 'layoffs']
+  if isinstance(seed, np.random.Generator):
+    streams = seed.spawn(len(names))
+  else:
+    seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    streams = [np.random.default_rng(s) for s in seed.spawn(len(names))]
+  return dict(zip(names, streams))
+
+# The phases of a run, in order, that instruments observe (see Instrument):
+# 'stimulus' grants the stimulus at the start of each period, 'metrics' is the
+# on_day callback, 'benefits' grants unemployment benefits at the end of each
+# month, and 'spending_reset' picks people's new spending rates
+phases = ['stimulus', 'metrics', 'spend', 'rehire', 'layoff', 'pay', 'benefits', 'spending_reset']
+
+# An observer of the phases of a run, e.g. for profiling. run() calls
+# before(phase, people, companies) just before each phase and after(phase,
+# people, companies) just after it. Subclass it and override the callbacks you
+# need. This base class does nothing, and is what run() uses when it isn't
+# given an instrument, so it costs only two empty calls per phase.
+class Instrument:
+  def before(self, phase, people, companies):
+    pass
+
+  def after(self, phase, people, companies):
+    pass
+
+# An instrument that calls each of a list of instruments, to use several at
+# once. They're nested: before() is called in order, and after() in reverse
+# order, so the last instrument's timings don't include the others' work.
+class Instruments(Instrument):
+  def __init__(self, instruments):
+    self.instruments = instruments
+
+  def before(self, phase, people, companies):
+    for instrument in self.instruments:
+      instrument.before(phase, people, companies)
+
+  def after(self, phase, people, companies):
+    for instrument in reversed(self.instruments):
+      instrument.after(phase, people, companies)
+
+# An instrument that records the wall time, number of calls, and number of
+# agents (people and companies) the phase ran on, for each phase
+class Profiler(Instrument):
+  def __init__(self):
+    self.stats = {}
+    self.start = None
+
+  def before(self, phase, people, companies):
+    self.start = time.perf_counter()
+
+  def after(self, phase, people, companies):
+    seconds = time.perf_counter() - self.start
+    if phase not in self.stats:
+      self.stats[phase] = {'calls': 0, 'seconds': 0.0, 'people': 0, 'companies': 0}
+    stats = self.stats[phase]
+    stats['calls'] += 1
+    stats['seconds'] += seconds
+    stats['people'] += len(people)
+    stats['companies'] += len(companies)
+
+  # Returns {phase: stats} in the order of phases, where the stats are the
+  # number of calls, the total seconds, the mean seconds per call, the
+  # fraction of the total time of all phases, and the total number of people
+  # and companies over all calls
+  def report(self):
+    total = sum([stats['seconds'] for stats in self.stats.values()])
+    return {
+      phase: dict(self.stats[phase],
+        mean_seconds=self.stats[phase]['seconds'] / self.stats[phase]['calls'],
+        fraction=self.stats[phase]['seconds'] / total if total > 0 else 0.0)
+      for phase in phases if phase in self.stats
+    }
+
+  # Returns the report as a text table
+  def format(self):
+    lines = ['%-16s %8s %12s %12s %8s %12s' % ('phase', 'calls', 'seconds', 'mean (ms)', 'share', 'people')]
+    for phase, stats in self.report().items():
+      lines.append('%-16s %8d %12.3f %12.3f %7.1f%% %12d' % (phase, stats['calls'], stats['seconds'],
+        1000 * stats['mean_seconds'], 100 * stats['fraction'], stats['people']))
+    return '\n'.join(lines)
+
+# A person in the model. People only have these attributes (no __dict__),
+# which makes each of them much smaller.
 class Person:
+  __slots__ = ['money', 'income', 'employed', 'daily_spending', 'industry']
 
   def __init__(self, money=0, income=0, employed=True, daily_spending=0, industry='economy'):
     self.money = money
@@ -48,12 +147,20 @@ class Person:
 
 # A company in the model
 class Company:
+  __slots__ = ['money', 'employees', 'in_business', 'industry', 'payroll']
 
-  def __init__(self, money=0, employees=[], in_business=True, industry='economy'):
+  def __init__(self, money=0, employees=None, in_business=True, industry='economy'):
     self.money = money
-    self.employees = employees
+    self.employees = [] if employees is None else employees
     self.in_business = in_business
     self.industry = industry
+    self.update_payroll()
+
+  # Recomputes the company's payroll (the total monthly income of its
+  # employees) from scratch. Hiring and laying off people keep it up to date,
+  # so this is only needed after changing employees' income directly.
+  def update_payroll(self):
+    self.payroll = sum([e.income for e in self.employees])
 
   def __str__(self):
     return ('Company(money=%.2f, in_business=%s, industry="%s", employees=%s)'
@@ -62,7 +169,7 @@ class Company:
 # Picks a new spending rate for each person given the spending inclination.
 # This function derives the uniform distribution to draw rates from, as
 # described in the README. Returns the new list of people.
-def reset_spending_rates(people, spending_inclination):
+def reset_spending_rates(people, spending_inclination, rng=np.random):
   lo = 0
   hi = 1
   diff = spending_inclination - 0.5
@@ -70,32 +177,64 @@ def reset_spending_rates(people, spending_inclination):
     lo += 2 * diff
   else:
     hi += 2 * diff # remember diff is negative
-  rands = np.random.rand(len(people)) # random numbers used to pick a spending rate for each person
+  rands = rng.random(len(people)) # random numbers used to pick a spending rate for each person
   for i in range(len(people)):
     rate = lo + rands[i] * (hi - lo)
     people[i].daily_spending = rate * people[i].money / days_per_month
   return people
 
+# Draws the initial state of the economy in bulk, as arrays, without building
+# any agents:
+# - company_industry: each company's index into industry_names, assigned in
+#   turn (company i is in industry i % len(industry_names))
+# - company_size: each company's number of employees, drawn from company_size
+# - employer: each person's company. Each company's employees are consecutive,
+#   in the order of the companies.
+# - income: each person's monthly income, drawn from income (which is annual)
+# Both engines initialize from this, so they draw the same economy from the
+# same rng.
+def init_arrays(ncompanies, income, company_size, industry_names, rng=np.random):
+  company_industry = np.arange(ncompanies) % len(industry_names)
+  size = rng.choice(company_size[0], p=company_size[1], size=ncompanies)
+  employer = np.repeat(np.arange(ncompanies), size)
+  incomes = rng.choice(income[0], p=income[1], size=len(employer)) / months_per_year
+  return {
+    'company_industry': company_industry,
+    'company_size': size,
+    'employer': employer,
+    'income': incomes.astype(float)
+  }
+
 # Initializes the simulator. Returns the list of people and companies
 def init(
   ncompanies=defaults['ncompanies'],
   income=defaults['income'],
   company_size=defaults['company_size'],
-  industry_names=defaults['periods'][0]['spending_distribution'][0]
+  industry_names=defaults['periods'][0]['spending_distribution'][0],
+  rng=np.random
   ):
-
-  # Assign people to companies
-  people = []
-  companies = [Company(industry=industry_names[i % len(industry_names)]) for i in range(ncompanies)]
-  size = np.random.choice(company_size[0], p=company_size[1], size=len(companies))
-  for i in range(ncompanies):
-    companies[i].employees = [Person(industry=companies[i].industry) for j in range(size[i])]
-    people += companies[i].employees
-
-  # Assign each person income
-  incomes = np.random.choice(income[0], p=income[1], size=len(people))
-  for i in range(len(people)):
-    people[i].income = incomes[i] / months_per_year
+  state = init_arrays(ncompanies, income, company_size, industry_names, rng)
+
+  # Make the people, then hand each company its slice of them. The arrays are
+  # converted to lists first, since indexing NumPy arrays one element at a time
+  # is slow. The garbage collector is paused meanwhile: it would otherwise scan
+  # the growing list of people again and again, which takes longer than making
+  # them.
+  industry_names = [sys.intern(str(name)) for name in industry_names] # shared by every agent in the industry
+  company_industry = [industry_names[i] for i in state['company_industry'].tolist()]
+  incomes = state['income'].tolist()
+  ends = np.cumsum(state['company_size']).tolist()
+  gc_enabled = gc.isenabled()
+  gc.disable()
+  try:
+    people = [Person(income=incomes[i], industry=company_industry[e]) for i, e in enumerate(state['employer'].tolist())]
+    companies = [
+      Company(employees=people[end - size:end], industry=company_industry[i])
+      for i, (size, end) in enumerate(zip(state['company_size'].tolist(), ends))
+    ]
+  finally:
+    if gc_enabled:
+      gc.enable()
   return people, companies
 
 # Grant stimulus for people and companies. Returns the new list of people and
@@ -105,8 +244,7 @@ def grant_stimulus(people, companies, person_stimulus, company_stimulus):
     p.money += person_stimulus * p.income
 
   for c in companies:
-    payroll = np.sum([e.income for e in c.employees])
-    c.money += company_stimulus * payroll
+    c.money += company_stimulus * c.payroll
 
   return people, companies
 
@@ -122,11 +260,10 @@ def grant_unemployment(people, unemployment_benefit):
 # and spends a portion of their monthly spending at that company. Returns the
 # new list of people and companies.
 # - industries: a dict {industry: [list of companies in business in that industry]}
-def spend(people, companies, spending_distribution, industries):
-  in_business = [c for c in companies if c.in_business]
-  if len(in_business) != 0:
-    rand_inds = np.random.choice(spending_distribution[0], p=spending_distribution[1], size=len(people))
-    rands = np.random.rand(len(people)) # random numbers used to pick a company for each person
+def spend(people, companies, spending_distribution, industries, rng=np.random):
+  if any(len(ind) != 0 for ind in industries.values()):
+    rand_inds = rng.choice(spending_distribution[0], p=spending_distribution[1], size=len(people))
+    rands = rng.random(len(people)) # random numbers used to pick a company for each person
     for p, rand_ind, r in zip(people, rand_inds, rands):
       ind = industries[rand_ind]
       if len(ind) == 0:
@@ -136,66 +273,139 @@ def spend(people, companies, spending_distribution, industries):
       c.money += p.daily_spending
   return people, companies
 
+# Equivalent to calling spend() ndays times in a row, but draws all of the
+# days' purchases at once and moves the whole month's money with one update per
+# person and company. The result has the same distribution as spending day by
+# day, since nothing but money changes in between. Returns the new list of
+# people and companies.
+def spend_month(people, companies, spending_distribution, industries, ndays=days_per_month, rng=np.random):
+  # Flatten the industries into one list of companies, where
+  # in_industry[offsets[k]:offsets[k+1]] are the companies in industry k
+  in_industry = [c for ind in spending_distribution[0] for c in industries[ind]]
+  if len(in_industry) == 0:
+    return people, companies
+  counts = np.array([len(industries[ind]) for ind in spending_distribution[0]])
+  offsets = np.cumsum(counts) - counts
+
+  # Pick the industry and company for every person's purchase on every day
+  rand_inds = rng.choice(len(counts), p=spending_distribution[1], size=(len(people), ndays))
+  rands = rng.random((len(people), ndays)) # random numbers used to pick a company for each purchase
+  spent = counts[rand_inds] > 0
+  c_indices = offsets[rand_inds[spent]] + (rands[spent] * counts[rand_inds[spent]]).astype(int)
+
+  # Move the money
+  daily_spending = np.array([p.daily_spending for p in people])
+  credit = np.bincount(c_indices, weights=np.repeat(daily_spending, np.sum(spent, axis=1)), minlength=len(in_industry))
+  for p, ndays_spent in zip(people, np.sum(spent, axis=1)):
+    p.money -= ndays_spent * p.daily_spending
+  for c, amount in zip(in_industry, credit):
+    c.money += amount
+  return people, companies
+
+# Matches people to companies that can afford to hire them. Takes the cost of
+# hiring each person, in the order they get to pick, and the money each company
+# has to spare. Each person is hired by a random company among those that can
+# still afford them, and that company's budget goes down by their cost. Returns
+# an array of the index of the company that hires each person, or -1 if no
+# company can afford them.
+#
+# This runs in rounds instead of one person at a time: each round, every
+# remaining person proposes to a random company that can afford them (found by
+# binary search over the companies sorted by budget), and each company accepts
+# its proposals in order until its budget runs out. The rejected people try
+# again next round against the reduced budgets. Every round hires at least one
+# person per company proposed to, and it only needs O(people + companies)
+# memory.
+def match_hires(cost, budget, rng=np.random):
+  cost = np.asarray(cost, dtype=float)
+  budget = np.array(budget, dtype=float)
+  hirer = np.full(len(cost), -1)
+  remaining = np.arange(len(cost))
+  while len(remaining) != 0 and len(budget) != 0:
+    # Each remaining person proposes to a random company that can afford them
+    order = np.argsort(budget)
+    first = np.searchsorted(budget[order], cost[remaining], side='left')
+    naffordable = len(budget) - first
+    can_hire = naffordable > 0
+    remaining = remaining[can_hire]
+    if len(remaining) == 0:
+      break
+    r = (rng.random(len(remaining)) * naffordable[can_hire]).astype(int)
+    pick = order[first[can_hire] + r]
+
+    # Companies accept proposals in order while they can afford them. Sorting
+    # by company is stable, so each company's proposals stay in order.
+    by_company = np.argsort(pick, kind='stable')
+    pick = pick[by_company]
+    proposed_cost = cost[remaining[by_company]]
+    total = np.cumsum(proposed_cost)
+    group_start = np.flatnonzero(np.r_[True, pick[1:] != pick[:-1]])
+    before_group = np.repeat(total[group_start] - proposed_cost[group_start], np.diff(np.r_[group_start, len(pick)]))
+    accept = total - before_group <= budget[pick]
+
+    hirer[remaining[by_company[accept]]] = pick[accept]
+    budget -= np.bincount(pick[accept], weights=proposed_cost[accept], minlength=len(budget))
+    remaining = np.sort(remaining[by_company[~accept]])
+  return hirer
+
 # Given the list of people and companies and the probability of rehiring,
 # companies than can afford to hire unemployed people do so with that
 # probability, giving each person an equally likely chance of being hired
-# by any company. Returns the new list of people and companies.
-def rehire_people(people, companies, rehire_rate):
+# by any company that can still afford them (see match_hires). Returns the new
+# list of people and companies.
+def rehire_people(people, companies, rehire_rate, rng=np.random):
   # Hire unemployed people
-  unemployed = np.random.permutation([p for p in people if not p.employed])
+  unemployed = rng.permutation([p for p in people if not p.employed])
   in_business = [c for c in companies if c.in_business]
 
-  rehire = np.random.rand(len(unemployed)) <= rehire_rate # whether to rehire each person
-  rands = np.random.rand(len(unemployed)) # rand numbers used to select the company that will hire this person
+  rehire = rng.random(len(unemployed)) <= rehire_rate # whether to rehire each person
+  unemployed = unemployed[rehire]
 
-  # Build an array where entry (i, j) is whether company j can afford to hire person i
+  # Pick the company that will hire each person
   cost_of_new_hire = np.array([p.income for p in unemployed])
   company_money = np.array([c.money for c in in_business])
-  company_payroll = np.array([np.sum([e.income for e in c.employees]) for c in in_business])
-  can_afford = np.outer(1/cost_of_new_hire, company_money - company_payroll) >= 1
-
-  # Pick the company that will hire each person
-  for i in range(len(unemployed)):
-    if not rehire[i]:
-      continue
-    c_indices = np.argwhere(can_afford[i,:]) # indices of True values
-    if c_indices.shape[0] == 0:
+  company_payroll = np.array([c.payroll for c in in_business])
+  hirer = match_hires(cost_of_new_hire, company_money - company_payroll, rng)
+  for p, c_index in zip(unemployed, hirer):
+    if c_index == -1:
       continue
-    r = int(rands[i] * c_indices.shape[0])
-    c_index = c_indices[r,0] # random company among the True values
     c = in_business[c_index]
-    c.employees.append(unemployed[i])
-    unemployed[i].employed = True
-    unemployed[i].industry = c.industry
+    c.employees.append(p)
+    c.payroll += p.income
+    p.employed = True
+    p.industry = c.industry
 
   return people, companies
 
 # Given the list of people and companies, companies lay off employees until
 # they can affor to pay all of them. Returns the new list of people and
 # companies.
-def layoff_employees(people, companies):
-  for c in companies:
-    if not c.in_business:
-      continue
-
-    # Count number of people to lay off
-    payroll = np.sum([e.income for e in c.employees])
-    layoffs = np.random.permutation(c.employees) # order in which to lay off employees
-    reduced_expense = 0 # total expense removed from laid off employees
-    nlayoff = 0
-    while True:
-      if payroll - reduced_expense <= c.money:
-        break
-      reduced_expense += layoffs[nlayoff].income
-      nlayoff += 1
-      if nlayoff == len(c.employees):
-        c.in_business = False
-        break
+# - industries: the dict of companies in business in each industry (see
+#   spend). If given, companies that go out of business are removed from it.
+def layoff_employees(people, companies, industries=None, rng=np.random):
+  # Only companies that can't afford their payroll lay anyone off
+  in_business = [c for c in companies if c.in_business]
+  payroll = np.array([c.payroll for c in in_business])
+  money = np.array([c.money for c in in_business])
+  over_budget = [in_business[i] for i in np.flatnonzero(payroll > money)]
+
+  for c in over_budget:
+    # Lay off employees in a random order until the remaining payroll fits.
+    # reduced_expense[i] is the expense removed by laying off the first i+1.
+    layoffs = [c.employees[i] for i in rng.permutation(len(c.employees))] # order in which to lay off employees
+    reduced_expense = np.cumsum([e.income for e in layoffs])
+    nlayoff = np.searchsorted(reduced_expense, c.payroll - c.money, side='left') + 1
+    if nlayoff >= len(layoffs):
+      nlayoff = len(layoffs)
+      c.in_business = False
+      if industries is not None and c.industry in industries:
+        industries[c.industry].remove(c)
 
     # Lay off those people
-    for i in range(nlayoff):
-      c.employees.remove(layoffs[i])
-      layoffs[i].employed = False
+    for e in layoffs[:nlayoff]:
+      e.employed = False
+    c.employees = layoffs[nlayoff:]
+    c.payroll = c.payroll - reduced_expense[nlayoff - 1] if len(c.employees) != 0 else 0
   return people, companies
 
 # Given the list of people and companies, each company pays their employees
@@ -205,10 +415,120 @@ def pay_employees(people, companies):
     if not c.in_business:
       continue
 
+    c.money -= c.payroll
     for e in c.employees:
-      amount = e.income
-      c.money -= amount
-      e.money += amount
+      e.money += e.income
+  return people, companies
+
+# Returns the expected number of people in an economy of a config: the number
+# of companies times the mean company size
+def expected_npeople(config):
+  sizes, p = config['company_size']
+  return int(round(config['ncompanies'] * np.dot(sizes, p) / np.sum(p)))
+
+# The memory a run takes besides its agents: the interpreter and libraries
+base_bytes = 64 * 2**20
+
+# Returns an estimate of the memory a run of a config takes, in bytes, as a
+# dict of:
+# - state: the people and companies. With __slots__, a person takes about 120
+#   bytes (the object, its floats and its place in the lists), and a company
+#   about 200 plus its employees.
+# - working: the temporary arrays of a day of the simulation and of computing
+#   its results, about 130 bytes per person
+# - base: base_bytes
+# - total: the sum
+# The constants were measured with tracemalloc on runs of 100k-1M people.
+def estimate_bytes(config, aggregate_months=False):
+  npeople = expected_npeople(config)
+  estimate = {
+    'state': 120 * npeople + 200 * config['ncompanies'],
+    'working': 130 * npeople,
+    'base': base_bytes
+  }
+  estimate['total'] = sum(estimate.values())
+  return estimate
+
+# Returns an id for the state of a run of a config (with the given engine name
+# and aggregate_months) at the start of the given period and month, to check
+# that a checkpoint is resumed by a run that would have reached the same state.
+# The state only depends on the periods before it, so runs of configs that
+# differ only in later periods can start from the same checkpoint (see
+# util/branch.py).
+def checkpoint_id(config, engine, aggregate_months, period, month):
+  config = dict(config, periods=config['periods'][:period + (1 if month > 0 else 0)])
+  canonical = json.dumps({'config': config, 'engine': engine, 'aggregate_months': aggregate_months}, sort_keys=True)
+  return hashlib.sha256(canonical.encode()).hexdigest()
+
+# Writes a checkpoint of a run to path: a compressed .npz of the given arrays
+# (the state of the people and companies), and the metadata as JSON, which
+# includes the states of the random number generators rngs. The checkpoint is
+# written to a temporary file and renamed, so a crash while writing it leaves
+# the last one intact.
+def write_checkpoint(path, arrays, rngs, meta):
+  meta = dict(meta, rngs={name: rng.bit_generator.state for name, rng in rngs.items()})
+  tmp = path + '.tmp'
+  with open(tmp, 'wb') as f:
+    np.savez_compressed(f, meta=np.array(json.dumps(meta)), **arrays)
+  os.replace(tmp, path)
+
+# Reads a checkpoint written by write_checkpoint(). Returns the arrays and the
+# metadata.
+def read_checkpoint(path):
+  with np.load(path) as f:
+    arrays = {name: f[name] for name in f.files if name != 'meta'}
+    meta = json.loads(str(f['meta']))
+  return arrays, meta
+
+# Restores the random number generators rngs to their states in a checkpoint's
+# metadata
+def restore_rngs(rngs, meta):
+  for name, state in meta['rngs'].items():
+    rngs[name].bit_generator.state = state
+  return rngs
+
+# Returns the state of the people and companies as a dict of arrays, for a
+# checkpoint. Employment is kept as each company's list of employees, in order
+# (indices into people), since layoffs depend on the order.
+def checkpoint_arrays(people, companies):
+  industry_names = list(dict.fromkeys([c.industry for c in companies] + [p.industry for p in people]))
+  industry_ids = {name: i for i, name in enumerate(industry_names)}
+  person_ids = {id(p): i for i, p in enumerate(people)}
+  return {
+    'person_money': np.array([p.money for p in people], dtype=float),
+    'person_income': np.array([p.income for p in people], dtype=float),
+    'person_employed': np.array([p.employed for p in people], dtype=bool),
+    'person_daily_spending': np.array([p.daily_spending for p in people], dtype=float),
+    'person_industry': np.array([industry_ids[p.industry] for p in people], dtype=int),
+    'company_money': np.array([c.money for c in companies], dtype=float),
+    'company_in_business': np.array([c.in_business for c in companies], dtype=bool),
+    'company_industry': np.array([industry_ids[c.industry] for c in companies], dtype=int),
+    'company_payroll': np.array([c.payroll for c in companies], dtype=float),
+    'company_headcount': np.array([len(c.employees) for c in companies], dtype=int),
+    'employees': np.array([person_ids[id(e)] for c in companies for e in c.employees], dtype=int),
+    'industry_names': np.array(industry_names, dtype=str)
+  }
+
+# Returns the people and companies from the arrays of a checkpoint (see
+# checkpoint_arrays())
+def from_checkpoint_arrays(arrays):
+  industry_names = [str(name) for name in arrays['industry_names']]
+  people = [
+    Person(money=float(m), income=float(i), employed=bool(e), daily_spending=float(d), industry=industry_names[k])
+    for m, i, e, d, k in zip(arrays['person_money'], arrays['person_income'],
+      arrays['person_employed'], arrays['person_daily_spending'], arrays['person_industry'])
+  ]
+  offsets = np.concatenate(([0], np.cumsum(arrays['company_headcount'])))
+  companies = []
+  for i in range(len(arrays['company_money'])):
+    c = Company(
+      money=float(arrays['company_money'][i]),
+      employees=[people[j] for j in arrays['employees'][offsets[i]:offsets[i+1]]],
+      in_business=bool(arrays['company_in_business'][i]),
+      industry=industry_names[arrays['company_industry'][i]]
+    )
+    c.payroll = float(arrays['company_payroll'][i])
+    companies.append(c)
   return people, companies
 
 # Runs the simulator, given the parameters as defined in design.md; and an
@@ -220,18 +540,58 @@ def pay_employees(people, companies):
 # - companies: the list of companies
 # The caller can use this to record data and/or report progress up a level.
 #
+# The random numbers are drawn from generators seeded with seed, or the config's
+# 'seed' if not given (see make_rngs), so runs with the same seed give the same
+# results.
+#
+# If aggregate_months is True, each month's spending is simulated in one step
+# (see spend_month) instead of day by day, and on_day is only called on the
+# first day of each month. This is much faster, and gives the same results in
+# distribution, so use it when you only need monthly data.
+#
+# If checkpoint_file is given, the full state of the simulation (people,
+# companies, random number generators, and the next period and month) is
+# written to it every checkpoint_months months. If resume is True and the
+# checkpoint file exists, the run continues from it instead of starting over,
+# giving the same results as if it had never stopped: on_day is only called
+# for the days after the checkpoint. Similarly, the run starts from the
+# checkpoint file snapshot if it's given, e.g. a snapshot of a config's first
+# few periods, shared by configs that differ only after them.
+#
+# If instrument is given (see Instrument, e.g. a Profiler), it's called before
+# and after each phase of the run.
+#
 # NOTE: Be mindful - these args are passed by reference, so you can technically
 # change them and mess with the simulation. Please don't do that. Read only. I
 # would have passed a copy instead, but it slows down the simulation a lot.
-def run(config, on_day=lambda period, day, people, companies: None):
-  # Set up simulation
-  industry_names = config['periods'][0]['spending_distribution'][0]
-  people, companies = init(
-    ncompanies=config['ncompanies'],
-    income=config['income'],
-    company_size=config['company_size'],
-    industry_names=industry_names
-  )
+def run(config, on_day=lambda period, day, people, companies: None, aggregate_months=False, seed=None,
+  checkpoint_file=None, checkpoint_months=12, resume=False, snapshot=None, instrument=None):
+  # Set up simulation, or resume it from the checkpoint
+  rngs = make_rngs(config.get('seed') if seed is None else seed)
+  instrument = Instrument() if instrument is None else instrument
+  start_period = 0
+  start_month = 0
+  nmonths = 0
+  if resume and checkpoint_file is not None and os.path.isfile(checkpoint_file):
+    snapshot = checkpoint_file
+  if snapshot is not None:
+    arrays, meta = read_checkpoint(snapshot)
+    if meta['run'] != checkpoint_id(config, 'legacy', aggregate_months, meta['period'], meta['month']):
+      raise ValueError('checkpoint %s is from a different run' % snapshot)
+    people, companies = from_checkpoint_arrays(arrays)
+    rngs = restore_rngs(rngs, meta)
+    start_period = meta['period']
+    start_month = meta['month']
+    nmonths = meta['nmonths']
+  else:
+    industry_names = config['periods'][0]['spending_distribution'][0]
+    people, companies = init(
+      ncompanies=config['ncompanies'],
+      income=config['income'],
+      company_size=config['company_size'],
+      industry_names=industry_names,
+      rng=rngs['init']
+    )
   person_stimulus = None
   company_stimulus = None
   unemployment_benefit = None
@@ -248,31 +608,71 @@ def run(config, on_day=lambda period, day, people, companies: None):
     rehire_rate = rehire_rate if 'rehire_rate' not in config['periods'][i] else config['periods'][i]['rehire_rate']
     spending_inclination = spending_inclination if 'spending_inclination' not in config['periods'][i] else config['periods'][i]['spending_inclination']
     spending_distribution = spending_distribution if 'spending_distribution' not in config['periods'][i] else config['periods'][i]['spending_distribution']
+    if i < start_period:
+      continue
 
-    # Grant stimulus/unemployment benefits for this period
-    people, companies = grant_stimulus(people, companies, person_stimulus, company_stimulus)
-    people = reset_spending_rates(people, spending_inclination)
+    # Grant stimulus/unemployment benefits for this period (unless resuming
+    # partway through it)
+    if i != start_period or start_month == 0:
+      instrument.before('stimulus', people, companies)
+      people, companies = grant_stimulus(people, companies, person_stimulus, company_stimulus)
+      instrument.after('stimulus', people, companies)
+      instrument.before('spending_reset', people, companies)
+      people = reset_spending_rates(people, spending_inclination, rngs['spending'])
+      instrument.after('spending_reset', people, companies)
+
+    # Index the companies in business in each industry. This only changes
+    # when companies go out of business, which layoff_employees keeps up to
+    # date.
+    industries = {
+      ind: [c for c in companies if c.in_business and c.industry == ind]
+      for ind in spending_distribution[0]
+    }
 
     # Run the period
-    for j in range(config['periods'][i]['duration']):
-      for d in range(days_per_month):
-        on_day(i, d, people, companies)
-
-        industries = {
-          ind: [c for c in companies if c.in_business and c.industry == ind]
-          for ind in spending_distribution[0]
-        }
-        people, companies = spend(people, companies, spending_distribution, industries)
-
-        # At the end of the month, companies hire new employees and pay their
-        # employees
-        if d % days_per_month == days_per_month - 1:
-          people, companies = rehire_people(people, companies, rehire_rate)
-          people, companies = layoff_employees(people, companies)
-          people, companies = pay_employees(people, companies)
-
-          # Grant unemployment benefits
-          people = grant_unemployment(people, unemployment_benefit)
-
-          # Reset people's spending rates
-          people = reset_spending_rates(people, spending_inclination)
+    for j in range(start_month if i == start_period else 0, config['periods'][i]['duration']):
+      if aggregate_months:
+        instrument.before('metrics', people, companies)
+        on_day(i, 0, people, companies)
+        instrument.after('metrics', people, companies)
+        instrument.before('spend', people, companies)
+        people, companies = spend_month(people, companies, spending_distribution, industries, rng=rngs['spending'])
+        instrument.after('spend', people, companies)
+      else:
+        for d in range(days_per_month):
+          instrument.before('metrics', people, companies)
+          on_day(i, d, people, companies)
+          instrument.after('metrics', people, companies)
+          instrument.before('spend', people, companies)
+          people, companies = spend(people, companies, spending_distribution, industries, rngs['spending'])
+          instrument.after('spend', people, companies)
+
+      # At the end of the month, companies hire new employees and pay their
+      # employees
+      instrument.before('rehire', people, companies)
+      people, companies = rehire_people(people, companies, rehire_rate, rngs['hiring'])
+      instrument.after('rehire', people, companies)
+      instrument.before('layoff', people, companies)
+      people, companies = layoff_employees(people, companies, industries, rngs['layoffs'])
+      instrument.after('layoff', people, companies)
+      instrument.before('pay', people, companies)
+      people, companies = pay_employees(people, companies)
+      instrument.after('pay', people, companies)
+
+      # Grant unemployment benefits
+      instrument.before('benefits', people, companies)
+      people = grant_unemployment(people, unemployment_benefit)
+      instrument.after('benefits', people, companies)
+
+      # Reset people's spending rates
+      instrument.before('spending_reset', people, companies)
+      people = reset_spending_rates(people, spending_inclination, rngs['spending'])
+      instrument.after('spending_reset', people, companies)
+
+      # Checkpoint the state at the start of the next month
+      nmonths += 1
+      if checkpoint_file is not None and nmonths % checkpoint_months == 0:
+        next_period, next_month = (i, j + 1) if j + 1 < config['periods'][i]['duration'] else (i + 1, 0)
+        write_checkpoint(checkpoint_file, checkpoint_arrays(people, companies), rngs,
+          {'run': checkpoint_id(config, 'legacy', aggregate_months, next_period, next_month),
+           'period': next_period, 'month': next_month, 'nmonths': nmonths})
@@ -1,5 +1,9 @@
+import numpy as np
+import os
 import simulator
 import sys
+import tempfile
+import vectorized
 
 def test_init_company_size():
   print('Check that company sizes are allocated according to the distribution')
@@ -231,6 +235,27 @@ def test_people_spending2():
       return
   print('Passed')
 
+def test_people_spending_month():
+  print('Check that spending a whole month at once spends every day (10 people, 2 companies)')
+  p_money = 100
+  c_money = 0
+  ind = 'industry'
+  daily_spending = 1
+  people = [simulator.Person(money=p_money, daily_spending=daily_spending) for i in range(10)]
+  companies = [simulator.Company(money=c_money, industry=ind) for i in range(2)]
+  people, companies = simulator.spend_month(people, companies, [[ind], [1]], {ind: companies})
+
+  p_money_exp = p_money - simulator.days_per_month * daily_spending
+  c_money_exp = len(people) * simulator.days_per_month * daily_spending
+  if any(p.money != p_money_exp for p in people) or sum(c.money for c in companies) != c_money_exp:
+    print('Failed: money was not spent correctly')
+    print('Expected: p.money = %.2f, total company money = %.2f' % (p_money_exp, c_money_exp))
+    print('Actual:   p.money in %s, total company money = %.2f' % (
+      sorted(set(p.money for p in people)), sum(c.money for c in companies)
+    ))
+    return
+  print('Passed')
+
 def test_people_spending_when_out_of_business():
   print("Check that people don't spend to an out of business company (1 person, 1 company)")
   p_money = 100
@@ -351,6 +376,11 @@ def test_layoff():
     for i in range(len(people)):
       if e == people[i]:
         employee_indices.append(i)
+  if c.payroll != (npeople - 2) * p_income:
+    print('Failed: company payroll was not updated')
+    print('Expected: %.2f' % ((npeople - 2) * p_income))
+    print('Actual:   %.2f' % c.payroll)
+    return
   if sorted(employee_indices) != sorted(employed):
     print('Failed: company has the wrong people listed as employees')
     print('Expected: people indices %s' % sorted(employed))
@@ -421,6 +451,397 @@ def test_rehire():
       return
   print('Passed')
 
+def test_rehire_within_budget():
+  print("Check that a company doesn't hire more people than it can afford (3 people, 1 company)")
+  income = 1
+  people = [simulator.Person(income=income, employed=False) for i in range(3)]
+  companies = [simulator.Company(money=2 * income, employees=[])]
+  people, companies = simulator.rehire_people(people, companies, 1.0)
+
+  nemployed = len([p for p in people if p.employed])
+  if nemployed != 2 or len(companies[0].employees) != 2:
+    print('Failed: wrong number of people were hired')
+    print('Expected: 2')
+    print('Actual:   %d employed, %d employees' % (nemployed, len(companies[0].employees)))
+    return
+  print('Passed')
+
+# Builds vectorized People from parallel lists of attributes
+def make_people(money, income, employed, employer, industry=None):
+  return vectorized.People(
+    money=np.array(money, dtype=float),
+    income=np.array(income, dtype=float),
+    employed=np.array(employed, dtype=bool),
+    daily_spending=np.zeros(len(money)),
+    industry=np.zeros(len(money), dtype=int) if industry is None else np.array(industry),
+    employer=np.array(employer)
+  )
+
+# Builds vectorized Companies from parallel lists of attributes, with the
+# payroll of the given people
+def make_companies(money, industry_names=['industry'], industry=None, in_business=None, people=None):
+  companies = vectorized.Companies(
+    money=np.array(money, dtype=float),
+    in_business=np.ones(len(money), dtype=bool) if in_business is None else np.array(in_business),
+    industry=np.zeros(len(money), dtype=int) if industry is None else np.array(industry),
+    industry_names=list(industry_names)
+  )
+  if people is not None:
+    companies = vectorized.update_payroll(people, companies)
+  return companies
+
+def test_vectorized_init():
+  print('Check that the vectorized init assigns people to companies according to the distribution')
+  low = 10
+  high = 20
+  p = 0.5
+  industry_names = ['industry 1', 'industry 2']
+  people, companies = vectorized.init(ncompanies=100, company_size=[[low, high], [p, p]], industry_names=industry_names)
+
+  sizes = np.bincount(people.employer, minlength=len(companies))
+  if not set(sizes) <= set([low, high]):
+    print('Failed: company sizes are not from the distribution')
+    print('Expected: sizes in %s' % [low, high])
+    print('Actual:   sizes %s' % sorted(set(sizes)))
+    return
+  if not np.all(people.industry == companies.industry[people.employer]):
+    print("Failed: people are not in their company's industry")
+    return
+  counts = np.bincount(companies.industry)
+  if list(counts) != [50, 50]:
+    print('Failed: industries are not assigned evenly')
+    print('Expected: [50, 50]')
+    print('Actual:   %s' % list(counts))
+    return
+  print('Passed')
+
+def test_vectorized_money_dtype():
+  print('Check that a vectorized run with float32 money keeps money in float32, payroll in float64 and ids in int32 throughout')
+  config = dict(simulator.defaults, ncompanies=10, periods=[dict(simulator.defaults['periods'][0], duration=3)], seed=4, money_dtype='float32')
+  dtypes = set()
+  def on_day(period, day, people, companies):
+    dtypes.update([('money', a.dtype.name) for a in [people.money, people.income, people.daily_spending, companies.money]])
+    dtypes.update([('payroll', companies.payroll.dtype.name)])
+    dtypes.update([('ids', a.dtype.name) for a in [people.employer, people.industry, companies.industry, companies.headcount]])
+  vectorized.run(config, on_day=on_day)
+  expected = set([('money', 'float32'), ('payroll', 'float64'), ('ids', 'int32')])
+  if dtypes != expected:
+    print('Failed: arrays changed dtype during the run')
+    print('Expected: %s' % str(sorted(expected)))
+    print('Actual:   %s' % str(sorted(dtypes)))
+    return
+  print('Passed')
+
+def test_vectorized_layoff_float32():
+  print('Check that with float32 money, every company $1 short of its payroll lays off one employee, like with float64 (20000 companies)')
+  laid_off = []
+  for money_dtype in vectorized.money_dtypes:
+    people, companies = vectorized.init(ncompanies=20000, income=[[25000, 65000, 100000, 250000], [0.25] * 4],
+      company_size=[[10], [1]], rng=np.random.default_rng(0), money_dtype=money_dtype)
+    companies.money[:] = companies.payroll - 1
+    people, companies = vectorized.layoff_employees(people, companies, rng=np.random.default_rng(1))
+    payroll = np.bincount(people.employer[people.employed], weights=people.income[people.employed], minlength=len(companies))
+    nover_budget = np.sum(companies.in_business & (payroll > companies.money))
+    if np.sum(~people.employed) != len(companies) or nover_budget != 0 or not np.allclose(companies.payroll, payroll, rtol=0, atol=1e-6):
+      print('Failed: %s companies laid off the wrong number of people' % money_dtype)
+      print('Expected: %d laid off, none over budget, payroll up to date' % len(companies))
+      print('Actual:   %d laid off, %d over budget, payroll off by %g' % (
+        np.sum(~people.employed), nover_budget, np.max(np.abs(companies.payroll - payroll))))
+      return
+    laid_off.append(np.flatnonzero(~people.employed))
+  if not np.array_equal(laid_off[0], laid_off[1]):
+    print('Failed: float32 and float64 companies laid off different people')
+    return
+  print('Passed')
+
+def test_vectorized_float32_run():
+  print('Check that float32 and float64 runs with the same seed make the same hiring, layoff and closure decisions')
+  period = dict(simulator.defaults['periods'][0], duration=2, rehire_rate=0.5, spending_distribution=[['a', 'b'], [0.5, 0.5]])
+  config = dict(simulator.defaults, ncompanies=200, income=[[12000, 60000, 150000], [0.4, 0.4, 0.2]], company_size=[[2, 8, 20], [0.4, 0.4, 0.2]], seed=0,
+    periods=[period, dict(period, duration=6, person_stimulus=0, company_stimulus=0, unemployment_benefit=0.5, spending_distribution=[['a', 'b'], [0.9, 0.1]])])
+  runs = []
+  for money_dtype in vectorized.money_dtypes:
+    states = []
+    def on_day(period, day, people, companies):
+      if day == 0:
+        states.append([list(people.employer), list(companies.in_business)])
+    vectorized.run(dict(config, money_dtype=money_dtype), on_day=on_day)
+    runs.append(states)
+  nclosed = len(runs[0][-1][1]) - sum(runs[0][-1][1])
+  if runs[0] != runs[1] or nclosed == 0:
+    print('Failed: float32 and float64 runs made different decisions')
+    print('Expected: the same employers and closures every month, with some closures')
+    print('Actual:   %d closures, same decisions %s' % (nclosed, runs[0] == runs[1]))
+    return
+  print('Passed')
+
+def test_init_engines_agree():
+  print('Check that both engines initialize the same economy from the same random numbers')
+  args = {'ncompanies': 30, 'income': [[12, 24, 36], [0.2, 0.3, 0.5]], 'company_size': [[1, 5, 10], [0.3, 0.3, 0.4]], 'industry_names': ['a', 'b']}
+  people, companies = simulator.init(rng=np.random.default_rng(3), **args)
+  vpeople, vcompanies = vectorized.init(rng=np.random.default_rng(3), **args)
+  arrays = simulator.checkpoint_arrays(people, companies)
+  expected = [list(vpeople.income), list(vcompanies.headcount), list(vcompanies.payroll), list(vcompanies.industry)]
+  actual = [list(arrays['person_income']), list(arrays['company_headcount']), list(arrays['company_payroll']), list(arrays['company_industry'])]
+  if actual != expected or list(arrays['employees']) != list(range(len(people))):
+    print('Failed: the engines initialize different economies')
+    print('Expected: %s' % str(expected))
+    print('Actual:   %s' % str(actual))
+    return
+  print('Passed')
+
+def test_vectorized_spend():
+  print('Check that vectorized spending moves money from people to companies (100 people, 2 companies in diff industries)')
+  npeople = 100
+  p_money = 100
+  daily_spending = 10
+  people = make_people([p_money] * npeople, [1] * npeople, [True] * npeople, [0] * npeople)
+  people.daily_spending[:] = daily_spending
+  companies = make_companies([0, 0], industry_names=['industry 1', 'industry 2'], industry=[0, 1])
+  people, companies = vectorized.spend(people, companies, [['industry 1', 'industry 2'], [0.75, 0.25]], rng=np.random.default_rng(0))
+
+  if not np.all(people.money == p_money - daily_spending):
+    print('Failed: people spent the wrong amount of money')
+    print('Expected: p.money=%.2f' % (p_money - daily_spending))
+    print('Actual:   p.money in %s' % sorted(set(people.money)))
+    return
+  if np.sum(companies.money) != npeople * daily_spending or not (650 <= companies.money[0] <= 850):
+    print('Failed: company money does not match the distribution')
+    print('Expected: total %.2f, company 0 in [650, 850]' % (npeople * daily_spending))
+    print('Actual:   %s' % list(companies.money))
+    return
+  print('Passed')
+
+def test_vectorized_spend_month():
+  print('Check that vectorized spending for a whole month matches the spending distribution (1000 people, 2 companies in diff industries)')
+  npeople = 1000
+  p_money = 100
+  daily_spending = 1
+  people = make_people([p_money] * npeople, [1] * npeople, [True] * npeople, [0] * npeople)
+  people.daily_spending[:] = daily_spending
+  companies = make_companies([0, 0], industry_names=['industry 1', 'industry 2'], industry=[0, 1])
+  people, companies = vectorized.spend_month(people, companies, [['industry 1', 'industry 2'], [0.75, 0.25]], rng=np.random.default_rng(0))
+
+  total = npeople * simulator.days_per_month * daily_spending
+  if not np.all(people.money == p_money - simulator.days_per_month * daily_spending):
+    print('Failed: people spent the wrong amount of money')
+    print('Expected: p.money=%.2f' % (p_money - simulator.days_per_month * daily_spending))
+    print('Actual:   p.money in %s' % sorted(set(people.money)))
+    return
+  if np.sum(companies.money) != total or not (0.73 * total <= companies.money[0] <= 0.77 * total):
+    print('Failed: company money does not match the distribution')
+    print('Expected: total %.2f, company 0 in [%.2f, %.2f]' % (total, 0.73 * total, 0.77 * total))
+    print('Actual:   %s' % list(companies.money))
+    return
+  print('Passed')
+
+def test_vectorized_pay_employees():
+  print('Check that vectorized companies pay employed people only (3 people, 2 companies)')
+  people = make_people([1, 1, 1], [1, 2, 3], [True, True, False], [0, 1, -1])
+  companies = make_companies([5, 5], people=people)
+  people, companies = vectorized.pay_employees(people, companies)
+
+  if list(people.money) != [2, 3, 1] or list(companies.money) != [4, 3]:
+    print('Failed: money was not paid correctly')
+    print('Expected: people [2, 3, 1], companies [4, 3]')
+    print('Actual:   people %s, companies %s' % (list(people.money), list(companies.money)))
+    return
+  print('Passed')
+
+def test_vectorized_layoff():
+  print("Check that a vectorized company lays off 2/4 employees when it can't afford them, and another closes (5 people, 2 companies)")
+  people = make_people([0] * 5, [1] * 5, [True] * 5, [0, 0, 0, 0, 1])
+  companies = make_companies([2, 0.5], people=people)
+  people, companies = vectorized.layoff_employees(people, companies)
+
+  if np.sum(people.employed[:4]) != 2 or np.any(people.employer[~people.employed] != -1):
+    print('Failed: wrong people were laid off')
+    print('Expected: 2 of the first 4 people employed')
+    print('Actual:   employed=%s, employer=%s' % (list(people.employed), list(people.employer)))
+    return
+  if list(companies.in_business) != [True, False] or people.employed[4]:
+    print('Failed: wrong company went out of business')
+    print('Expected: in_business=[True, False]')
+    print('Actual:   in_business=%s' % list(companies.in_business))
+    return
+  if list(companies.payroll) != [2, 0] or list(companies.headcount) != [2, 0]:
+    print('Failed: payroll was not updated')
+    print('Expected: payroll=[2, 0], headcount=[2, 0]')
+    print('Actual:   payroll=%s, headcount=%s' % (list(companies.payroll), list(companies.headcount)))
+    return
+  print('Passed')
+
+def test_vectorized_rehire():
+  print('Check that vectorized rehiring only hires into companies that can afford the person (2 people, 2 companies)')
+  people = make_people([0, 0], [1, 5], [False, False], [-1, -1], industry=[0, 0])
+  companies = make_companies([0, 2], industry_names=['old industry', 'new industry'], industry=[0, 1])
+  people, companies = vectorized.rehire_people(people, companies, 1.0)
+
+  if list(people.employed) != [True, False] or list(people.employer) != [1, -1] or people.industry[0] != 1:
+    print('Failed: wrong people were hired')
+    print('Expected: employed=[True, False], employer=[1, -1], industry[0]=1')
+    print('Actual:   employed=%s, employer=%s, industry[0]=%d' % (
+      list(people.employed), list(people.employer), people.industry[0]
+    ))
+    return
+  if list(companies.payroll) != [0, 1] or list(companies.headcount) != [0, 1]:
+    print('Failed: payroll was not updated')
+    print('Expected: payroll=[0, 1], headcount=[0, 1]')
+    print('Actual:   payroll=%s, headcount=%s' % (list(companies.payroll), list(companies.headcount)))
+    return
+  print('Passed')
+
+def test_vectorized_industry_index():
+  print('Check that companies that go out of business are removed from the industry index (3 people, 3 companies)')
+  people = make_people([0] * 3, [1] * 3, [True] * 3, [0, 1, 2])
+  companies = make_companies([1, 0, 1], industry_names=['industry 1', 'industry 2'], industry=[0, 0, 1], people=people)
+  industries = vectorized.IndustryIndex(companies, [['industry 2', 'industry 1'], [0.5, 0.5]])
+  people, companies = vectorized.layoff_employees(people, companies, industries)
+
+  if list(industries.offsets) != [0, 1, 2] or list(industries.members) != [2, 0]:
+    print('Failed: industry index is wrong')
+    print('Expected: offsets=[0, 1, 2], members=[2, 0]')
+    print('Actual:   offsets=%s, members=%s' % (list(industries.offsets), list(industries.members)))
+    return
+  print('Passed')
+
+def test_run_reproducible():
+  print('Check that runs with the same seed give the same results, with both engines')
+  config = {
+    'ncompanies': 20,
+    'income': [[12, 24], [0.5, 0.5]],
+    'company_size': [[5, 10], [0.5, 0.5]],
+    'periods': [dict(simulator.defaults['periods'][0], duration=6, rehire_rate=0.5)]
+  }
+  for engine in [simulator, vectorized]:
+    money = []
+    for seed in [1, 1, 2]:
+      run_money = []
+      def on_day(period, day, people, companies):
+        if day == 0:
+          run_money.append(sorted([p.money for p in people]) if engine == simulator else list(people.money))
+      engine.run(config, on_day=on_day, seed=seed)
+      money.append(run_money)
+    if money[0] != money[1] or money[0] == money[2]:
+      print('Failed: %s runs are not reproducible' % engine.__name__)
+      print('Expected: same results for the same seed, different for different seeds')
+      print('Actual:   same seed equal=%s, different seed equal=%s' % (money[0] == money[1], money[0] == money[2]))
+      return
+  print('Passed')
+
+def test_run_aggregate_months():
+  print('Check that a run with aggregated months calls on_day once a month and matches a daily run, with both engines')
+  config = dict(simulator.defaults, ncompanies=200, periods=[dict(simulator.defaults['periods'][0], duration=6, rehire_rate=0.5)],
+    seed=1)
+  for engine in [simulator, vectorized]:
+    results = []
+    for aggregate_months in [False, True]:
+      # Count the calls, and record circulation and unemployment each month
+      ncalls = [0]
+      months = []
+      def on_day(period, day, people, companies):
+        ncalls[0] += 1
+        if day != 0:
+          return
+        if engine == simulator:
+          circulation = sum([p.money for p in people]) + sum([c.money for c in companies])
+          unemployment = np.mean([not p.employed for p in people])
+        else:
+          circulation = np.sum(people.money, dtype=float) + np.sum(companies.money, dtype=float)
+          unemployment = np.mean(~people.employed)
+        months.append((circulation, unemployment))
+      engine.run(config, on_day=on_day, aggregate_months=aggregate_months)
+      results.append((ncalls[0], np.array(months)))
+    (daily_calls, daily), (monthly_calls, monthly) = results
+    if daily_calls != 6 * simulator.days_per_month or monthly_calls != 6:
+      print('Failed: %s called on_day the wrong number of times' % engine.__name__)
+      print('Expected: %d daily, 6 with aggregated months' % (6 * simulator.days_per_month))
+      print('Actual:   %d daily, %d with aggregated months' % (daily_calls, monthly_calls))
+      return
+    if not (np.allclose(monthly[:, 0], daily[:, 0], rtol=0.02) and np.allclose(monthly[:, 1], daily[:, 1], rtol=0, atol=0.02)):
+      print('Failed: %s run with aggregated months differs from the daily run' % engine.__name__)
+      print('Expected: circulation within 2%%, unemployment within 0.02 of %s' % str(daily.tolist()))
+      print('Actual:   %s' % str(monthly.tolist()))
+      return
+  print('Passed')
+
+def test_run_resume():
+  print('Check that a run resumed from a checkpoint gives the same results as an uninterrupted run, with both engines, daily and aggregated months')
+  config = {
+    'ncompanies': 20,
+    'income': [[12, 24], [0.5, 0.5]],
+    'company_size': [[5, 10], [0.5, 0.5]],
+    'periods': [
+      dict(simulator.defaults['periods'][0], duration=4, rehire_rate=0.5),
+      dict(simulator.defaults['periods'][0], duration=3, person_stimulus=2)
+    ],
+    'seed': 1
+  }
+  class Stop(Exception):
+    pass
+  for engine in [simulator, vectorized]:
+    for aggregate_months in [True, False]:
+      # Run uninterrupted, then stop a checkpointed run after 5 months and resume
+      checkpoint_file = os.path.join(tempfile.mkdtemp(), 'checkpoint.npz')
+      money = []
+      def on_day(period, day, people, companies):
+        if day == 0:
+          money.append(sorted([p.money for p in people]) if engine == simulator else list(people.money))
+      engine.run(config, on_day=on_day, aggregate_months=aggregate_months)
+      expected = money
+      money = []
+      def on_day_stop(period, day, people, companies):
+        if day == 0 and len(money) == 5:
+          raise Stop()
+        on_day(period, day, people, companies)
+      try:
+        engine.run(config, on_day=on_day_stop, aggregate_months=aggregate_months, checkpoint_file=checkpoint_file,
+          checkpoint_months=2)
+      except Stop:
+        pass
+      money = money[:4] # the checkpoint is from the start of month 4
+      engine.run(config, on_day=on_day, aggregate_months=aggregate_months, checkpoint_file=checkpoint_file,
+        checkpoint_months=2, resume=True)
+      if len(expected) != 7 or money != expected:
+        print('Failed: %s run resumed from a checkpoint differs, aggregate_months=%s' % (engine.__name__, aggregate_months))
+        print('Expected: %s' % str(expected[-1]))
+        print('Actual:   %s' % str(money[-1]))
+        return
+
+    # The checkpoint left is from the daily run, which can't be resumed with
+    # aggregated months
+    try:
+      engine.run(config, aggregate_months=True, checkpoint_file=checkpoint_file, checkpoint_months=2, resume=True)
+    except ValueError:
+      continue
+    print('Failed: %s resumed a checkpoint of a daily run with aggregated months' % engine.__name__)
+    print('Expected: ValueError')
+    return
+  print('Passed')
+
+def test_run_profiler():
+  print('Check that a profiler counts every phase of a run, with both engines, without changing the results')
+  config = dict(simulator.defaults, ncompanies=10, periods=[dict(simulator.defaults['periods'][0], duration=3)], seed=2)
+  for engine in [simulator, vectorized]:
+    money = []
+    def on_day(period, day, people, companies):
+      if day == 0:
+        money.append(sorted([p.money for p in people]) if engine == simulator else list(people.money))
+    engine.run(config, on_day=on_day)
+    expected = money
+    money = []
+    profiler = simulator.Profiler()
+    engine.run(config, on_day=on_day, instrument=profiler)
+    report = profiler.report()
+    calls = {phase: stats['calls'] for phase, stats in report.items()}
+    expected_calls = {'metrics': 90, 'spend': 90, 'rehire': 3, 'layoff': 3, 'pay': 3, 'benefits': 3, 'stimulus': 1, 'spending_reset': 4}
+    if calls != expected_calls or report['pay']['people'] != 3 * 100 or money != expected:
+      print('Failed: %s run with a profiler' % engine.__name__)
+      print('Expected: %s' % str(expected_calls))
+      print('Actual:   %s' % str(calls))
+      return
+  print('Passed')
+
 # Run all tests
 def main():
   test_init_company_size()
@@ -433,12 +854,29 @@ def main():
   test_unemployment_benefit()
   test_people_spending1()
   test_people_spending2()
+  test_people_spending_month()
   test_people_spending_when_out_of_business()
   test_pay_employees()
   test_unemployed_people_are_not_paid()
   test_layoff()
   test_company_goes_out_of_business()
   test_rehire()
+  test_rehire_within_budget()
+  test_vectorized_init()
+  test_init_engines_agree()
+  test_vectorized_money_dtype()
+  test_vectorized_layoff_float32()
+  test_vectorized_float32_run()
+  test_vectorized_spend()
+  test_vectorized_spend_month()
+  test_vectorized_pay_employees()
+  test_vectorized_layoff()
+  test_vectorized_rehire()
+  test_vectorized_industry_index()
+  test_run_reproducible()
+  test_run_aggregate_months()
+  test_run_resume()
+  test_run_profiler()
 
 if __name__ == '__main__':
   main()
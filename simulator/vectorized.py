@@ -0,0 +1,470 @@
+'''
+A vectorized version of the simulator. It implements the same algorithm as
+simulator.py and takes the same config, but instead of one Python object per
+person and company, it keeps the state of all agents in parallel NumPy arrays
+(one array per attribute), so each step of the simulation is a handful of array
+operations rather than a Python loop over every agent.
+'''
+
+import json
+import numpy as np
+import os
+try:
+  from simulator import simulator
+except ImportError: # imported from within simulator/, e.g. by test.py
+  import simulator
+
+# The dtypes money can be kept in (the config's 'money_dtype', default
+# float64). float32 halves the memory of people's money, income and daily
+# spending, and companies' money, at the cost of rounding large amounts to
+# about 7 significant digits. Sums over many people are still computed in
+# float64, and companies' payrolls are always kept in float64: they're updated
+# incrementally on every hire and layoff, and in float32 they'd drift away from
+# the true payroll.
+money_dtypes = ['float64', 'float32']
+
+# The dtype of indices of companies and industries, and of headcounts
+id_dtype = np.int32
+
+# All people in the model. Entry i of each array describes person i.
+class People:
+
+  def __init__(self, money, income, employed, daily_spending, industry, employer):
+    self.money = money
+    self.income = income # income *per month* (not annual)
+    self.employed = employed
+    self.daily_spending = daily_spending # amount to spend each day this month
+    self.industry = industry # index into the companies' industry_names
+    self.employer = employer # index of the company they work for, -1 if unemployed
+
+  def __len__(self):
+    return len(self.money)
+
+# All companies in the model. Entry i of each array describes company i.
+class Companies:
+
+  def __init__(self, money, in_business, industry, industry_names, payroll=None, headcount=None):
+    self.money = money
+    self.in_business = in_business
+    self.industry = industry # index into industry_names
+    self.industry_names = industry_names
+    self.payroll = np.zeros(len(money)) if payroll is None else payroll # total monthly income of employees, in float64
+    self.headcount = np.zeros(len(money), dtype=id_dtype) if headcount is None else headcount # number of employees
+
+  def __len__(self):
+    return len(self.money)
+
+  # Returns the index of the industry with the given name, adding it if this is
+  # the first time it's seen (e.g. a later period spends in a new industry)
+  def industry_id(self, name):
+    if name not in self.industry_names:
+      self.industry_names.append(name)
+    return self.industry_names.index(name)
+
+# Recomputes each company's payroll and headcount from scratch. Hiring and
+# laying off people keep them up to date, so this is only needed after
+# changing people's employment or income directly. Returns the updated
+# companies.
+def update_payroll(people, companies):
+  employer = people.employer[people.employed]
+  companies.payroll = np.bincount(employer, weights=people.income[people.employed], minlength=len(companies))
+  companies.headcount = np.bincount(employer, minlength=len(companies)).astype(id_dtype)
+  return companies
+
+# Picks a new spending rate for each person given the spending inclination, as
+# in simulator.reset_spending_rates. Returns the updated people.
+def reset_spending_rates(people, spending_inclination, rng=np.random):
+  lo = 0
+  hi = 1
+  diff = spending_inclination - 0.5
+  if diff > 0:
+    lo += 2 * diff
+  else:
+    hi += 2 * diff # remember diff is negative
+  rates = lo + rng.random(len(people)) * (hi - lo)
+  people.daily_spending = (rates * people.money / simulator.days_per_month).astype(people.money.dtype)
+  return people
+
+# Initializes the simulator. Returns the people and companies, with money in
+# money_dtype (see money_dtypes) and indices in id_dtype.
+def init(
+  ncompanies=simulator.defaults['ncompanies'],
+  income=simulator.defaults['income'],
+  company_size=simulator.defaults['company_size'],
+  industry_names=simulator.defaults['periods'][0]['spending_distribution'][0],
+  rng=np.random,
+  money_dtype='float64'
+  ):
+
+  if money_dtype not in money_dtypes:
+    raise ValueError('invalid money dtype %s' % json.dumps(money_dtype))
+
+  # Draw every agent's arrays at once
+  industry_names = list(industry_names)
+  state = simulator.init_arrays(ncompanies, income, company_size, industry_names, rng)
+  company_industry = state['company_industry'].astype(id_dtype)
+  employer = state['employer'].astype(id_dtype)
+  npeople = len(employer)
+
+  people = People(
+    money=np.zeros(npeople, dtype=money_dtype),
+    income=state['income'].astype(money_dtype),
+    employed=np.ones(npeople, dtype=bool),
+    daily_spending=np.zeros(npeople, dtype=money_dtype),
+    industry=company_industry[employer],
+    employer=employer
+  )
+  companies = Companies(
+    money=np.zeros(ncompanies, dtype=money_dtype),
+    in_business=np.ones(ncompanies, dtype=bool),
+    industry=company_industry,
+    industry_names=industry_names
+  )
+  companies = update_payroll(people, companies)
+  return people, companies
+
+# Grant stimulus for people and companies. Returns the updated people and
+# companies.
+def grant_stimulus(people, companies, person_stimulus, company_stimulus):
+  people.money += person_stimulus * people.income
+  companies.money += company_stimulus * companies.payroll
+  return people, companies
+
+# Grant the unemployment benefit to people. Returns the updated people.
+def grant_unemployment(people, unemployment_benefit):
+  unemployed = ~people.employed
+  people.money[unemployed] += unemployment_benefit * people.income[unemployed]
+  return people
+
+# A compact index of the companies in business in each industry of a spending
+# distribution: members[offsets[k]:offsets[k+1]] are the indices of the
+# companies in business in the industry spending_distribution[0][k].
+class IndustryIndex:
+
+  def __init__(self, companies, spending_distribution):
+    names = spending_distribution[0]
+    position = np.full(len(companies.industry_names) + len(names), -1)
+    position[[companies.industry_id(name) for name in names]] = np.arange(len(names))
+
+    in_business = np.flatnonzero(companies.in_business)
+    k = position[companies.industry[in_business]]
+    in_distribution = k >= 0
+    order = np.argsort(k[in_distribution], kind='stable')
+    self.members = in_business[in_distribution][order]
+    self.offsets = np.zeros(len(names) + 1, dtype=int)
+    self.offsets[1:] = np.cumsum(np.bincount(k[in_distribution], minlength=len(names)))
+
+  # Removes the given companies from the index, e.g. when they go out of
+  # business
+  def remove(self, closed):
+    keep = ~np.isin(self.members, closed)
+    k = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+    self.offsets[1:] = np.cumsum(np.bincount(k[keep], minlength=len(self.offsets) - 1))
+    self.members = self.members[keep]
+
+# Picks the company for a batch of purchases, each from one random number in
+# rands: the industry is the bucket of the spending distribution's CDF the
+# number falls in, and where it falls within that bucket picks the company.
+# Purchases in an industry with no companies in business don't happen. Returns
+# (purchases, c), the indices into rands of the purchases that happen and the
+# company each one is made at.
+def pick_companies(rands, spending_distribution, industries):
+  offsets, members = industries.offsets, industries.members
+  p = np.asarray(spending_distribution[1], dtype=float) / np.sum(spending_distribution[1])
+  cdf = np.cumsum(p)
+  counts = np.diff(offsets)
+  scale = np.divide(counts, p, out=np.zeros(len(p)), where=p > 0) # companies per unit of probability
+  k = np.minimum(np.searchsorted(cdf, rands, side='right'), len(p) - 1)
+  purchases = np.flatnonzero(counts[k] > 0)
+  k = k[purchases]
+  within = ((rands[purchases] - (cdf[k] - p[k])) * scale[k]).astype(int)
+  c = members[offsets[k] + np.minimum(within, counts[k] - 1)]
+  return purchases, c
+
+# Each person picks a random company within an industry chosen from the
+# spending distribution, and spends their daily spending at that company.
+# Returns the updated people and companies.
+# - industries: the IndustryIndex for the spending distribution. Built from the
+#   companies if not given.
+def spend(people, companies, spending_distribution, industries=None, rng=np.random):
+  industries = IndustryIndex(companies, spending_distribution) if industries is None else industries
+  if len(industries.members) == 0:
+    return people, companies
+
+  # Pick the company for every person at once, then move the money
+  spenders, c = pick_companies(rng.random(len(people)), spending_distribution, industries)
+  amount = people.daily_spending[spenders]
+  people.money[spenders] -= amount
+  companies.money += np.bincount(c, weights=amount, minlength=len(companies))
+  return people, companies
+
+# The most purchases spend_month draws at once, to bound its memory use
+spend_month_batch = 2**22
+
+# Equivalent to calling spend() ndays times in a row, but draws all of the
+# days' purchases at once and moves the whole month's money in one step. The
+# result has the same distribution as spending day by day, since nothing but
+# money changes in between. Returns the updated people and companies.
+def spend_month(people, companies, spending_distribution, industries=None, ndays=simulator.days_per_month, rng=np.random):
+  industries = IndustryIndex(companies, spending_distribution) if industries is None else industries
+  if len(industries.members) == 0:
+    return people, companies
+
+  credit = np.zeros(len(companies))
+  batch = max(1, spend_month_batch // ndays) # people per batch
+  for start in range(0, len(people), batch):
+    rows = np.arange(start, min(start + batch, len(people)))
+    purchases, c = pick_companies(rng.random(len(rows) * ndays), spending_distribution, industries)
+    spender = rows[purchases // ndays]
+    people.money[rows] -= np.bincount(purchases // ndays, minlength=len(rows)) * people.daily_spending[rows]
+    credit += np.bincount(c, weights=people.daily_spending[spender], minlength=len(companies))
+  companies.money += credit
+  return people, companies
+
+# Companies that can afford to hire unemployed people do so with probability
+# rehire_rate, giving each person an equally likely chance of being hired by
+# any company that can still afford them (see simulator.match_hires). Returns
+# the updated people and companies.
+def rehire_people(people, companies, rehire_rate, rng=np.random):
+  unemployed = rng.permutation(np.flatnonzero(~people.employed))
+  in_business = np.flatnonzero(companies.in_business)
+  rehire = rng.random(len(unemployed)) <= rehire_rate # whether to rehire each person
+  unemployed = unemployed[rehire]
+
+  # Pick the company that will hire each person
+  spare = companies.money[in_business].astype(float) - companies.payroll[in_business]
+  hirer = simulator.match_hires(people.income[unemployed], spare, rng)
+  p = unemployed[hirer != -1]
+  c = in_business[hirer[hirer != -1]]
+  people.employed[p] = True
+  people.employer[p] = c
+  people.industry[p] = companies.industry[c]
+  companies.payroll += np.bincount(c, weights=people.income[p], minlength=len(companies))
+  companies.headcount += np.bincount(c, minlength=len(companies))
+  return people, companies
+
+# Companies lay off random employees until they can afford to pay the rest,
+# going out of business if they have to lay off all of them. Returns the
+# updated people and companies.
+# - industries: an IndustryIndex to remove the companies that go out of
+#   business from, if given
+def layoff_employees(people, companies, industries=None, rng=np.random):
+  over_budget = companies.in_business & (companies.payroll > companies.money)
+  if not np.any(over_budget):
+    return people, companies
+
+  # Put the employees of the companies over budget in a random order, grouped
+  # by company
+  employees = np.flatnonzero(people.employed & over_budget[people.employer])
+  employees = employees[np.lexsort((rng.random(len(employees)), people.employer[employees]))]
+  employer = people.employer[employees]
+
+  # Each company lays off employees in that order while its remaining payroll
+  # is more than it can afford, i.e. while the expense removed by the layoffs
+  # before each employee is less than the excess. The running sum is over every
+  # company's employees, so it's in float64 even if money is float32.
+  income = people.income[employees].astype(float)
+  removed = np.cumsum(income)
+  group_start = np.flatnonzero(np.r_[True, employer[1:] != employer[:-1]]) if len(employer) != 0 else np.array([], dtype=int)
+  removed -= np.repeat(removed[group_start] - income[group_start], np.diff(np.r_[group_start, len(employer)]))
+  excess = companies.payroll[employer] - companies.money[employer].astype(float)
+  laid_off = removed - income < excess
+
+  # Lay off those people, and close the companies that laid off everyone
+  c = employer[laid_off]
+  companies.payroll -= np.bincount(c, weights=income[laid_off], minlength=len(companies))
+  companies.headcount -= np.bincount(c, minlength=len(companies))
+  closed = np.flatnonzero(over_budget & (companies.headcount == 0))
+  companies.in_business[closed] = False
+  companies.payroll[closed] = 0
+  people.employed[employees[laid_off]] = False
+  people.employer[employees[laid_off]] = -1
+
+  if industries is not None and len(closed) != 0:
+    industries.remove(closed)
+  return people, companies
+
+# Each company pays its employees one month's income. Returns the updated
+# people and companies.
+def pay_employees(people, companies):
+  companies.money -= companies.payroll
+  people.money[people.employed] += people.income[people.employed]
+  return people, companies
+
+# Returns the state of the people and companies as a dict of arrays, for a
+# checkpoint (see simulator.write_checkpoint)
+def checkpoint_arrays(people, companies):
+  return {
+    'person_money': people.money,
+    'person_income': people.income,
+    'person_employed': people.employed,
+    'person_daily_spending': people.daily_spending,
+    'person_industry': people.industry,
+    'person_employer': people.employer,
+    'company_money': companies.money,
+    'company_in_business': companies.in_business,
+    'company_industry': companies.industry,
+    'company_payroll': companies.payroll,
+    'company_headcount': companies.headcount,
+    'industry_names': np.array(companies.industry_names, dtype=str)
+  }
+
+# Returns the people and companies from the arrays of a checkpoint (see
+# checkpoint_arrays())
+def from_checkpoint_arrays(arrays):
+  people = People(
+    money=arrays['person_money'],
+    income=arrays['person_income'],
+    employed=arrays['person_employed'],
+    daily_spending=arrays['person_daily_spending'],
+    industry=arrays['person_industry'],
+    employer=arrays['person_employer']
+  )
+  companies = Companies(
+    money=arrays['company_money'],
+    in_business=arrays['company_in_business'],
+    industry=arrays['company_industry'],
+    industry_names=[str(name) for name in arrays['industry_names']],
+    payroll=arrays['company_payroll'].astype(float),
+    headcount=arrays['company_headcount']
+  )
+  return people, companies
+
+# Returns an estimate of the memory a run of a config takes, in bytes, like
+# simulator.estimate_bytes:
+# - state: the arrays of people and companies, in the config's money dtype
+# - working: the temporary arrays of a day of spending and of computing its
+#   results (about 64 bytes per person), or with aggregate_months, of a batch
+#   of a month's purchases (about 80 bytes per purchase, see spend_month_batch)
+#   if that's more
+# - base: simulator.base_bytes
+# - total: the sum
+# The constants were measured with tracemalloc on runs of 1M people.
+def estimate_bytes(config, aggregate_months=False):
+  npeople = simulator.expected_npeople(config)
+  money = np.dtype(config.get('money_dtype', 'float64')).itemsize
+  ids = np.dtype(id_dtype).itemsize
+  estimate = {
+    'state': npeople * (3 * money + 2 * ids + 1) + config['ncompanies'] * (money + 8 + 2 * ids + 1),
+    'working': 64 * npeople,
+    'base': simulator.base_bytes
+  }
+  if aggregate_months:
+    estimate['working'] = max(estimate['working'], 80 * min(npeople * simulator.days_per_month, spend_month_batch))
+  estimate['total'] = sum(estimate.values())
+  return estimate
+
+# Runs the simulator. Takes the same config and callbacks as simulator.run
+# (including checkpointing and instruments), except that on_day receives the
+# People and Companies arrays instead of lists of objects (util.results accepts
+# either).
+def run(config, on_day=lambda period, day, people, companies: None, aggregate_months=False, seed=None,
+  checkpoint_file=None, checkpoint_months=12, resume=False, snapshot=None, instrument=None):
+  # Set up simulation, or resume it from the checkpoint
+  rngs = simulator.make_rngs(config.get('seed') if seed is None else seed)
+  instrument = simulator.Instrument() if instrument is None else instrument
+  start_period = 0
+  start_month = 0
+  nmonths = 0
+  if resume and checkpoint_file is not None and os.path.isfile(checkpoint_file):
+    snapshot = checkpoint_file
+  if snapshot is not None:
+    arrays, meta = simulator.read_checkpoint(snapshot)
+    if meta['run'] != simulator.checkpoint_id(config, 'vectorized', aggregate_months, meta['period'], meta['month']):
+      raise ValueError('checkpoint %s is from a different run' % snapshot)
+    people, companies = from_checkpoint_arrays(arrays)
+    rngs = simulator.restore_rngs(rngs, meta)
+    start_period = meta['period']
+    start_month = meta['month']
+    nmonths = meta['nmonths']
+  else:
+    industry_names = config['periods'][0]['spending_distribution'][0]
+    people, companies = init(
+      ncompanies=config['ncompanies'],
+      income=config['income'],
+      company_size=config['company_size'],
+      industry_names=industry_names,
+      rng=rngs['init'],
+      money_dtype=config.get('money_dtype', 'float64')
+    )
+  person_stimulus = None
+  company_stimulus = None
+  unemployment_benefit = None
+  rehire_rate = None
+  spending_inclination = None
+  spending_distribution = None
+
+  # Run simluation
+  for i in range(len(config['periods'])):
+    # Set parameters for this period
+    person_stimulus = person_stimulus if 'person_stimulus' not in config['periods'][i] else config['periods'][i]['person_stimulus']
+    company_stimulus = company_stimulus if 'company_stimulus' not in config['periods'][i] else config['periods'][i]['company_stimulus']
+    unemployment_benefit = unemployment_benefit if 'unemployment_benefit' not in config['periods'][i] else config['periods'][i]['unemployment_benefit']
+    rehire_rate = rehire_rate if 'rehire_rate' not in config['periods'][i] else config['periods'][i]['rehire_rate']
+    spending_inclination = spending_inclination if 'spending_inclination' not in config['periods'][i] else config['periods'][i]['spending_inclination']
+    spending_distribution = spending_distribution if 'spending_distribution' not in config['periods'][i] else config['periods'][i]['spending_distribution']
+    if i < start_period:
+      continue
+
+    # Grant stimulus/unemployment benefits for this period (unless resuming
+    # partway through it)
+    if i != start_period or start_month == 0:
+      instrument.before('stimulus', people, companies)
+      people, companies = grant_stimulus(people, companies, person_stimulus, company_stimulus)
+      instrument.after('stimulus', people, companies)
+      instrument.before('spending_reset', people, companies)
+      people = reset_spending_rates(people, spending_inclination, rngs['spending'])
+      instrument.after('spending_reset', people, companies)
+
+    # Index the companies in business in each industry. This only changes
+    # when companies go out of business, which layoff_employees keeps up to
+    # date.
+    industries = IndustryIndex(companies, spending_distribution)
+
+    # Run the period
+    for j in range(start_month if i == start_period else 0, config['periods'][i]['duration']):
+      if aggregate_months:
+        instrument.before('metrics', people, companies)
+        on_day(i, 0, people, companies)
+        instrument.after('metrics', people, companies)
+        instrument.before('spend', people, companies)
+        people, companies = spend_month(people, companies, spending_distribution, industries, rng=rngs['spending'])
+        instrument.after('spend', people, companies)
+      else:
+        for d in range(simulator.days_per_month):
+          instrument.before('metrics', people, companies)
+          on_day(i, d, people, companies)
+          instrument.after('metrics', people, companies)
+          instrument.before('spend', people, companies)
+          people, companies = spend(people, companies, spending_distribution, industries, rngs['spending'])
+          instrument.after('spend', people, companies)
+
+      # At the end of the month, companies hire new employees and pay their
+      # employees
+      instrument.before('rehire', people, companies)
+      people, companies = rehire_people(people, companies, rehire_rate, rngs['hiring'])
+      instrument.after('rehire', people, companies)
+      instrument.before('layoff', people, companies)
+      people, companies = layoff_employees(people, companies, industries, rngs['layoffs'])
+      instrument.after('layoff', people, companies)
+      instrument.before('pay', people, companies)
+      people, companies = pay_employees(people, companies)
+      instrument.after('pay', people, companies)
+
+      # Grant unemployment benefits
+      instrument.before('benefits', people, companies)
+      people = grant_unemployment(people, unemployment_benefit)
+      instrument.after('benefits', people, companies)
+
+      # Reset people's spending rates
+      instrument.before('spending_reset', people, companies)
+      people = reset_spending_rates(people, spending_inclination, rngs['spending'])
+      instrument.after('spending_reset', people, companies)
+
+      # Checkpoint the state at the start of the next month
+      nmonths += 1
+      if checkpoint_file is not None and nmonths % checkpoint_months == 0:
+        next_period, next_month = (i, j + 1) if j + 1 < config['periods'][i]['duration'] else (i + 1, 0)
+        simulator.write_checkpoint(checkpoint_file, checkpoint_arrays(people, companies), rngs,
+          {'run': simulator.checkpoint_id(config, 'vectorized', aggregate_months, next_period, next_month),
+           'period': next_period, 'month': next_month, 'nmonths': nmonths})
@@ -0,0 +1,80 @@
+'''
+Runs scenarios that branch off a shared history: configs that are the same
+except for their later periods (e.g. different shutdown policies after the
+same normal economy). The shared periods are simulated once, and the state at
+the end of them is snapshotted to a checkpoint. Each branch then starts from
+the snapshot instead of simulating the shared periods again, in parallel on a
+pool of processes.
+
+Since every branch starts from the same state, random number generators
+included, the branches only differ because of their policies, which makes them
+easier to compare than independent runs.
+'''
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from simulator import simulator
+from util import util
+import os
+import tempfile
+
+# Returns the number of periods at the start of every config that are the same
+# in all of them (0 if anything but the periods differs, e.g. the seed)
+def shared_periods(configs):
+  base = lambda config: {k: v for k, v in config.items() if k != 'periods'}
+  if any([base(config) != base(configs[0]) for config in configs]):
+    return 0
+  n = 0
+  while all([n < len(config['periods']) and config['periods'][n] == configs[0]['periods'][n] for config in configs]):
+    n += 1
+  return n
+
+# Runs one config (or its first nperiods periods) from the snapshot (or from
+# the start if it's None), optionally writing a snapshot at the end. Returns the
+# list of results from the first day of each month it ran.
+def run_from(config, snapshot=None, engine='legacy', aggregate_months=False, epsilon=None,
+  nperiods=None, snapshot_file=None):
+  if nperiods is not None:
+    config = dict(config, periods=config['periods'][:nperiods])
+  results = []
+  def on_day(period, day, people, companies):
+    if day % simulator.days_per_month == 0:
+      results.append(util.results(people, companies, epsilon))
+  nmonths = sum([p['duration'] for p in config['periods']])
+  util.engines[engine].run(config, on_day=on_day, aggregate_months=aggregate_months,
+    snapshot=snapshot, checkpoint_file=snapshot_file, checkpoint_months=max(nmonths, 1))
+  return results
+
+# Runs each of the configs, simulating the periods they share only once. Runs
+# the branches on a pool of the given number of worker processes (default: one
+# per CPU), and calls on_branch(i, results) as each one finishes. The snapshot
+# of the shared periods is kept in directory (default: a temporary directory).
+# Returns the list of each config's monthly results, in order, including the
+# shared months, as if it had been run on its own.
+def run(configs, workers=None, engine='legacy', aggregate_months=False, epsilon=None, directory=None,
+  on_branch=lambda i, results: None):
+  with tempfile.TemporaryDirectory() as tmp:
+    directory = tmp if directory is None else directory
+
+    # Simulate the shared periods once, and snapshot the end of them
+    nshared = shared_periods(configs)
+    snapshot = None
+    shared = []
+    if nshared > 0:
+      snapshot = os.path.join(directory, 'snapshot.npz')
+      shared = run_from(configs[0], engine=engine, aggregate_months=aggregate_months,
+        epsilon=epsilon, nperiods=nshared, snapshot_file=snapshot)
+      if not os.path.isfile(snapshot): # the shared periods have no months
+        snapshot = None
+
+    # Run each branch from the snapshot
+    branches = [None] * len(configs)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      futures = {
+        pool.submit(run_from, config, snapshot, engine, aggregate_months, epsilon): i
+        for i, config in enumerate(configs)
+      }
+      for future in as_completed(futures):
+        i = futures[future]
+        branches[i] = shared + future.result()
+        on_branch(i, branches[i])
+  return branches
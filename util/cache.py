@@ -0,0 +1,98 @@
+'''
+A cache of simulation results on local disk, so that rerunning the same config
+replays the stored results instead of simulating again. Entries are addressed
+by a hash of the config (including its seed), the options that affect the
+results and the version of the cache, and the least recently used entries are
+evicted to stay under a size cap.
+
+Only seeded configs are cached: without a seed, each run is meant to be a new
+random sample.
+'''
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+
+# The version of the cached results. Bump it whenever a change to the engines
+# or to the results changes what a seeded run gives, so that entries from older
+# code are never replayed.
+version = 2
+
+# The default cache directory and size cap
+default_directory = os.path.join(os.path.expanduser('~'), '.cache', 'economy-simulator')
+default_max_bytes = 256 * 2**20
+
+# Returns whether runs of a config can be cached, i.e. whether it's seeded
+def cacheable(config):
+  return config.get('seed') is not None
+
+# Returns the cache key of a config and the options of the run (e.g. engine,
+# sampling cadence): the sha256 of their canonical JSON, with the version above,
+# sorted keys and no whitespace
+def key(config, **options):
+  canonical = json.dumps({'version': version, 'config': config, 'options': options}, sort_keys=True, separators=(',', ':'))
+  return hashlib.sha256(canonical.encode()).hexdigest()
+
+# A directory of cached results, at most max_bytes in total. Each entry is a
+# gzipped JSON list of records (e.g. results snapshots), in a file named by its
+# key. Reading an entry marks it as recently used.
+class ResultCache:
+  def __init__(self, directory=default_directory, max_bytes=default_max_bytes):
+    self.directory = directory
+    self.max_bytes = max_bytes
+
+  def path(self, key):
+    return os.path.join(self.directory, key + '.json.gz')
+
+  # Returns the records cached under key, or None if there are none
+  def get(self, key):
+    path = self.path(key)
+    try:
+      with gzip.open(path, 'rt') as f:
+        records = json.load(f)
+    except (OSError, ValueError): # missing, or partly written/corrupt
+      return None
+    try:
+      os.utime(path)
+    except OSError:
+      pass
+    return records
+
+  # Caches a list of records under key, then evicts the least recently used
+  # entries until the cache fits in max_bytes. The entry is written to a
+  # temporary file and renamed, so readers never see it partly written.
+  def put(self, key, records):
+    os.makedirs(self.directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+    os.close(fd)
+    try:
+      with gzip.open(tmp, 'wt') as f:
+        json.dump(records, f, default=float)
+      os.replace(tmp, self.path(key))
+    except BaseException:
+      os.remove(tmp)
+      raise
+    self.evict()
+
+  # Evicts the least recently used entries until the cache fits in max_bytes
+  def evict(self):
+    entries = []
+    for name in os.listdir(self.directory):
+      if name.endswith('.json.gz'):
+        try:
+          st = os.stat(os.path.join(self.directory, name))
+        except OSError: # evicted by another process
+          continue
+        entries.append((st.st_mtime, st.st_size, name))
+    entries.sort()
+    total = sum([size for _, size, _ in entries])
+    for _, size, name in entries:
+      if total <= self.max_bytes:
+        break
+      try:
+        os.remove(os.path.join(self.directory, name))
+      except OSError:
+        pass
+      total -= size
@@ -0,0 +1,96 @@
+'''
+Runs an ensemble of independent replicates of one simulation across a pool of
+processes, and combines their results into mean/percentile bands. The simulator
+is stochastic, so a single run only gives one noisy sample of the outcome.
+'''
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from simulator import simulator
+from util import util
+import numpy as np
+
+# The percentiles of the replicates reported by combine()
+percentiles = [5, 50, 95]
+
+# Runs one replicate of the simulation with the given seed. Returns the list of
+# results from the first day of each month (with approximate percentiles if
+# epsilon is given, see util.results).
+def run_replicate(config, seed, engine='legacy', aggregate_months=False, epsilon=None):
+  results = []
+  def on_day(period, day, people, companies):
+    if day % simulator.days_per_month == 0:
+      results.append(util.results(people, companies, epsilon))
+  util.engines[engine].run(config, on_day=on_day, aggregate_months=aggregate_months, seed=seed)
+  return results
+
+# Returns a seed for each of n replicates, derived from the given seed (or
+# from fresh entropy if it's None) so that the replicates are independent but
+# the whole ensemble is reproducible
+def replicate_seeds(n, seed=None):
+  return [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(n)]
+
+# Runs n replicates of the simulation in parallel on a pool of the given number
+# of worker processes (default: one per CPU), seeded from seed (default: the
+# config's 'seed'). Calls on_replicate(i, results)
+# with each replicate's list of monthly results as soon as it finishes. Returns
+# the list of every replicate's results, in order.
+def run(config, n, workers=None, seed=None, engine='legacy', aggregate_months=False,
+  epsilon=None, on_replicate=lambda i, results: None):
+  replicates = [None] * n
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    futures = {
+      pool.submit(run_replicate, config, s, engine, aggregate_months, epsilon): i
+      for i, s in enumerate(replicate_seeds(n, config.get('seed') if seed is None else seed))
+    }
+    for future in as_completed(futures):
+      i = futures[future]
+      replicates[i] = future.result()
+      on_replicate(i, replicates[i])
+  return replicates
+
+# Combines the results of several replicates. Returns a dict
+# {statistic: list of monthly results}, where the statistics are 'mean' and
+# each of the percentiles above (as strings), and each monthly result has the
+# same structure as util.results, holding that statistic across replicates.
+# Groups that are missing from some replicates (e.g. an income level nobody
+# was assigned) are combined over the replicates that have them.
+def combine(replicates):
+  # Stack each result across replicates and months
+  def stack(get):
+    values = []
+    for r in replicates:
+      try:
+        values.append([get(month) for month in r[:nmonths]])
+      except KeyError:
+        pass
+    return np.array(values, dtype=float) # (replicates, months, values)
+
+  def statistics(get):
+    values = stack(get)
+    return [np.mean(values, axis=0)] + list(np.percentile(values, percentiles, axis=0))
+
+  # Combine every result of every group that any replicate has, in the order
+  # they first appear
+  stats = ['mean'] + [str(p) for p in percentiles]
+  nmonths = min([len(r) for r in replicates])
+  combined = {s: [{'overall': {}, 'income_levels': {}, 'industries': {}} for m in range(nmonths)] for s in stats}
+  names = {'overall': {}, 'income_levels': {}, 'industries': {}}
+  for r in replicates:
+    for month in r[:nmonths]:
+      names['overall'].update(dict.fromkeys(month['overall']))
+      for level in ['income_levels', 'industries']:
+        for group in month[level]:
+          names[level].setdefault(group, {}).update(dict.fromkeys(month[level][group]))
+  for name in names['overall']:
+    get = lambda month, name=name: month['overall'][name]
+    for s, values in zip(stats, statistics(get)):
+      for m in range(nmonths):
+        combined[s][m]['overall'][name] = list(np.round(values[m], 4))
+  for level in ['income_levels', 'industries']:
+    for group in names[level]:
+      for name in names[level][group]:
+        get = lambda month, level=level, group=group, name=name: month[level][group][name]
+        for s, values in zip(stats, statistics(get)):
+          for m in range(nmonths):
+            combined[s][m][level].setdefault(group, {})[name] = list(np.round(values[m], 4))
+  return combined
@@ -0,0 +1,119 @@
+'''
+A streaming quantile sketch (KLL), for approximate percentiles of money without
+keeping or sorting every value. Sketches are small (a few hundred values,
+however many were added), and sketches of different sets of values, e.g. from
+parallel shards or replicates, can be merged into a sketch of all of them.
+'''
+
+import numpy as np
+
+# The ratio between the capacities of consecutive levels
+capacity_ratio = 2 / 3
+
+# Approximate quantiles of a stream of values. The sketch keeps levels of
+# sorted values, where each value at level h stands for 2^h of the values
+# added. When a level fills up, half of its values (every other one, starting
+# at random) are promoted to the next level.
+# - epsilon: the rank error of each quantile, with high probability (99%). E.g.
+#   with epsilon=0.01, the 50th percentile is somewhere between the 49th and
+#   51st.
+# - seed: seed for the random promotions, so that the same values give the same
+#   sketch
+class QuantileSketch:
+  def __init__(self, epsilon=0.01, seed=0):
+    self.epsilon = epsilon
+    self.k = max(8, int(np.ceil((2.296 / epsilon) ** (1 / 0.9723))))
+    self.levels = [np.empty(0)]
+    self.n = 0
+    self.min = np.inf
+    self.max = -np.inf
+    self.rng = np.random.default_rng(seed)
+
+  def __len__(self):
+    return self.n
+
+  # The number of values level h can hold before it's compacted. Lower levels
+  # hold fewer values.
+  def capacity(self, h):
+    return max(2, int(np.ceil(self.k * capacity_ratio ** (len(self.levels) - 1 - h))))
+
+  # Compacts each level that's over capacity, from the bottom up
+  def compress(self):
+    h = 0
+    while h < len(self.levels):
+      level = self.levels[h]
+      if len(level) > self.capacity(h):
+        if h + 1 == len(self.levels):
+          self.levels.append(np.empty(0))
+        # Keep the odd value out at this level, and promote every other value
+        # of the rest
+        odd = len(level) % 2
+        promoted = level[odd + self.rng.integers(2)::2]
+        self.levels[h] = level[:odd]
+        if len(self.levels[h+1]) == 0:
+          self.levels[h+1] = promoted.copy() # already sorted
+        else:
+          self.levels[h+1] = np.sort(np.concatenate((self.levels[h+1], promoted)))
+      h += 1
+
+  # Adds an array of values to the sketch
+  def update(self, values):
+    values = np.asarray(values, dtype=float).reshape(-1)
+    if len(values) == 0:
+      return self
+    self.n += len(values)
+    self.min = min(self.min, np.min(values))
+    self.max = max(self.max, np.max(values))
+    self.levels[0] = np.sort(np.concatenate((self.levels[0], values)))
+    self.compress()
+    return self
+
+  # Merges another sketch into this one, so that it sketches the values added
+  # to both
+  def merge(self, other):
+    if other.n == 0:
+      return self
+    self.n += other.n
+    self.min = min(self.min, other.min)
+    self.max = max(self.max, other.max)
+    while len(self.levels) < len(other.levels):
+      self.levels.append(np.empty(0))
+    for h, level in enumerate(other.levels):
+      self.levels[h] = np.sort(np.concatenate((self.levels[h], level)))
+    self.compress()
+    return self
+
+  # Returns the approximate values at the given percentiles (0-100), like
+  # np.percentile. The 0th and 100th percentiles are exact. Returns NaNs if
+  # the sketch is empty.
+  def percentiles(self, percentiles):
+    percentiles = np.asarray(percentiles, dtype=float)
+    if self.n == 0:
+      return np.full(len(percentiles), np.nan)
+    values = np.concatenate(self.levels)
+    weights = np.concatenate([np.full(len(level), 2**h) for h, level in enumerate(self.levels)])
+    order = np.argsort(values, kind='stable')
+    values = values[order]
+    ranks = np.cumsum(weights[order])
+    i = np.searchsorted(ranks, percentiles / 100 * (ranks[-1] - 1), side='right')
+    result = np.clip(values[np.minimum(i, len(values) - 1)], self.min, self.max)
+    result[percentiles <= 0] = self.min
+    result[percentiles >= 100] = self.max
+    return result
+
+# Sketches values within each group: returns a list of ngroups sketches, where
+# the ith sketches the values in group i (0 to ngroups-1, or -1 to leave a
+# value out). The values don't need to be sorted: they're only reordered by
+# group, with a stable sort of the small integer group ids (a radix sort, in
+# linear time), and each sketch sorts its own values.
+def grouped_sketches(values, group, ngroups, epsilon=0.01, seed=0):
+  if ngroups == 1 and np.all(group == 0):
+    return [QuantileSketch(epsilon, seed).update(values)]
+  g = np.where(group < 0, ngroups, group).astype(np.int16 if ngroups < 2**15 - 1 else int)
+  counts = np.bincount(g, minlength=ngroups + 1)[:ngroups]
+  starts = np.cumsum(counts) - counts
+  values = values[np.argsort(g, kind='stable')]
+  return [
+    QuantileSketch(epsilon, seed).update(values[starts[i]:starts[i] + counts[i]])
+    for i in range(ngroups)
+  ]
@@ -0,0 +1,190 @@
+'''
+Runs a parameter sweep: many simulations of a base config, each with some
+parameters set to different values, across a pool of processes. The results of
+every run are consolidated into one table.
+
+A sweep is specified as a JSON object like:
+
+{
+  "axes": {
+    "periods[1].unemployment_benefit": [0, 0.5, 1],
+    "ncompanies": [100, 1000]
+  },
+  "design": "grid",
+  "replicates": 1
+}
+
+- axes: the parameters to vary, as paths into the config, and their values
+- design: "grid" runs every combination of the axes' values. "lhs" runs a Latin
+  hypercube sample of "samples" points instead, treating each axis as a range
+  [min, max] of its values (rounded to integers if they're all integers).
+- replicates: how many independently seeded runs to do at each point
+- seed: optional seed for the sample and the runs (default: the config's seed)
+'''
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from util import ensemble, util
+import copy
+import csv
+import hashlib
+import itertools
+import json
+import numpy as np
+import os
+import re
+
+# Splits a path into the config like "periods[1].unemployment_benefit" into
+# its keys, e.g. ['periods', 1, 'unemployment_benefit']
+def parse_path(path):
+  keys = []
+  for name, index in re.findall(r'([^.\[\]]+)|\[(\d+)\]', path):
+    keys.append(int(index) if index != '' else name)
+  return keys
+
+# Returns a copy of the config with the parameters at the given paths set to
+# the given values ({path: value})
+def apply(config, values):
+  config = copy.deepcopy(config)
+  for path, value in values.items():
+    keys = parse_path(path)
+    d = config
+    for k in keys[:-1]:
+      d = d[k]
+    d[keys[-1]] = value
+  return config
+
+# Returns every combination of the axes' values, as a list of {path: value}
+def grid(axes):
+  paths = list(axes.keys())
+  return [dict(zip(paths, values)) for values in itertools.product(*[axes[p] for p in paths])]
+
+# Returns a Latin hypercube sample of n points from the axes, each taken as a
+# range [min, max] of its values, as a list of {path: value}. Each axis's range
+# is split into n equal strata, and each stratum is sampled exactly once.
+def latin_hypercube(axes, n, rng):
+  points = [{} for i in range(n)]
+  for path, values in axes.items():
+    lo = min(values)
+    hi = max(values)
+    u = (rng.permutation(n) + rng.random(n)) / n
+    samples = lo + u * (hi - lo)
+    integer = all([isinstance(v, int) for v in values])
+    for point, sample in zip(points, samples):
+      point[path] = int(round(sample)) if integer else float(sample)
+  return points
+
+# Returns the list of points to run for a sweep spec, as {path: value}
+def points(spec):
+  design = spec.get('design', 'grid')
+  if design == 'grid':
+    return grid(spec['axes'])
+  elif design == 'lhs':
+    return latin_hypercube(spec['axes'], spec['samples'], np.random.default_rng(spec.get('seed')))
+  raise ValueError('unknown sweep design "%s"' % design)
+
+# Returns the hash that identifies a sweep: the sha256 of the canonical JSON of
+# the base config, the spec and the options of the runs (e.g. engine). The
+# progress file starts with it, so that a sweep only resumes from the runs of
+# the same sweep.
+def sweep_hash(config, spec, **options):
+  canonical = json.dumps({'config': config, 'spec': spec, 'options': options}, sort_keys=True, separators=(',', ':'))
+  return hashlib.sha256(canonical.encode()).hexdigest()
+
+# Reads a sweep's progress file. Returns the hash of the sweep from its first
+# line (None if it has none) and the records of finished runs from the rest.
+# Skips a partly written last line, e.g. if the sweep was killed while writing
+# it.
+def read_progress(progress_file):
+  h = None
+  records = []
+  if os.path.isfile(progress_file):
+    with open(progress_file) as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          continue
+        if 'sweep' in record:
+          h = record['sweep']
+        else:
+          records.append(record)
+  return h, records
+
+# Runs the sweep given by spec over the base config, writing the results to
+# output_dir:
+# - sweep-progress.jsonl: a checkpoint with the hash of the sweep, then one
+#   line per finished run. If the sweep is interrupted, running it again skips
+#   the runs recorded here. Raises a ValueError if the file is from a different
+#   sweep (a changed base config, spec, engine or options), rather than mixing
+#   its results in.
+# - sweep.csv: the consolidated table, with one row per run per month. The
+#   columns are the run and replicate indices, the month, the value of each
+#   axis, and each result (see util.flatten).
+# Runs on a pool of the given number of worker processes (default: one per
+# CPU), and calls on_run(ndone, ntotal) each time a run finishes. Returns the
+# path to the table.
+def run(config, spec, output_dir, workers=None, engine='legacy', aggregate_months=False,
+  epsilon=None, on_run=lambda ndone, ntotal: None):
+  if not os.path.isdir(output_dir):
+    os.mkdir(output_dir)
+  progress_file = os.path.join(output_dir, 'sweep-progress.jsonl')
+  table_file = os.path.join(output_dir, 'sweep.csv')
+
+  # List every run, and skip the ones that already finished
+  nreplicates = spec.get('replicates', 1)
+  runs = [(i, r, p) for i, p in enumerate(points(spec)) for r in range(nreplicates)]
+  seeds = ensemble.replicate_seeds(len(runs), spec.get('seed', config.get('seed')))
+  h = sweep_hash(config, spec, engine=engine, aggregate_months=aggregate_months, epsilon=epsilon)
+  progress_hash, records = read_progress(progress_file)
+  if len(records) > 0 and progress_hash != h:
+    raise ValueError('%s is from a different sweep; use another output directory, or delete it to start over' % progress_file)
+  done = set([(record['run'], record['replicate']) for record in records])
+  on_run(len(done), len(runs))
+
+  # Run the rest, recording each as it finishes
+  with ProcessPoolExecutor(max_workers=workers) as pool, open(progress_file, 'a+') as progress:
+    # Start with the hash of the sweep, or on a new line if the last run was
+    # only partly written
+    if progress_hash != h:
+      progress.truncate(0)
+      progress.write(json.dumps({'sweep': h}) + '\n')
+    elif progress.tell() != 0:
+      progress.seek(progress.tell() - 1)
+      if progress.read(1) != '\n':
+        progress.write('\n')
+    futures = {
+      pool.submit(ensemble.run_replicate, apply(config, point), seed, engine, aggregate_months, epsilon): (i, r, point)
+      for (i, r, point), seed in zip(runs, seeds) if (i, r) not in done
+    }
+    for future in as_completed(futures):
+      i, r, point = futures[future]
+      record = {
+        'run': i,
+        'replicate': r,
+        'point': point,
+        'results': [util.flatten(month) for month in future.result()]
+      }
+      progress.write(json.dumps(record) + '\n')
+      progress.flush()
+      done.add((i, r))
+      on_run(len(done), len(runs))
+
+  # Consolidate the records into one table
+  records = sorted(read_progress(progress_file)[1], key=lambda record: (record['run'], record['replicate']))
+  axes = list(spec['axes'].keys())
+  result_columns = {} # used as an ordered set
+  for record in records:
+    for month in record['results']:
+      result_columns.update(dict.fromkeys(month))
+  result_columns = list(result_columns)
+  with open(table_file, 'w', newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(['run', 'replicate', 'month'] + axes + result_columns)
+    for record in records:
+      for m, month in enumerate(record['results']):
+        writer.writerow(
+          [record['run'], record['replicate'], m]
+          + [record['point'][a] for a in axes]
+          + [month.get(c, '') for c in result_columns]
+        )
+  return table_file
@@ -0,0 +1,565 @@
+'''
+Tests for the helpers in util/. Run from the repo root with:
+python -m util.test
+'''
+
+from simulator import simulator, vectorized
+from util import branch, cache, ensemble, sketch, sweep, timeseries, transactions, util, wire
+import copy
+import json
+import numpy as np
+import os
+import tempfile
+
+# A small config for runs in the tests: 10 companies of 5 people, for the given
+# number of months
+def small_config(nmonths=2, seed=1):
+  return dict(simulator.defaults, ncompanies=10, company_size=[[5], [1]],
+    periods=[dict(simulator.defaults['periods'][0], duration=nmonths)], seed=seed)
+
+# Builds one month of results with a single value per result, and the given
+# income levels
+def make_month(value, income_levels):
+  return {
+    'overall': {'circulation': [value]},
+    'income_levels': {level: {'person_unemployment': [value]} for level in income_levels},
+    'industries': {}
+  }
+
+# Returns the largest rank error of the approximate percentiles of values (as
+# a fraction of the number of values): how far the rank of each estimate is
+# from the percentile's rank
+def rank_error(values, percentiles, estimates):
+  values = np.sort(values)
+  lo = np.searchsorted(values, estimates, side='left')
+  hi = np.searchsorted(values, estimates, side='right')
+  target = np.asarray(percentiles) / 100 * len(values)
+  return np.max(np.maximum(0, np.maximum(lo - target, target - hi))) / len(values)
+
+def test_ensemble_replicate_seeds():
+  print('Check that replicate seeds are reproducible from the ensemble seed, and distinct')
+  seeds = ensemble.replicate_seeds(5, seed=1)
+  if seeds != ensemble.replicate_seeds(5, seed=1) or len(set(seeds)) != 5 or seeds == ensemble.replicate_seeds(5, seed=2):
+    print('Failed: replicate seeds are wrong')
+    print('Expected: 5 distinct seeds, the same for the same ensemble seed only')
+    print('Actual:   %s, %s' % (seeds, ensemble.replicate_seeds(5, seed=2)))
+    return
+  print('Passed')
+
+def test_ensemble_combine():
+  print('Check that combining replicates gives the mean and percentiles of each result, over the replicates that have each group')
+  replicates = [
+    [make_month(1, ['12']), make_month(2, ['12'])],
+    [make_month(3, ['12', '24']), make_month(4, ['12', '24'])],
+    [make_month(5, ['12', '24']), make_month(6, ['12', '24']), make_month(7, ['12', '24'])]
+  ]
+  combined = ensemble.combine(replicates)
+
+  expected = {'mean': [[3], [4]], '50': [[3], [4]], '5': [[1.2], [2.2]]}
+  actual = {s: [month['overall']['circulation'] for month in combined[s]] for s in expected}
+  if actual != expected:
+    print('Failed: overall results were combined wrong')
+    print('Expected: %s' % str(expected))
+    print('Actual:   %s' % str(actual))
+    return
+  expected = [[4], [5]]
+  actual = [month['income_levels'].get('24', {}).get('person_unemployment') for month in combined['mean']]
+  if actual != expected:
+    print('Failed: a group missing from the first replicate was combined wrong')
+    print('Expected: %s' % str(expected))
+    print('Actual:   %s' % str(actual))
+    return
+  print('Passed')
+
+def test_sweep_apply():
+  print('Check that sweep parameters are set at their paths into a copy of the config')
+  config = small_config()
+  keys = sweep.parse_path('periods[0].unemployment_benefit')
+  if keys != ['periods', 0, 'unemployment_benefit']:
+    print('Failed: path was parsed wrong')
+    print("Expected: ['periods', 0, 'unemployment_benefit']")
+    print('Actual:   %s' % keys)
+    return
+  swept = sweep.apply(config, {'periods[0].unemployment_benefit': 0.5, 'ncompanies': 3})
+  if swept['periods'][0]['unemployment_benefit'] != 0.5 or swept['ncompanies'] != 3 \
+    or config['periods'][0]['unemployment_benefit'] != 0 or config['ncompanies'] != 10:
+    print('Failed: parameters were set wrong, or the base config was changed')
+    print('Actual:   swept %s, base %s' % (swept, config))
+    return
+  print('Passed')
+
+def test_sweep_grid():
+  print('Check that a grid sweep runs every combination of the axes')
+  points = sweep.grid({'a': [1, 2], 'b': [3, 4, 5]})
+  expected = [{'a': a, 'b': b} for a in [1, 2] for b in [3, 4, 5]]
+  if points != expected:
+    print('Failed: grid is wrong')
+    print('Expected: %s' % expected)
+    print('Actual:   %s' % points)
+    return
+  print('Passed')
+
+def test_sweep_latin_hypercube():
+  print('Check that a Latin hypercube samples each stratum of each axis exactly once')
+  n = 20
+  points = sweep.latin_hypercube({'a': [0, 0.5, 1], 'b': [100, 300]}, n, np.random.default_rng(0))
+  a = np.array([p['a'] for p in points])
+  b = [p['b'] for p in points]
+  strata = [int(s) for s in np.floor(a * n)]
+  if sorted(strata) != list(range(n)) or not all([isinstance(v, int) and 100 <= v <= 300 for v in b]):
+    print('Failed: sample is not a Latin hypercube of the axes')
+    print('Expected: one value of a in each of %d strata of [0, 1], integer b in [100, 300]' % n)
+    print('Actual:   a strata %s, b %s' % (sorted(strata), b))
+    return
+  print('Passed')
+
+def test_sweep_resume():
+  print('Check that a resumed sweep only runs the runs that are left, and refuses a progress file from a different sweep')
+  config = small_config()
+  spec = {'axes': {'periods[0].unemployment_benefit': [0, 1]}, 'replicates': 2}
+  output_dir = tempfile.mkdtemp()
+  progress_file = os.path.join(output_dir, 'sweep-progress.jsonl')
+  table_file = sweep.run(config, spec, output_dir, workers=1)
+  with open(table_file) as f:
+    expected = f.read()
+
+  # Cut the progress file off partway through the third run, and resume
+  with open(progress_file) as f:
+    lines = f.readlines()
+  with open(progress_file, 'w') as f:
+    f.write(''.join(lines[:3]) + lines[3][:10])
+  progress = []
+  sweep.run(config, spec, output_dir, workers=1, on_run=lambda ndone, ntotal: progress.append(ndone))
+  with open(table_file) as f:
+    actual = f.read()
+  if progress != [2, 3, 4] or actual != expected:
+    print('Failed: resumed sweep is wrong')
+    print('Expected: runs done [2, 3, 4], the same table')
+    print('Actual:   runs done %s, same table %s' % (progress, actual == expected))
+    return
+
+  for changed_config, changed_spec, engine in [
+    (small_config(seed=2), spec, 'legacy'),
+    (config, dict(spec, replicates=3), 'legacy'),
+    (config, spec, 'vectorized')
+  ]:
+    try:
+      sweep.run(changed_config, changed_spec, output_dir, workers=1, engine=engine)
+    except ValueError:
+      continue
+    print('Failed: resumed from the progress file of a different sweep')
+    print('Expected: ValueError')
+    print('Actual:   config %s, spec %s, engine %s resumed' % (changed_config, changed_spec, engine))
+    return
+  print('Passed')
+
+def test_grouped_percentiles():
+  print('Check that grouped percentiles match np.percentile over each group, with empty and left out groups')
+  rng = np.random.default_rng(0)
+  ngroups = 5
+  values = np.sort(np.concatenate([rng.normal(size=1000), np.full(10, 0.5)])) # with ties
+  group = rng.integers(-1, ngroups, size=len(values))
+  group[group == 2] = 3 # group 2 is empty
+  group[group == 4] = -1
+  group[:3] = 4 # group 4 only has the 3 lowest values
+  actual = util.grouped_percentiles(values, group, ngroups, util.percentiles)
+  expected = np.array([
+    np.percentile(values[group == i], util.percentiles) if np.any(group == i) else np.full(len(util.percentiles), np.nan)
+    for i in range(ngroups)
+  ])
+  if not np.allclose(actual, expected, rtol=0, atol=1e-12, equal_nan=True):
+    print('Failed: grouped percentiles differ from np.percentile')
+    print('Expected: %s' % str(expected))
+    print('Actual:   %s' % str(actual))
+    return
+  print('Passed')
+
+def test_sketch_rank_error():
+  print('Check that sketch percentiles are within the rank error, adding values in batches or merging sketches of shards')
+  epsilon = 0.01
+  percentiles = np.arange(101)
+  values = np.random.default_rng(0).lognormal(size=200000)
+  batches = np.split(values, [1, 100, 5000, 50000, 120000])
+  added = sketch.QuantileSketch(epsilon)
+  for batch in batches:
+    added.update(batch)
+  merged = sketch.QuantileSketch(epsilon)
+  for i, batch in enumerate(batches):
+    merged.merge(sketch.QuantileSketch(epsilon, seed=i).update(batch))
+  for name, s in [('batches', added), ('merged shards', merged)]:
+    estimates = s.percentiles(percentiles)
+    error = rank_error(values, percentiles, estimates)
+    if len(s) != len(values) or error > epsilon or estimates[0] != np.min(values) or estimates[-1] != np.max(values):
+      print('Failed: sketch of %s is off' % name)
+      print('Expected: n=%d, rank error <= %g, exact min and max' % (len(values), epsilon))
+      print('Actual:   n=%d, rank error %g, min %g (%g), max %g (%g)' % (
+        len(s), error, estimates[0], np.min(values), estimates[-1], np.max(values)))
+      return
+  print('Passed')
+
+def test_grouped_sketches():
+  print('Check that grouped sketches sketch the values of each group, unsorted, with empty and left out groups')
+  rng = np.random.default_rng(1)
+  values = rng.normal(size=50000)
+  group = rng.integers(-1, 4, size=len(values))
+  group[group == 2] = -1
+  sketches = sketch.grouped_sketches(values, group, 4, epsilon=0.01)
+  for i, s in enumerate(sketches):
+    expected = values[group == i]
+    if len(s) != len(expected) or (len(expected) > 0 and rank_error(expected, [10, 50, 90], s.percentiles([10, 50, 90])) > 0.01):
+      print('Failed: sketch of group %d is off' % i)
+      print('Expected: n=%d, rank error <= 0.01' % len(expected))
+      print('Actual:   n=%d' % len(s))
+      return
+  print('Passed')
+
+def test_summary_results():
+  print('Check that merged summaries of runs give the counts of the runs combined, and percentiles within the rank error')
+  # The second run has an income level the first doesn't
+  runs = []
+  for income in [[[12, 24], [1, 0]], [[12, 24], [0.5, 0.5]]]:
+    people, companies = vectorized.init(ncompanies=100, income=income, company_size=[[10], [1]], industry_names=['a', 'b'], rng=np.random.default_rng(2))
+    people.money[:] = np.random.default_rng(len(runs)).lognormal(size=len(people))
+    people.employed[::3] = False
+    companies.in_business[::4] = False
+    runs.append((people, companies))
+  merged = util.summary_results(util.merge_summaries([util.summary(p, c, 0.01) for p, c in runs]))
+  # Results that are counts are exact
+  exact = util.flatten(util.results(*runs[0]))
+  approximate = util.flatten(util.summary_results(util.summary(*runs[0], 0.01)))
+  counts = [c for c in exact if not c.endswith('money') and '_money/' not in c]
+  if set(approximate) != set(exact) or [approximate[c] for c in counts] != [exact[c] for c in counts]:
+    print('Failed: summary results of a run differ from its results')
+    print('Expected: %s' % str([exact[c] for c in counts]))
+    print('Actual:   %s' % str([approximate.get(c) for c in counts]))
+    return
+
+  money = np.concatenate([p.money for p, c in runs])
+  unemployed = np.mean(np.concatenate([~p.employed for p, c in runs]))
+  closed = np.mean(np.concatenate([~c.in_business for p, c in runs]))
+  circulation = round(sum([np.sum(p.money) + np.sum(c.money) for p, c in runs]), 2)
+  level_people = np.sum(runs[1][0].income == 2)
+  expected = [unemployed, closed, circulation, level_people]
+  actual = [
+    merged['overall']['person_unemployment'][0],
+    merged['overall']['company_closures'][0],
+    merged['overall']['circulation'][0],
+    util.merge_summaries([util.summary(p, c, 0.01) for p, c in runs])['income_levels']['24']['people']
+  ]
+  error = rank_error(money, util.percentiles, merged['overall']['person_money'])
+  if not np.allclose(actual, expected) or error > 0.01:
+    print('Failed: merged summary results are wrong')
+    print('Expected: %s, rank error <= 0.01' % str(expected))
+    print('Actual:   %s, rank error %g' % (str(actual), error))
+    return
+  print('Passed')
+
+def test_wire_round_trip():
+  print('Check that results encoded in the binary format decode to the same values, with and without delta and compression, when the groups change')
+  snapshots = []
+  def on_day(period, day, people, companies):
+    if day % 10 == 0:
+      snapshots.append(util.results(people, companies))
+  vectorized.run(small_config(nmonths=2), on_day=on_day)
+  changed = copy.deepcopy(snapshots[-1])
+  changed['industries']['new industry'] = changed['industries']['industry 1']
+  snapshots += [changed, changed]
+  schema_at = [0, len(snapshots) - 2]
+
+  for delta in [False, True]:
+    for compress in [False, True]:
+      encoder = wire.Encoder(delta=delta, compress=compress)
+      columns = None
+      previous = None
+      for i, results in enumerate(snapshots):
+        progress = [0, i, i, len(snapshots)]
+        messages = encoder.encode(results, progress)
+        if len(messages) == 2:
+          columns = json.loads(messages[0])['schema']['columns']
+          previous = None
+        elif len(messages) != 1 or i in schema_at:
+          print('Failed: schema was sent on the wrong snapshots (delta=%s, compress=%s)' % (delta, compress))
+          print('Expected: schema with snapshots %s' % schema_at)
+          print('Actual:   %d messages for snapshot %d' % (len(messages), i))
+          return
+        flags = int(np.frombuffer(messages[-1][:4], dtype='<u4')[0])
+        if bool(flags & wire.flag_delta) != (delta and len(messages) == 1) or bool(flags & wire.flag_compressed) != compress:
+          print('Failed: snapshot %d has the wrong flags (delta=%s, compress=%s)' % (i, delta, compress))
+          print('Expected: delta only after the first snapshot of a schema')
+          print('Actual:   flags %d' % flags)
+          return
+        decoded_progress, decoded = wire.decode(messages[-1], columns, previous)
+        expected = wire.values(results, wire.schema(results))
+        if columns != wire.schema(results) or decoded_progress != progress or decoded.tobytes() != expected.tobytes():
+          print('Failed: snapshot %d decoded wrong (delta=%s, compress=%s)' % (i, delta, compress))
+          print('Expected: %s, %s' % (progress, list(expected)))
+          print('Actual:   %s, %s' % (decoded_progress, list(decoded)))
+          return
+        previous = decoded
+  print('Passed')
+
+def test_cache_key():
+  print('Check that only seeded configs are cached, under keys of the config, the options and the cache version')
+  config = small_config()
+  reordered = dict(reversed(list(config.items())))
+  key = cache.key(config, engine='legacy', sampling=1)
+  keys = [
+    cache.key(dict(config, seed=2), engine='legacy', sampling=1),
+    cache.key(config, engine='vectorized', sampling=1),
+    cache.key(config, engine='legacy', sampling=2)
+  ]
+  version = cache.version
+  try:
+    cache.version += 1
+    keys.append(cache.key(config, engine='legacy', sampling=1))
+  finally:
+    cache.version = version
+  if not cache.cacheable(config) or cache.cacheable(dict(config, seed=None)) \
+    or cache.key(reordered, sampling=1, engine='legacy') != key or key in keys or len(set(keys)) != len(keys):
+    print('Failed: cache keys are wrong')
+    print('Expected: the same key for the same config and options, different keys otherwise')
+    print('Actual:   %s, %s' % (key, keys))
+    return
+  print('Passed')
+
+def test_cache_put():
+  print('Check that cache entries are written whole, and the least recently used are evicted')
+  directory = tempfile.mkdtemp()
+  result_cache = cache.ResultCache(directory)
+  records = [[[0, i, i, 30], {'value': i}] for i in range(100)]
+
+  # A failed write leaves the old entry and no temporary file behind
+  result_cache.put('a', records)
+  try:
+    result_cache.put('a', records + [object()])
+  except TypeError:
+    pass
+  with open(result_cache.path('b'), 'w') as f:
+    f.write('partly written')
+  if result_cache.get('a') != records or result_cache.get('b') is not None or result_cache.get('c') is not None \
+    or sorted(os.listdir(directory)) != ['a.json.gz', 'b.json.gz']:
+    print('Failed: cache entries were not written whole')
+    print("Expected: entry a intact, b and c missing, files ['a.json.gz', 'b.json.gz']")
+    print('Actual:   files %s' % sorted(os.listdir(directory)))
+    return
+
+  # With room for 2 entries, reading a keeps it over the older b
+  os.remove(result_cache.path('b'))
+  size = os.path.getsize(result_cache.path('a'))
+  result_cache.max_bytes = 2.5 * size
+  result_cache.put('b', records)
+  os.utime(result_cache.path('a'), (1, 1))
+  os.utime(result_cache.path('b'), (2, 2))
+  result_cache.get('a')
+  result_cache.put('c', records)
+  if sorted(os.listdir(directory)) != ['a.json.gz', 'c.json.gz']:
+    print('Failed: the wrong entries were evicted')
+    print("Expected: ['a.json.gz', 'c.json.gz']")
+    print('Actual:   %s' % sorted(os.listdir(directory)))
+    return
+  print('Passed')
+
+def test_timeseries_round_trip():
+  print('Check that a time series table reads back as written, also while it is written, and continues from its first rows')
+  snapshots = []
+  def on_day(period, day, people, companies):
+    if day % 10 == 0:
+      snapshots.append(util.results(people, companies))
+  vectorized.run(small_config(nmonths=2), on_day=on_day)
+  missing = copy.deepcopy(snapshots[-1])
+  del missing['industries']['industry 1']
+  snapshots.append(missing)
+  path = os.path.join(tempfile.mkdtemp(), 'results')
+
+  columns = wire.schema(snapshots[0])
+  names = list(util.flatten(snapshots[0]).keys())
+  expected = np.array([[util.flatten(r).get(name, np.nan) for name in names] for r in snapshots])
+  with timeseries.Writer(path) as writer:
+    writer.write(snapshots[0])
+    writer.write(snapshots[1])
+    _, _, partial = timeseries.read(path)
+    partial = np.array(partial)
+    for r in snapshots[2:]:
+      writer.write(r)
+  read_columns, read_names, table = timeseries.read(path)
+  if read_columns != columns or read_names != names or not np.array_equal(partial, expected[:2]) \
+    or not np.array_equal(table, expected, equal_nan=True) or not np.any(np.isnan(table[-1])):
+    print('Failed: table reads back wrong')
+    print('Expected: %s' % str(expected))
+    print('Actual:   %s' % str(np.array(table)))
+    return
+
+  # Continue from the first 2 rows, dropping the rest
+  del table
+  with timeseries.Writer(path, nrows=2) as writer:
+    writer.write(snapshots[-1])
+  read_columns, _, table = timeseries.read(path)
+  if read_columns != columns or not np.array_equal(table, expected[[0, 1, -1]], equal_nan=True):
+    print('Failed: continued table is wrong')
+    print('Expected: %s' % str(expected[[0, 1, -1]]))
+    print('Actual:   %s' % str(np.array(table)))
+    return
+  print('Passed')
+
+def test_branch_shared_periods():
+  print('Check that branches share the periods at the start of their configs that are the same, with the same seed')
+  config = small_config()
+  config['periods'] = config['periods'] + [dict(config['periods'][0], unemployment_benefit=0.5)]
+  other = dict(config, periods=config['periods'][:1] + [dict(config['periods'][0], unemployment_benefit=1)])
+  cases = [
+    ([config, config], 2),
+    ([config, other], 1),
+    ([config, dict(other, periods=other['periods'][1:])], 0),
+    ([config, dict(config, seed=2)], 0)
+  ]
+  for configs, expected in cases:
+    actual = branch.shared_periods(configs)
+    if actual != expected:
+      print('Failed: wrong number of shared periods')
+      print('Expected: %d' % expected)
+      print('Actual:   %d' % actual)
+      return
+  print('Passed')
+
+def test_branch_run():
+  print('Check that branches run from a snapshot of their shared periods get the same results as run on their own, with both engines')
+  base = small_config(nmonths=2)
+  configs = [
+    dict(base, periods=base['periods'] + [dict(base['periods'][0], duration=2, spending_inclination=s, unemployment_benefit=0.5)])
+    for s in [0.1, 0.5, 0.9]
+  ]
+  for engine in util.engines:
+    branches = branch.run(configs, workers=1, engine=engine)
+    if branches[0][:2] != branches[1][:2] or branches[0][-1] == branches[1][-1]:
+      print('Failed: %s branches differ in their shared months, or are the same after them' % engine)
+      return
+    for i, config in enumerate(configs):
+      expected = branch.run_from(config, engine=engine)
+      if branches[i] != expected:
+        print('Failed: %s branch %d differs from running its config on its own' % (engine, i))
+        print('Expected: %s' % str(util.flatten(expected[-1])))
+        print('Actual:   %s' % str(util.flatten(branches[i][-1])))
+        return
+  print('Passed')
+
+# A config with layoffs, closures, rehires and benefits: after a month, nobody
+# spends in industry 2
+def shutdown_config():
+  period = dict(simulator.defaults['periods'][0], duration=1, rehire_rate=0.5,
+    spending_distribution=[['industry 1', 'industry 2'], [0.5, 0.5]])
+  return dict(simulator.defaults, ncompanies=20, income=[[12000, 60000], [0.5, 0.5]], company_size=[[2, 8], [0.5, 0.5]], seed=3,
+    periods=[period, dict(period, duration=3, person_stimulus=0, company_stimulus=0, unemployment_benefit=0.5,
+      spending_distribution=[['industry 1', 'industry 2'], [1, 0]])])
+
+# An instrument that keeps the money and headcount of each company, and
+# whether each person is employed, at the start of the run and after the last
+# phase
+class EconomyState(simulator.Instrument):
+  def __init__(self):
+    self.first = None
+    self.last = None
+
+  def state(self, people, companies):
+    if isinstance(companies, vectorized.Companies):
+      return companies.money.astype(float), companies.headcount.copy(), people.employed.astype(int)
+    return (np.array([c.money for c in companies], dtype=float), np.array([len(c.employees) for c in companies]),
+      np.array([p.employed for p in people], dtype=int))
+
+  def before(self, phase, people, companies):
+    if self.first is None:
+      self.first = self.state(people, companies)
+
+  def after(self, phase, people, companies):
+    self.last = self.state(people, companies)
+
+def test_transactions_log():
+  print('Check that a flushed transaction log matches one kept in memory, and reads back the same, with both engines')
+  for engine in util.engines:
+    path = os.path.join(tempfile.mkdtemp(), 'transactions')
+    flushed = transactions.Recorder(path, capacity=37)
+    in_memory = transactions.Recorder(capacity=10**6)
+    ring = transactions.Recorder(capacity=37)
+    util.engines[engine].run(shutdown_config(), instrument=simulator.Instruments([flushed, in_memory, ring]))
+    flushed.close()
+    expected = in_memory.events()
+    meta, events = transactions.read(path)
+    if meta != json.loads(json.dumps(in_memory.meta())) or meta['nevents'] != len(expected) or len(expected) <= 37 \
+      or events.tobytes() != expected.tobytes() or flushed.nflushed != len(expected):
+      print('Failed: %s log flushed to disk differs from the log kept in memory' % engine)
+      print('Expected: %d events, %s' % (len(expected), in_memory.meta()['ndays']))
+      print('Actual:   %d events, %s' % (len(events), meta))
+      return
+    if ring.events().tobytes() != expected[-37:].tobytes():
+      print('Failed: %s ring buffer does not keep the latest events, oldest first' % engine)
+      return
+  print('Passed')
+
+def test_transactions_flows():
+  print("Check that the flows in a transaction log add up to the changes in the companies' money and employees, with both engines")
+  for engine in util.engines:
+    recorder = transactions.Recorder()
+    state = EconomyState()
+    util.engines[engine].run(shutdown_config(), instrument=simulator.Instruments([recorder, state]))
+    meta = recorder.meta()
+    by_company = transactions.flows(recorder.events(), meta, by='company')
+    counts = transactions.flows(recorder.events(), meta, by='company', value='count')
+    money = by_company['spend'] - by_company['payroll'] + by_company['stimulus']
+    headcount = counts['hire'] - counts['layoff']
+    (money0, headcount0, employed0), (money1, headcount1, employed1) = state.first, state.last
+    if not np.allclose(money, money1 - money0) or not np.array_equal(headcount, headcount1 - headcount0) \
+      or np.sum(counts['layoff']) == 0 or np.sum(counts['hire']) == 0 or np.sum(counts['closure']) == 0:
+      print('Failed: %s flows by company do not add up' % engine)
+      print('Expected: money %s, headcount %s' % (list(money1 - money0), list(headcount1 - headcount0)))
+      print('Actual:   money %s, headcount %s' % (list(money), list(headcount)))
+      return
+
+    by_industry = transactions.flows(recorder.events(), meta, by='industry')
+    person_counts = transactions.flows(recorder.events(), meta, by='person', value='count')
+    employed = person_counts['hire'] - person_counts['layoff']
+    industry = np.array(meta['company_industry'])
+    expected = [np.bincount(industry, weights=by_company[kind], minlength=len(meta['industry_names'])) for kind in transactions.kinds]
+    if not all([np.allclose(by_industry[kind], e) for kind, e in zip(transactions.kinds, expected)]) \
+      or not np.array_equal(employed, employed1 - employed0) or np.sum(person_counts['benefit']) == 0:
+      print('Failed: %s flows by industry or person do not add up' % engine)
+      print('Expected: employed %s' % list(employed1 - employed0))
+      print('Actual:   employed %s' % list(employed))
+      return
+
+    # Without meta, events can be grouped by company or person, but not industry
+    try:
+      transactions.flows(recorder.events())
+      print('Failed: %s flows were grouped by industry without meta' % engine)
+      print('Expected: ValueError')
+      return
+    except ValueError:
+      pass
+    if not np.allclose(transactions.flows(recorder.events(), by='company')['spend'], by_company['spend']):
+      print('Failed: %s flows by company without meta differ' % engine)
+      print('Expected: %s' % list(by_company['spend']))
+      print('Actual:   %s' % list(transactions.flows(recorder.events(), by='company')['spend']))
+      return
+  print('Passed')
+
+# Run all tests
+def main():
+  test_ensemble_replicate_seeds()
+  test_ensemble_combine()
+  test_sweep_apply()
+  test_sweep_grid()
+  test_sweep_latin_hypercube()
+  test_sweep_resume()
+  test_grouped_percentiles()
+  test_sketch_rank_error()
+  test_grouped_sketches()
+  test_summary_results()
+  test_wire_round_trip()
+  test_cache_key()
+  test_cache_put()
+  test_timeseries_round_trip()
+  test_branch_shared_periods()
+  test_branch_run()
+  test_transactions_log()
+  test_transactions_flows()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,131 @@
+'''
+Writes the results of a run to disk as a time series table, streaming each
+snapshot as it's produced, so that memory stays flat however long the run. The
+table is a NumPy .npy file of float64s, with one row per snapshot and one
+column per group, result and percentile, which can be memory-mapped for
+analysis without loading it all. Next to it, a JSON file lists the columns.
+
+Example:
+columns, names, table = timeseries.read('output/results')
+table[:, names.index('overall/person_money/p50')]
+'''
+
+from util import util, wire
+import json
+import numpy as np
+import os
+
+# The header of the .npy file is padded to a fixed length, so that it can be
+# rewritten with the final number of rows without moving the data
+header_length = 128
+
+# Returns the name of a column [level, group, result, index] (see wire.schema),
+# like util.flatten, e.g. "overall/person_money/p50" or
+# "industries/industry 1/company_closures"
+def column_name(column):
+  level, group, result, i = column
+  name = level if group is None else '%s/%s' % (level, group)
+  name += '/' + result
+  if result in util.distributions:
+    name += '/p%d' % util.percentiles[i]
+  return name
+
+# Returns the .npy header for a table with the given number of rows and
+# columns, padded to header_length
+def header(nrows, ncolumns):
+  d = "{'descr': '<f8', 'fortran_order': False, 'shape': (%d, %d), }" % (nrows, ncolumns)
+  prefix = b'\x93NUMPY\x01\x00' + np.uint16(header_length - 10).tobytes()
+  return prefix + d.ljust(header_length - 10 - 1).encode('latin1') + b'\n'
+
+# Returns the row of a table for a results snapshot: its values in the order of
+# the columns, with NaN for any it doesn't have
+def row(results, columns):
+  get = lambda level, group: results[level] if group is None else results[level].get(group, {})
+  return [get(level, group).get(result, [np.nan] * (i + 1))[i] for level, group, result, i in columns]
+
+# Returns the columns and table (a 2D array) of a list of results snapshots held
+# in memory, e.g. the combined results of an ensemble
+def table(results):
+  columns = wire.schema(results[0])
+  return columns, np.array([row(r, columns) for r in results], dtype=float).reshape(-1, len(columns))
+
+# Returns the names of the groups at a level ("income_levels" or "industries")
+# of the columns, in order
+def groups(columns, level):
+  return list(dict.fromkeys([group for l, group, _, _ in columns if l == level]))
+
+# Returns {result name: indices of its columns} for one group of the columns
+def group_columns(columns, level, group=None):
+  indices = {}
+  for j, (l, g, result, _) in enumerate(columns):
+    if l == level and g == group:
+      indices.setdefault(result, []).append(j)
+  return indices
+
+# Streams results snapshots to path.npy (the table) and path.json (the
+# columns). The columns are taken from the first snapshot unless they're given.
+# If nrows is given, continues the table already at path from its first nrows
+# rows instead, dropping any after them (e.g. when resuming a run from a
+# checkpoint). Use as a context manager, or call close() when done.
+class Writer:
+  def __init__(self, path, columns=None, nrows=None):
+    self.path = path
+    self.columns = None
+    self.nrows = 0
+    if nrows is not None and nrows > 0:
+      with open(path + '.json') as f:
+        self.columns = json.load(f)['columns']
+      self.nrows = nrows
+      self.f = open(path + '.npy', 'r+b')
+      self.f.truncate(header_length + 8 * nrows * len(self.columns))
+      self.f.seek(0)
+      self.f.write(header(self.nrows, len(self.columns)))
+      self.f.seek(0, os.SEEK_END)
+      return
+    self.f = open(path + '.npy', 'wb')
+    if columns is not None:
+      self.start(columns)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  # Writes the columns file and an empty table
+  def start(self, columns):
+    self.columns = columns
+    with open(self.path + '.json', 'w') as f:
+      json.dump({'names': [column_name(c) for c in columns], 'columns': columns}, f)
+    self.f.write(header(0, len(columns)))
+
+  # Appends a snapshot (from util.results) as a row of the table
+  def write(self, results):
+    if self.columns is None:
+      self.start(wire.schema(results))
+    self.write_rows([row(results, self.columns)])
+
+  # Appends rows of values, in the order of the columns
+  def write_rows(self, rows):
+    rows = np.asarray(rows, dtype='<f8').reshape(-1, len(self.columns))
+    self.f.write(rows.tobytes())
+    self.nrows += len(rows)
+    # Keep the header up to date, so the table can be read while it's written
+    self.f.seek(0)
+    self.f.write(header(self.nrows, len(self.columns)))
+    self.f.seek(0, os.SEEK_END)
+    self.f.flush()
+
+  def close(self):
+    if self.f.closed:
+      return
+    if self.columns is None:
+      self.start([])
+    self.f.close()
+
+# Reads a table written by Writer. Returns the columns (see wire.schema), their
+# names (see column_name()), and the table, memory-mapped (read only).
+def read(path):
+  with open(path + '.json') as f:
+    d = json.load(f)
+  return d['columns'], d['names'], np.load(path + '.npy', mmap_mode='r')
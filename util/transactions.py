@@ -0,0 +1,268 @@
+'''
+A log of the transactions of a run, for tracing which flows of money and
+people caused an outcome (e.g. an industry collapsing), where the results only
+show aggregate snapshots. A Recorder is an instrument (see
+simulator.Instrument) that compares the state of the economy before and after
+each phase of the run, and records what changed as events: spending, payroll,
+hires, layoffs, closures, stimulus and benefits.
+
+Events go into a preallocated NumPy structured array, used as a ring buffer.
+If the recorder has a file, the buffer is flushed to it whenever it fills up,
+so memory stays bounded however long the run. Otherwise it keeps the latest
+events that fit. Spending and payroll are recorded per company per day rather
+than per person, so that the log stays small enough to leave on for runs with
+millions of people.
+
+Example:
+recorder = transactions.Recorder('output/transactions')
+vectorized.run(config, instrument=recorder)
+recorder.close()
+meta, events = transactions.read('output/transactions')
+transactions.flows(events, meta, by='industry')['spend']
+'''
+
+from simulator import simulator, vectorized
+import json
+import numpy as np
+
+# The kinds of events, by their code in the log
+kinds = ['spend', 'payroll', 'hire', 'layoff', 'closure', 'stimulus', 'benefit']
+
+# An event in the log:
+# - day: the number of days simulated before it
+# - kind: index into kinds
+# - person, company: the indices of the person and company involved, or -1
+# - amount: the money that moved. For spend, what people spent at the company
+#   that day; for payroll, what the company paid its employees; for stimulus
+#   and benefit, the grant (negative for a tax); for hire and layoff, the
+#   person's monthly income; for closure, 0.
+event_dtype = np.dtype([
+  ('day', '<i4'),
+  ('kind', 'u1'),
+  ('person', '<i4'),
+  ('company', '<i4'),
+  ('amount', '<f8')
+])
+
+# The number of events the buffer holds by default (21 MB)
+default_capacity = 2**20
+
+# Records the events of a run. Pass it to an engine's run as the instrument.
+# - path: if given, events are flushed to path.bin in batches (see read()),
+#   and path.json describes them when the recorder is closed
+# - capacity: the number of events the buffer holds
+# - aggregate_months: whether the run is aggregate_months, where each spend
+#   phase is a month rather than a day
+# - start_day: the day the run starts at (e.g. when resuming a checkpoint)
+class Recorder(simulator.Instrument):
+  def __init__(self, path=None, capacity=default_capacity, aggregate_months=False, start_day=0):
+    self.path = path
+    self.buffer = np.zeros(capacity, dtype=event_dtype)
+    self.head = 0 # where the next event goes in the buffer
+    self.size = 0 # the number of events in the buffer
+    self.nevents = 0 # the number of events recorded in total
+    self.nflushed = 0
+    self.day = start_day
+    self.days_per_spend = simulator.days_per_month if aggregate_months else 1
+    self.file = None if path is None else open(path + '.bin', 'wb')
+    self.state = None
+    self.companies = None
+    self.npeople = None
+    self.person_ids = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  # Adds events of one kind to the buffer. person, company and amount are
+  # arrays (or scalars) of the same length n.
+  def append(self, kind, n, person=-1, company=-1, amount=0):
+    if n == 0:
+      return
+    events = np.zeros(n, dtype=event_dtype)
+    events['day'] = self.day
+    events['kind'] = kinds.index(kind)
+    events['person'] = person
+    events['company'] = company
+    events['amount'] = amount
+    self.nevents += n
+    capacity = len(self.buffer)
+    while len(events) > 0:
+      m = min(len(events), capacity - self.head)
+      self.buffer[self.head:self.head + m] = events[:m]
+      events = events[m:]
+      self.head = (self.head + m) % capacity
+      self.size = min(self.size + m, capacity)
+      if self.file is not None and self.size == capacity:
+        self.flush()
+
+  # Writes the buffered events to the file, if there is one, and empties the
+  # buffer
+  def flush(self):
+    if self.file is None:
+      return
+    self.file.write(self.buffer[:self.size].tobytes())
+    self.file.flush()
+    self.nflushed += self.size
+    self.head = 0
+    self.size = 0
+
+  # Returns the events in the buffer, oldest first. Without a file, these are
+  # the latest events recorded (all of them if they fit).
+  def events(self):
+    if self.size < len(self.buffer):
+      return self.buffer[:self.size].copy()
+    return np.concatenate([self.buffer[self.head:], self.buffer[:self.head]])
+
+  # Returns the description of the log so far (see read())
+  def meta(self):
+    meta = {'kinds': kinds, 'nevents': self.nevents, 'ndays': self.day}
+    if self.companies is not None:
+      meta['npeople'] = self.npeople
+      meta['industry_names'], meta['company_industry'] = self.industries(self.companies)
+    return meta
+
+  # Flushes the buffer and writes the description of the log to path.json
+  def close(self):
+    if self.file is None or self.file.closed:
+      return
+    self.flush()
+    self.file.close()
+    with open(self.path + '.json', 'w') as f:
+      json.dump(self.meta(), f)
+
+  # Returns the names of the industries and each company's index into them
+  def industries(self, companies):
+    if isinstance(companies, vectorized.Companies):
+      return list(companies.industry_names), companies.industry.tolist()
+    names = list(dict.fromkeys([c.industry for c in companies]))
+    return names, [names.index(c.industry) for c in companies]
+
+  # Returns the arrays of the state of the people and companies (from either
+  # engine) that a phase changes
+  def snapshot(self, phase, people, companies):
+    if isinstance(people, vectorized.People):
+      get = {
+        'person_money': lambda: people.money.copy(),
+        'person_income': lambda: people.income,
+        'person_employer': lambda: people.employer.copy(),
+        'company_money': lambda: companies.money.copy(),
+        'company_in_business': lambda: companies.in_business.copy()
+      }
+    else:
+      get = {
+        'person_money': lambda: np.array([p.money for p in people], dtype=float),
+        'person_income': lambda: np.array([p.income for p in people], dtype=float),
+        'person_employer': lambda: self.employers(people, companies),
+        'company_money': lambda: np.array([c.money for c in companies], dtype=float),
+        'company_in_business': lambda: np.array([c.in_business for c in companies], dtype=bool)
+      }
+    fields = {
+      'stimulus': ['person_money', 'company_money'],
+      'spend': ['company_money'],
+      'rehire': ['person_employer', 'person_income'],
+      'layoff': ['person_employer', 'person_income', 'company_in_business'],
+      'pay': ['company_money'],
+      'benefits': ['person_money']
+    }
+    return {field: get[field]() for field in fields.get(phase, [])}
+
+  # Returns the index of each person's employer (-1 if unemployed), from the
+  # legacy engine's lists of employees
+  def employers(self, people, companies):
+    if self.person_ids is None:
+      self.person_ids = {id(p): i for i, p in enumerate(people)}
+    employer = np.full(len(people), -1)
+    for j, c in enumerate(companies):
+      for e in c.employees:
+        employer[self.person_ids[id(e)]] = j
+    return employer
+
+  def before(self, phase, people, companies):
+    self.state = self.snapshot(phase, people, companies)
+
+  def after(self, phase, people, companies):
+    before = self.state
+    if len(before) == 0:
+      return
+    after = self.snapshot(phase, people, companies)
+    self.companies = companies
+    self.npeople = len(people)
+
+    if phase == 'spend':
+      credit = after['company_money'] - before['company_money']
+      c = np.flatnonzero(credit)
+      self.append('spend', len(c), company=c, amount=credit[c])
+      self.day += self.days_per_spend
+    elif phase == 'pay':
+      paid = before['company_money'] - after['company_money']
+      c = np.flatnonzero(paid)
+      self.append('payroll', len(c), company=c, amount=paid[c])
+    elif phase == 'stimulus' or phase == 'benefits':
+      kind = 'stimulus' if phase == 'stimulus' else 'benefit'
+      grant = after['person_money'] - before['person_money']
+      p = np.flatnonzero(grant)
+      self.append(kind, len(p), person=p, amount=grant[p])
+      if phase == 'stimulus':
+        grant = after['company_money'] - before['company_money']
+        c = np.flatnonzero(grant)
+        self.append(kind, len(c), company=c, amount=grant[c])
+    elif phase == 'rehire':
+      p = np.flatnonzero((before['person_employer'] < 0) & (after['person_employer'] >= 0))
+      self.append('hire', len(p), person=p, company=after['person_employer'][p], amount=after['person_income'][p])
+    elif phase == 'layoff':
+      p = np.flatnonzero((before['person_employer'] >= 0) & (after['person_employer'] < 0))
+      self.append('layoff', len(p), person=p, company=before['person_employer'][p], amount=after['person_income'][p])
+      c = np.flatnonzero(before['company_in_business'] & ~after['company_in_business'])
+      self.append('closure', len(c), company=c)
+
+# Reads a log written by a Recorder. Returns its description (the kinds, the
+# number of events, days and people, the industry names and each company's
+# index into them) and the events, memory-mapped (read only).
+def read(path):
+  with open(path + '.json') as f:
+    meta = json.load(f)
+  if meta['nevents'] == 0:
+    return meta, np.zeros(0, dtype=event_dtype)
+  return meta, np.memmap(path + '.bin', dtype=event_dtype, mode='r')
+
+# Returns the total of each kind of event per company, industry or person:
+# {kind: array of totals, indexed by company, industry or person}, each as long
+# as the number of them in meta. Events without one (e.g. people's benefits, by
+# company) aren't counted.
+# - events, meta: from read(), or a Recorder's events() and meta()
+# - by: 'company', 'industry' or 'person' (grouping by industry needs meta)
+# - value: 'amount' to sum the money moved, or 'count' to count the events
+# - days: optional [first, last) range of days to count events from
+# The events are read in chunks, so that logs bigger than memory can be
+# queried.
+def flows(events, meta=None, by='industry', value='amount', days=None, chunk=2**22):
+  if by == 'industry' and meta is None:
+    raise ValueError('grouping by industry needs meta')
+  elif by == 'industry':
+    company_industry = np.asarray(meta['company_industry'])
+  elif by not in ['company', 'person']:
+    raise ValueError('invalid grouping %s' % json.dumps(by))
+  totals = {kind: np.zeros(0) for kind in kinds}
+  for start in range(0, len(events), chunk):
+    e = np.asarray(events[start:start + chunk])
+    if days is not None:
+      e = e[(e['day'] >= days[0]) & (e['day'] < days[1])]
+    group = e['person'] if by == 'person' else e['company']
+    if by == 'industry':
+      group = np.where(group >= 0, company_industry[group], -1)
+    for k, kind in enumerate(kinds):
+      mask = (e['kind'] == k) & (group >= 0)
+      weights = e['amount'][mask] if value == 'amount' else None
+      counts = np.bincount(group[mask], weights=weights)
+      n = max(len(totals[kind]), len(counts))
+      totals[kind] = np.pad(totals[kind], (0, n - len(totals[kind]))) + np.pad(counts, (0, n - len(counts)))
+  if meta is not None and by == 'person':
+    ngroups = meta.get('npeople') or max([len(t) for t in totals.values()])
+  elif meta is not None:
+    ngroups = len(meta['industry_names'] if by == 'industry' else meta['company_industry'])
+  else:
+    ngroups = max([len(t) for t in totals.values()])
+  return {kind: np.pad(t, (0, ngroups - len(t))) for kind, t in totals.items()}
@@ -2,9 +2,23 @@
 Helper functions for the web app and CLI.
 '''
 
-from simulator import simulator
+from simulator import simulator, vectorized
+from util import sketch
+import copy
 import numpy as np
 
+# Simulator engines the apps can choose between. They take the same config and
+# produce the same results.
+engines = {
+  'legacy': simulator,
+  'vectorized': vectorized
+}
+
+# The percentiles of money reported in the results, and the results that are
+# reported as those percentiles (the rest are a single value)
+percentiles = [0, 10, 25, 50, 75, 90, 100]
+distributions = ['person_money', 'company_money']
+
 # Merges dicts
 def merge(dicts):
   d0 = dicts[0]
@@ -12,47 +26,258 @@ def merge(dicts):
     d0.update(d)
   return d0
 
-# Computes the results from a particular day of the simulation, given the list
-# of people and companies from that day. Returns a dict you can see below, with
-# the results as described in the docs.
-def results(people, companies):
-  # Computes people results
-  def people_results(people, percentiles):
-    person_money = [0] * len(percentiles) if len(people) == 0 else list(np.round(np.percentile([p.money for p in people], percentiles), 2))
-    person_unemployment = [1] if len(people) == 0 else [np.mean([not p.employed for p in people])]
-    return {
-      'person_money': person_money,
-      'person_unemployment': person_unemployment
-    }
+# Computes the given percentiles of values within each group, the same as
+# np.percentile (with linear interpolation) over each group separately, but in
+# one pass over all groups.
+# - sorted_values: the values, sorted, so that they only need to be sorted once
+#   for all groupings
+# - group: the group (0 to ngroups-1) of each of the sorted values, or -1 to
+#   leave it out
+# Returns an array of shape (ngroups, len(percentiles)), with NaN for empty
+# groups.
+def grouped_percentiles(sorted_values, group, ngroups, percentiles):
+  if len(sorted_values) == 0:
+    return np.full((ngroups, len(percentiles)), np.nan)
 
-  # Computes company results
-  def company_results(companies, percentiles):
-    return {
-      'company_money': list(np.round(np.percentile([c.money for c in companies], percentiles), 2)),
-      'company_closures': [np.mean([not c.in_business for c in companies])]
-    }
+  # Reorder the sorted values by group. The sort is stable, so each group's
+  # values stay sorted. Values left out go in an extra group at the end.
+  g = np.where(group < 0, ngroups, group).astype(np.int16 if ngroups < 2**15 - 1 else int)
+  sorted_values = sorted_values[np.argsort(g, kind='stable')]
+  counts = np.bincount(g, minlength=ngroups + 1)[:ngroups]
+  starts = np.cumsum(counts) - counts
 
-  # Compute all results
-  percentiles = [0, 10, 25, 50, 75, 90, 100]
-  income_levels = set([p.income for p in people])
-  industries = set([c.industry for c in companies])
+  # Interpolate between the values on either side of each percentile's
+  # position in its group, the way np.percentile does
+  position = (counts[:,None] - 1) * (np.asarray(percentiles)[None,:] / 100)
+  below = np.floor(position).astype(int)
+  t = position - below
+  a = sorted_values[np.clip(starts[:,None] + below, 0, len(sorted_values) - 1)]
+  b = sorted_values[np.clip(starts[:,None] + np.minimum(below + 1, counts[:,None] - 1), 0, len(sorted_values) - 1)]
+  lerp = np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+  lerp[counts == 0] = np.nan
+  return lerp
+
+# Flattens the people and companies from a particular day of the simulation,
+# either as lists of objects (from simulator.run) or as arrays (from
+# vectorized.run), into arrays, and groups them by income level and industry.
+# Only industries that have companies are reported. Returns a dict of:
+# - person_money, person_employed, company_money, company_in_business: arrays
+# - income_levels: the income levels, and person_level: each person's index
+#   into them
+# - industries: the names of the industries, and person_industry,
+#   company_industry: each person's and company's index into them (-1 for
+#   none)
+def groups(people, companies):
+  # Flatten people and companies into arrays, with industries as ids into
+  # industry_names
+  if isinstance(people, vectorized.People):
+    person_money = people.money
+    person_income = people.income
+    person_employed = people.employed
+    person_industry = people.industry
+    company_money = companies.money
+    company_in_business = companies.in_business
+    company_industry = companies.industry
+    industry_names = companies.industry_names
+  else:
+    industry_names = list(dict.fromkeys([c.industry for c in companies]))
+    industry_ids = {name: i for i, name in enumerate(industry_names)}
+    person_money = np.array([p.money for p in people], dtype=float)
+    person_income = np.array([p.income for p in people], dtype=float)
+    person_employed = np.array([p.employed for p in people], dtype=bool)
+    person_industry = np.array([industry_ids.get(p.industry, -1) for p in people], dtype=int)
+    company_money = np.array([c.money for c in companies], dtype=float)
+    company_in_business = np.array([c.in_business for c in companies], dtype=bool)
+    company_industry = np.array([industry_ids[c.industry] for c in companies], dtype=int)
+
+  income_levels, person_level = np.unique(person_income, return_inverse=True)
+  industries = np.unique(company_industry)
+  position = np.full(len(industry_names) + 1, -1)
+  position[industries] = np.arange(len(industries))
+  return {
+    'person_money': person_money,
+    'person_employed': person_employed,
+    'company_money': company_money,
+    'company_in_business': company_in_business,
+    'income_levels': [str(int(simulator.months_per_year * i)) for i in income_levels],
+    'person_level': person_level.reshape(-1),
+    'industries': [str(industry_names[i]) for i in industries],
+    'person_industry': position[person_industry], # -1 indexes the extra -1 at the end
+    'company_industry': position[company_industry]
+  }
+
+# Computes the results from a particular day of the simulation, given the
+# people and companies from that day, either as lists of objects (from
+# simulator.run) or as arrays (from vectorized.run). Returns a dict you can see
+# below, with the results as described in the docs.
+#
+# The people and companies are grouped by income level and industry once, as
+# integer group ids, and each result is computed for every group at once: money
+# is sorted once for the percentiles, and the rates are counted with bincount.
+#
+# If epsilon is given, the percentiles of money are approximated with quantile
+# sketches with that rank error instead (see summary()).
+def results(people, companies, epsilon=None):
+  if epsilon is not None:
+    return summary_results(summary(people, companies, epsilon))
+  g = groups(people, companies)
+  person_money = g['person_money']
+  company_money = g['company_money']
+
+  # Compute each result for every group of each grouping, sorting money once.
+  # The groups are looked up in money order.
+  person_order = np.argsort(person_money)
+  company_order = np.argsort(company_money)
+  sorted_person_money = person_money[person_order]
+  sorted_company_money = company_money[company_order]
+  unemployed = ~g['person_employed'][person_order]
+  closed = ~g['company_in_business'][company_order]
+  def people_results(group, ngroups):
+    group = group[person_order]
+    money = grouped_percentiles(sorted_person_money, group, ngroups, percentiles)
+    counts = np.bincount(group[group >= 0], minlength=ngroups)
+    nunemployed = np.bincount(group[group >= 0], weights=unemployed[group >= 0], minlength=ngroups)
+    return [
+      {
+        'person_money': [0] * len(percentiles) if counts[i] == 0 else list(np.round(money[i], 2)),
+        'person_unemployment': [1] if counts[i] == 0 else [np.float64(nunemployed[i] / counts[i])]
+      }
+      for i in range(ngroups)
+    ]
+  def company_results(group, ngroups):
+    group = group[company_order]
+    money = grouped_percentiles(sorted_company_money, group, ngroups, percentiles)
+    counts = np.bincount(group, minlength=ngroups)
+    nclosed = np.bincount(group, weights=closed, minlength=ngroups)
+    return [
+      {
+        'company_money': list(np.round(money[i], 2)),
+        'company_closures': [np.float64(nclosed[i] / counts[i])]
+      }
+      for i in range(ngroups)
+    ]
+
+  people_by_industry = people_results(g['person_industry'], len(g['industries']))
+  companies_by_industry = company_results(g['company_industry'], len(g['industries']))
   return {
     'overall': merge([
-      people_results(people, percentiles),
-      company_results(companies, percentiles),
+      people_results(np.zeros(len(person_money), dtype=int), 1)[0],
+      company_results(np.zeros(len(company_money), dtype=int), 1)[0],
       {'circulation': [
-        round(np.sum([p.money for p in people]) + np.sum([c.money for c in companies]), 2)
+        round(float(np.sum(person_money, dtype=float) + np.sum(company_money, dtype=float)), 2) # summed in float64 even if money is float32
       ]}
     ]),
-    'income_levels': {
-      str(int(simulator.months_per_year * i)): people_results([p for p in people if p.income == i], percentiles)
-      for i in income_levels
-    },
+    'income_levels': dict(zip(g['income_levels'], people_results(g['person_level'], len(g['income_levels'])))),
     'industries': {
-      i: merge([
-        people_results([p for p in people if p.industry == i], percentiles),
-        company_results([c for c in companies if c.industry == i], percentiles)
-      ])
-      for i in industries
+      name: merge([p, c])
+      for name, p, c in zip(g['industries'], people_by_industry, companies_by_industry)
     }
   }
+
+# Summarizes the people and companies from a particular day of the simulation
+# (like results()) without keeping every agent's money: money is summarized by
+# quantile sketches with rank error epsilon (see sketch.py), and the rates by
+# counts. Returns a dict with the same groups as results(), where each group
+# has some of:
+# - person_money, company_money: QuantileSketch
+# - people, unemployed, companies, closed: counts
+# - circulation: total money (overall only)
+# Summaries of disjoint shards of the population, or of replicates, can be
+# merged with merge_summaries(), and turned into results with
+# summary_results().
+def summary(people, companies, epsilon=0.01):
+  g = groups(people, companies)
+
+  # Money isn't sorted: each group's values go straight into its sketch
+  unemployed = ~g['person_employed']
+  closed = ~g['company_in_business']
+  def people_summaries(group, ngroups):
+    sketches = sketch.grouped_sketches(g['person_money'], group, ngroups, epsilon)
+    counts = np.bincount(group[group >= 0], minlength=ngroups)
+    nunemployed = np.bincount(group[group >= 0], weights=unemployed[group >= 0], minlength=ngroups)
+    return [
+      {'person_money': sketches[i], 'people': int(counts[i]), 'unemployed': int(nunemployed[i])}
+      for i in range(ngroups)
+    ]
+  def company_summaries(group, ngroups):
+    sketches = sketch.grouped_sketches(g['company_money'], group, ngroups, epsilon)
+    counts = np.bincount(group, minlength=ngroups)
+    nclosed = np.bincount(group, weights=closed, minlength=ngroups)
+    return [
+      {'company_money': sketches[i], 'companies': int(counts[i]), 'closed': int(nclosed[i])}
+      for i in range(ngroups)
+    ]
+
+  people_by_industry = people_summaries(g['person_industry'], len(g['industries']))
+  companies_by_industry = company_summaries(g['company_industry'], len(g['industries']))
+  return {
+    'overall': merge([
+      people_summaries(np.zeros(len(g['person_money']), dtype=int), 1)[0],
+      company_summaries(np.zeros(len(g['company_money']), dtype=int), 1)[0],
+      {'circulation': float(np.sum(g['person_money'], dtype=float) + np.sum(g['company_money'], dtype=float))}
+    ]),
+    'income_levels': dict(zip(g['income_levels'], people_summaries(g['person_level'], len(g['income_levels'])))),
+    'industries': {
+      name: merge([p, c])
+      for name, p, c in zip(g['industries'], people_by_industry, companies_by_industry)
+    }
+  }
+
+# Merges a list of summaries (from summary()) into one summary of all of their
+# people and companies. Groups that are missing from some summaries are merged
+# over the ones that have them.
+def merge_summaries(summaries):
+  def merge_group(a, b):
+    for name, value in b.items():
+      if name not in a:
+        a[name] = copy.deepcopy(value)
+      elif isinstance(value, sketch.QuantileSketch):
+        a[name].merge(value)
+      else:
+        a[name] += value
+  merged = {'overall': {}, 'income_levels': {}, 'industries': {}}
+  for s in summaries:
+    merge_group(merged['overall'], s['overall'])
+    for level in ['income_levels', 'industries']:
+      for group, r in s[level].items():
+        merge_group(merged[level].setdefault(group, {}), r)
+  return merged
+
+# Turns a summary (from summary() or merge_summaries()) into results, with the
+# same structure as results()
+def summary_results(summary):
+  def group_results(s):
+    r = {}
+    if 'person_money' in s:
+      r['person_money'] = [0] * len(percentiles) if s['people'] == 0 else list(np.round(s['person_money'].percentiles(percentiles), 2))
+      r['person_unemployment'] = [1] if s['people'] == 0 else [np.float64(s['unemployed'] / s['people'])]
+    if 'company_money' in s:
+      r['company_money'] = list(np.round(s['company_money'].percentiles(percentiles), 2))
+      r['company_closures'] = [np.float64(s['closed'] / s['companies'])]
+    if 'circulation' in s:
+      r['circulation'] = [round(s['circulation'], 2)]
+    return r
+  return {
+    'overall': group_results(summary['overall']),
+    'income_levels': {level: group_results(s) for level, s in summary['income_levels'].items()},
+    'industries': {industry: group_results(s) for industry, s in summary['industries'].items()}
+  }
+
+# Flattens a results dict into {column name: value}, with one column per
+# group, result and percentile, e.g. "overall/person_money/p50" or
+# "industries/industry 1/company_closures". Useful for writing results as a
+# table.
+def flatten(results):
+  columns = {}
+  def add(group, r):
+    for name, values in r.items():
+      if name in distributions:
+        for p, v in zip(percentiles, values):
+          columns['%s/%s/p%d' % (group, name, p)] = float(v)
+      else:
+        columns['%s/%s' % (group, name)] = float(values[0])
+  add('overall', results['overall'])
+  for level in ['income_levels', 'industries']:
+    for group, r in results[level].items():
+      add('%s/%s' % (level, group), r)
+  return columns
@@ -0,0 +1,93 @@
+'''
+A compact binary encoding of results, for streaming them to the web app. The
+schema of the results (every group, result and percentile) is sent once as
+JSON, and then each snapshot of results is sent as a packed array of float32s
+in the schema's order, optionally delta-encoded and compressed.
+
+Each binary message is a header of 5 little-endian uint32s:
+  [flags, period, day, ndays, total_ndays]
+followed by the payload, one float32 per schema column. The flags say how the
+payload is encoded:
+- delta: each value is XORed (as its 32 bits) with the same column's value in
+  the previous snapshot, so unchanged values are 0 and compress well. This is
+  lossless, unlike subtracting floats.
+- compressed: the payload is compressed with zlib (DecompressionStream's
+  "deflate" format in the browser)
+'''
+
+from util import util
+import json
+import numpy as np
+import zlib
+
+flag_delta = 1
+flag_compressed = 2
+
+# Returns the schema of a results dict (from util.results): a list of columns
+# [level, group, result, index], where level is "overall", "income_levels" or
+# "industries", group is the group's name (None for overall), and index is the
+# index into the result's list of values (e.g. which percentile)
+def schema(results):
+  columns = []
+  def add(level, group, r):
+    for name, values in r.items():
+      for i in range(len(values)):
+        columns.append([level, group, name, i])
+  add('overall', None, results['overall'])
+  for level in ['income_levels', 'industries']:
+    for group, r in results[level].items():
+      add(level, group, r)
+  return columns
+
+# Returns the values of a results dict in the order of its schema, as float32s
+def values(results, columns):
+  get = lambda level, group: results[level] if group is None else results[level][group]
+  return np.array([get(level, group)[name][i] for level, group, name, i in columns], dtype='<f4')
+
+# Encodes a stream of results snapshots into web socket messages
+class Encoder:
+  def __init__(self, delta=False, compress=False):
+    self.delta = delta
+    self.compress = compress
+    self.columns = None
+    self.previous = None
+
+  # Returns the list of messages to send for a results snapshot: the schema
+  # (as a JSON string, with the columns and util.percentiles) if it's the first
+  # snapshot or the groups changed, and then the snapshot (as bytes). progress
+  # is a list of the snapshot's [period, day, ndays, total_ndays].
+  def encode(self, results, progress):
+    messages = []
+    columns = schema(results)
+    if columns != self.columns:
+      self.columns = columns
+      self.previous = None
+      messages.append(json.dumps({'schema': {'columns': columns, 'percentiles': util.percentiles}}))
+
+    payload = values(results, self.columns).view('<u4')
+    flags = 0
+    if self.delta and self.previous is not None:
+      flags |= flag_delta
+      self.previous, payload = payload, payload ^ self.previous
+    else:
+      self.previous = payload
+    payload = payload.tobytes()
+    if self.compress:
+      flags |= flag_compressed
+      payload = zlib.compress(payload)
+    messages.append(np.array([flags] + list(progress), dtype='<u4').tobytes() + payload)
+    return messages
+
+# Decodes one binary snapshot message, given the schema's columns and the
+# previous snapshot's values (needed if the message is delta-encoded). Returns
+# the progress [period, day, ndays, total_ndays] and the values as float32s.
+def decode(message, columns, previous=None):
+  header = np.frombuffer(message[:20], dtype='<u4')
+  flags = int(header[0])
+  payload = message[20:]
+  if flags & flag_compressed:
+    payload = zlib.decompress(payload)
+  payload = np.frombuffer(payload, dtype='<u4')
+  if flags & flag_delta:
+    payload = payload ^ previous.view('<u4')
+  return [int(x) for x in header[1:]], payload.view('<f4')
@@ -8,10 +8,12 @@ $(document).ready(() => {
   //
 
   const urlParams = {
-    config: "config"
+    config: "config",
+    profile: "profile" // if present, the run is profiled (see server.py)
   };
 
   const defaultConfig = {
+    seed: 1,
     ncompanies: 100,
     income: [
       [50000],
@@ -462,6 +464,7 @@ $(document).ready(() => {
       this.ncompanies = new Var("ncompanies", new NumberInput("Number of companies", "integer"));
       this.income = new Var("income", new DistributionInput("Income levels", "integer"));
       this.company_size = new Var("company_size", new DistributionInput("Company size", "integer"));
+      this.seed = new Var("seed", new NumberInput("Random seed", "integer"));
       this.periods = [];
 
       let periodButtons = new AddRemoveButtons(
@@ -481,7 +484,8 @@ $(document).ready(() => {
       [
         this.ncompanies,
         this.income,
-        this.company_size
+        this.company_size,
+        this.seed
       ].forEach((x) => {
         baseParamsCards.add(x.input.element);
       });
@@ -509,6 +513,7 @@ $(document).ready(() => {
 
     toJSON() {
       let json = {
+        seed: this.seed.input.value,
         ncompanies: this.ncompanies.input.value,
         income: [
           this.income.input.values,
@@ -546,6 +551,9 @@ $(document).ready(() => {
       success &= this.ncompanies.set(json.ncompanies);
       success &= this.income.set(json.income);
       success &= this.company_size.set(json.company_size);
+      if (json.seed != undefined) { // links from before there was a seed
+        success &= this.seed.set(json.seed);
+      }
 
       // Add/remove periods if necessary to match the given set
       let diff = Math.abs(json.periods.length - this.periods.length);
@@ -629,10 +637,9 @@ $(document).ready(() => {
       });
     }
 
-    // Add a new data point to the chart. newData is an array, where each entry
-    // i is the new value for legend[i]
-    update(newData) {
-      let x = this.chart.data.labels.length;
+    // Add a new data point to the chart at x. newData is an array, where each
+    // entry i is the new value for legend[i]
+    update(x, newData) {
       this.chart.data.labels.push(x);
       for (let i = 0; i < newData.length; i++) {
         this.chart.data.datasets[i].data.push(newData[i]);
@@ -686,10 +693,34 @@ $(document).ready(() => {
     }
   }
 
+  // Progress bar for a running simulation
+  class ProgressBar {
+    constructor() {
+      this.bar = element("div")
+        .addClass("progress-bar")
+        .attr("role", "progressbar")
+        .css("width", "0%");
+      this.element = element("div").addClass("progress")
+        .append(this.bar);
+    }
+
+    // Sets the progress, as a fraction from 0 to 1
+    set(fraction) {
+      let p = Math.round(100 * fraction);
+      this.bar.css("width", p.toString() + "%").text(p.toString() + "%");
+    }
+
+    // Shows a message in place of the progress, e.g. while the run is queued
+    message(text) {
+      this.bar.css("width", "100%").text(text);
+    }
+  }
+
   // "Run" button sends a the config to the server and displays the results
-  // as it runs
+  // as it runs. Results are sampled at the given cadence (see server.py), and
+  // the progress bar is updated each day.
   class RunButton {
-    constructor(config, chartsContainer) {
+    constructor(config, chartsContainer, progressBar, sampling) {
       this.element = element("button")
         .addClass("btn")
         .addClass("btn-primary")
@@ -779,37 +810,138 @@ $(document).ready(() => {
           let protocol = (document.location.protocol == "https:") ? "wss:" : "ws:";
           let ws = new WebSocket(`${protocol}//${document.location.host}/run-simulator`);
 
+          // Ask for results in the binary format (see util/wire.py), compressed
+          // if the browser can decompress it
+          let compress = (typeof DecompressionStream != "undefined");
+          ws.binaryType = "arraybuffer";
+
+          progressBar.set(0);
           ws.onopen = (e) => {
-            ws.send(JSON.stringify(config.toJSON()));
+            let json = config.toJSON();
+            json.sampling = sampling;
+            json.format = "binary";
+            json.delta = true;
+            json.compress = compress;
+            json.profile = (new URLSearchParams(document.location.search)).has(urlParams.profile);
+            ws.send(JSON.stringify(json));
+          };
+
+          // The binary results. Each column of the schema is plotted on the
+          // chart for its group and result, in the dataset at its index (e.g.
+          // percentile), or not at all if there's no chart for it.
+          let columns = [];
+          let previous = null;
+          let chartOf = (level, group, name) => {
+            let g = (level == "overall") ? charts.overall : charts[level][group];
+            return (g == undefined) ? undefined : g.charts[name];
           };
 
+          // Decodes a binary results message into the charts. Returns a
+          // promise, since decompression is asynchronous.
+          let decode = async (buffer) => {
+            let header = new Uint32Array(buffer, 0, 5);
+            let flags = header[0];
+            let ndays = header[3];
+            let totalNdays = header[4];
+            let payload = buffer.slice(20);
+            if (flags & 2) {
+              let stream = new Blob([payload]).stream().pipeThrough(new DecompressionStream("deflate"));
+              payload = await new Response(stream).arrayBuffer();
+            }
+            let bits = new Uint32Array(payload);
+            if (flags & 1) {
+              for (let i = 0; i < bits.length; i++) {
+                bits[i] ^= previous[i];
+              }
+            }
+            previous = bits.slice();
+            let values = new Float32Array(bits.buffer);
+
+            // Gather the new values of each chart, and add them all at once
+            let x = Math.round(100 * ndays / 30) / 100;
+            let updates = new Map();
+            columns.forEach(([level, group, name, index], i) => {
+              let chart = chartOf(level, group, name);
+              if (chart != undefined) {
+                if (!updates.has(chart)) {
+                  updates.set(chart, []);
+                }
+                updates.get(chart)[index] = values[i];
+              }
+            });
+            updates.forEach((newData, chart) => {
+              chart.update(x, newData);
+            });
+            progressBar.set((ndays + 1) / totalNdays);
+          };
+
+          // Messages are handled in order, waiting for each binary message to
+          // be decoded. A message that fails is reported and skipped, so the
+          // ones after it are still handled
+          let queue = Promise.resolve();
           ws.onmessage = (e) => {
-            let msg = JSON.parse(e.data);
+            queue = queue.then(() => {
+              if (typeof e.data != "string") {
+                return decode(e.data);
+              }
+              onJSON(JSON.parse(e.data));
+            }).catch((error) => {
+              console.error("error while handling a message from the server: " + error);
+              progressBar.message("Error while handling results: " + error);
+            });
+          };
 
-            // Only plot the first day of each month
-            if (msg.day % 30 != 0) {
+          let onJSON = (msg) => {
+            if (msg.schema != undefined) {
+              columns = msg.schema.columns;
+              previous = null;
               return;
             }
 
-            // Add the new data to the charts
+            // The time spent in each phase of the simulation so far, if the
+            // run is profiled
+            if (msg.timing != undefined) {
+              console.table(msg.timing);
+              return;
+            }
+
+            // Waiting for a worker, or turned away (the server is busy or the
+            // config is invalid)
+            if (msg.queued != undefined) {
+              progressBar.message(`Queued (${msg.queued} ahead)`);
+              return;
+            }
+            if (msg.results != undefined) {
+              progressBar.message(msg.results);
+              return;
+            }
+            progressBar.set((msg.ndays + 1) / msg.total_ndays);
+
+            // Progress ticks have no results to plot
+            if (msg.data == undefined) {
+              return;
+            }
+
+            // Add the new data to the charts, at the month it's from
             let data = msg.data;
+            let x = Math.round(100 * msg.ndays / 30) / 100;
 
             // Overall charts
             [person_money, company_money, person_unemployment, company_closures, circulation].forEach((t) => {
-              charts.overall.charts[t.name].update(data.overall[t.name]);
+              charts.overall.charts[t.name].update(x, data.overall[t.name]);
             });
 
             // Per-income level charts
             income_levels.forEach((i) => {
               [person_money, person_unemployment].forEach((t) => {
-                charts.income_levels[i].charts[t.name].update(data.income_levels[i][t.name]);
+                charts.income_levels[i].charts[t.name].update(x, data.income_levels[i][t.name]);
               });
             });
 
             // Industry charts
             industries.forEach((i) => {
               [person_money, company_money, person_unemployment, company_closures].forEach((t) => {
-                charts.industries[i].charts[t.name].update(data.industries[i][t.name]);
+                charts.industries[i].charts[t.name].update(x, data.industries[i][t.name]);
               });
             });
           };
@@ -893,14 +1025,16 @@ $(document).ready(() => {
     }
   }
 
-  // Run and "get link" buttons
+  // Run and "get link" buttons, and the progress bar
   let chartsContainer = $("#charts-container");
+  let progressBar = new ProgressBar();
   $("#button-container")
   .append(
     withPadding(
       element("div")
-      .append((new RunButton(config, chartsContainer)).element)
+      .append((new RunButton(config, chartsContainer, progressBar, "monthly")).element)
       .append((new GetLinkButton(config)).element)
     )
-  );
+  )
+  .append(withPadding(progressBar.element));
 });
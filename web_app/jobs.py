@@ -0,0 +1,287 @@
+'''
+Runs the web app's simulations as jobs, off the web socket handlers. Submitted
+jobs wait in a bounded queue, and run in a pool of simulation worker
+processes, at most a fixed number at a time. Workers are started once and
+reused for job after job, so jobs don't pay for starting Python and importing
+NumPy. Each job sends its messages back to its web socket handler through its
+worker's pipe, and can be cancelled (e.g. when the client disconnects). A
+running job is cancelled by killing its worker, which is the only way to stop
+a simulation partway through, and a new worker is started in its place.
+
+The handlers wait on the pipes with poll() and time.sleep(), which gunicorn's
+gevent worker patches to yield to the other handlers instead of blocking them.
+'''
+
+from simulator import simulator
+from util import cache, util, wire
+import itertools
+import json
+import multiprocessing
+import threading
+import time
+import traceback
+
+# Raised by JobQueue.submit() when the queue is full
+class QueueFull(Exception):
+  pass
+
+# Returns a function sample(period, day, ndays) that says whether to send
+# results on a day of the simulation, given the sampling cadence requested by
+# the client:
+# - "monthly": the first day of each month
+# - "periods": the first day of each period
+# - an integer n: every n days
+# ndays is the number of days simulated so far (before this one). Raises a
+# ValueError if the cadence is invalid.
+def sampler(sampling):
+  if sampling == 'monthly':
+    return lambda period, day, ndays: day % simulator.days_per_month == 0
+  elif sampling == 'periods':
+    last_period = [None]
+    def sample(period, day, ndays):
+      new_period = period != last_period[0]
+      last_period[0] = period
+      return new_period
+    return sample
+  elif isinstance(sampling, int) and not isinstance(sampling, bool) and sampling > 0:
+    return lambda period, day, ndays: ndays % sampling == 0
+  raise ValueError('invalid sampling cadence %s' % json.dumps(sampling))
+
+# Returns the encoder for the results messages of a run with the given options:
+# a wire.Encoder for the binary format, or None for JSON
+def encoder(options):
+  if options['format'] == 'binary':
+    return wire.Encoder(delta=options['delta'], compress=options['compress'])
+  return None
+
+# Returns the messages for the client for one day of a simulation: the results,
+# if given (as JSON, or in the binary format if encoder is given), or else a
+# progress tick. progress is [period, day, ndays, total_ndays].
+def day_messages(encoder, progress, results=None):
+  period, day, ndays, total_ndays = progress
+  msg = {'period': period, 'day': day, 'ndays': ndays, 'total_ndays': total_ndays}
+  if results is None:
+    return [json.dumps(msg)]
+  elif encoder is not None:
+    return encoder.encode(results, progress)
+  msg['data'] = results
+  return [json.dumps(msg, default=float)]
+
+# Returns the cache key (see util/cache.py) of a run of the config, from the
+# options its results depend on
+def cache_key(config, options):
+  return cache.key(config, app='web', engine=options['engine'], sampling=options['sampling'])
+
+# Runs a simulation in a worker process, sending the messages for the client
+# through conn: on the sampled days, the results, and on every other day a
+# progress tick (see day_messages()). Sends None when it's done.
+# - options: the engine name (see util.engines), the sampling cadence, the
+#   format, delta and compress options of the binary format, and whether to
+#   profile the run. If profiling, the time spent so far in each phase of the
+#   simulation (see simulator.Profiler) is sent as {'timing': ...} after each
+#   sampled day's results, and once more at the end.
+# - result_cache: if given, the sampled results are cached in it
+def run_job(config, options, conn, result_cache=None):
+  sample = sampler(options['sampling'])
+  e = encoder(options)
+  total_ndays = simulator.days_per_month * sum([p['duration'] for p in config['periods']])
+  ndays = [0]
+  records = []
+  profiler = simulator.Profiler() if options.get('profile') else None
+  def on_day(period, day, people, companies):
+    progress = [period, day, ndays[0], total_ndays]
+    results = None
+    if sample(period, day, ndays[0]):
+      results = util.results(people, companies)
+      records.append([progress, results])
+    ndays[0] += 1
+    for m in day_messages(e, progress, results):
+      conn.send(m)
+    if profiler is not None and results is not None:
+      conn.send(json.dumps({'timing': profiler.report()}))
+
+  util.engines[options['engine']].run(config, on_day=on_day, instrument=profiler)
+  if profiler is not None:
+    conn.send(json.dumps({'timing': profiler.report()}))
+  if result_cache is not None:
+    result_cache.put(cache_key(config, options), records)
+  conn.send(None)
+
+# The main loop of a worker process: runs each job (config, options,
+# result_cache) it receives through conn with run_job(), until conn is closed.
+# A job that fails still ends with None, so the worker can take the next one.
+def worker_main(conn):
+  while True:
+    try:
+      config, options, result_cache = conn.recv()
+    except EOFError:
+      break
+    try:
+      run_job(config, options, conn, result_cache)
+    except Exception:
+      traceback.print_exc()
+      conn.send(None)
+
+# A worker process, and the pipe to send it jobs and receive their messages
+class Worker:
+  def __init__(self, context):
+    self.conn, child_conn = context.Pipe()
+    self.process = context.Process(target=worker_main, args=(child_conn,), daemon=True)
+    self.process.start()
+    child_conn.close()
+
+  # Starts running a job
+  def run(self, job, result_cache):
+    self.conn.send((job.config, job.options, result_cache))
+
+  # Kills the worker
+  def kill(self):
+    self.process.terminate()
+    self.process.join()
+    self.conn.close()
+
+# Returns the messages for the client to replay a cached run's records
+def replay_messages(records, options):
+  e = encoder(options)
+  messages = []
+  for progress, results in records:
+    messages += day_messages(e, progress, results)
+  return messages
+
+# A simulation job. status is one of 'queued', 'running', 'done' or
+# 'cancelled'.
+class Job:
+  def __init__(self, id, config, options):
+    self.id = id
+    self.config = config
+    self.options = options
+    self.status = 'queued'
+    self.submitted = time.time()
+    self.started = None
+    self.worker = None
+    self.conn = None
+
+  # Returns a summary of the job for the status endpoint
+  def status_dict(self):
+    return {
+      'id': self.id,
+      'status': self.status,
+      'submitted': self.submitted,
+      'started': self.started,
+      'engine': self.options['engine'],
+      'ncompanies': self.config.get('ncompanies'),
+      'nmonths': sum([p['duration'] for p in self.config['periods']])
+    }
+
+# A queue of jobs, run by a pool of at most nworkers worker processes, one job
+# at a time each. Workers are started as they're needed, and kept for the next
+# jobs. At most max_queued jobs can wait for a worker; more are turned away. If
+# result_cache is given, the results of seeded configs are cached in it.
+class JobQueue:
+  def __init__(self, nworkers=None, max_queued=None, result_cache=None):
+    self.nworkers = multiprocessing.cpu_count() if nworkers is None else nworkers
+    self.max_queued = 4 * self.nworkers if max_queued is None else max_queued
+    self.queued = [] # in order
+    self.running = []
+    self.idle = [] # workers without a job
+    self.ids = itertools.count()
+    self.result_cache = result_cache
+    self.lock = threading.Lock()
+    # Workers are spawned rather than forked, so they don't inherit the
+    # server's sockets or event loop
+    self.context = multiprocessing.get_context('spawn')
+
+  # Returns the messages to replay the cached results of a config run with the
+  # given options, or None if they aren't cached (or the run is profiled, so it
+  # has to actually run)
+  def cached_messages(self, config, options):
+    if self.result_cache is None or not cache.cacheable(config) or options.get('profile'):
+      return None
+    records = self.result_cache.get(cache_key(config, options))
+    return None if records is None else replay_messages(records, options)
+
+  # Adds a job to the queue. Returns the Job, or raises QueueFull if there are
+  # already max_queued jobs waiting.
+  def submit(self, config, options):
+    with self.lock:
+      if len(self.queued) >= self.max_queued:
+        raise QueueFull()
+      job = Job(next(self.ids), config, options)
+      self.queued.append(job)
+    self.schedule()
+    return job
+
+  # Forgets finished jobs, and starts queued jobs on the free workers, starting
+  # new workers if there are fewer than nworkers
+  def schedule(self):
+    with self.lock:
+      self.running = [job for job in self.running if job.status == 'running']
+      while len(self.queued) > 0 and len(self.running) < self.nworkers:
+        job = self.queued.pop(0)
+        job.worker = self.idle.pop() if len(self.idle) > 0 else Worker(self.context)
+        job.conn = job.worker.conn
+        job.worker.run(job, self.result_cache if cache.cacheable(job.config) else None)
+        job.status = 'running'
+        job.started = time.time()
+        self.running.append(job)
+
+  # Cancels a job: takes it off the queue, or kills its worker if it's running
+  def cancel(self, job):
+    with self.lock:
+      if job.status == 'queued':
+        self.queued.remove(job)
+      elif job.status != 'running':
+        return
+      job.status = 'cancelled'
+    self.finish(job, reuse=False)
+
+  # Cleans up after a job that's finished or cancelled, and starts the next.
+  # Its worker goes back to the pool if reuse is true, or else is killed (e.g.
+  # if the job was cancelled partway through, or the worker died).
+  def finish(self, job, reuse=True):
+    worker = job.worker
+    with self.lock:
+      if job.status == 'running':
+        job.status = 'done'
+      job.worker = None
+      if worker is not None and reuse:
+        self.idle.append(worker)
+    if worker is not None and not reuse:
+      worker.kill()
+    self.schedule()
+
+  # Yields the messages of a job for its client as they come: while it's
+  # queued, {'queued': number of jobs ahead of it} every poll_interval seconds,
+  # and then the messages from its worker, until it's done
+  def messages(self, job, poll_interval=1):
+    while job.status == 'queued':
+      with self.lock:
+        ahead = self.queued.index(job) if job in self.queued else 0
+      yield json.dumps({'queued': ahead})
+      time.sleep(poll_interval)
+      self.schedule()
+
+    while job.status == 'running':
+      if not job.conn.poll(poll_interval):
+        continue
+      try:
+        msg = job.conn.recv()
+      except EOFError: # the worker died
+        self.finish(job, reuse=False)
+        break
+      if msg is None:
+        self.finish(job)
+        break
+      yield msg
+
+  # Returns the status of the queue: the number of workers, how many are idle,
+  # the limit on queued jobs, and every queued and running job
+  def status(self):
+    self.schedule()
+    with self.lock:
+      return {
+        'nworkers': self.nworkers,
+        'nidle': len(self.idle),
+        'max_queued': self.max_queued,
+        'jobs': [job.status_dict() for job in self.running + self.queued]
+      }
@@ -6,13 +6,14 @@ References:
 - Flask docs: https://flask.palletsprojects.com/en/1.1.x/quickstart/
 '''
 
-from simulator import simulator
-from util import util
+from simulator import vectorized
+from util import cache, util
+from web_app import jobs
 import flask
 import flask_sockets
 import json
 import logging
-import time
+import os
 
 app = flask.Flask(__name__)
 sockets = flask_sockets.Sockets(app)
@@ -20,6 +21,29 @@ gunicorn_logger = logging.getLogger('gunicorn.error')
 app.logger.handlers = gunicorn_logger.handlers
 app.logger.setLevel(gunicorn_logger.level)
 
+# The simulator engine to run, set with the SIMULATOR_ENGINE environment
+# variable (see util.engines)
+engine = os.environ.get('SIMULATOR_ENGINE', 'legacy')
+if engine not in util.engines:
+  raise ValueError('unknown engine "%s"' % engine)
+
+# The job queue that runs the simulations, with SIMULATOR_WORKERS worker
+# processes (default: one per CPU) and at most SIMULATOR_MAX_QUEUED jobs waiting
+# for them (default: 4 per worker). The results of seeded configs are cached in
+# SIMULATOR_CACHE_DIR, up to SIMULATOR_CACHE_MB megabytes (see util/cache.py).
+def env_int(name):
+  return int(os.environ[name]) if name in os.environ else None
+result_cache = cache.ResultCache(
+  os.environ.get('SIMULATOR_CACHE_DIR', cache.default_directory),
+  int(float(os.environ.get('SIMULATOR_CACHE_MB', cache.default_max_bytes / 2**20)) * 2**20)
+)
+job_queue = jobs.JobQueue(env_int('SIMULATOR_WORKERS'), env_int('SIMULATOR_MAX_QUEUED'), result_cache)
+
+# The memory each simulation may take, in megabytes, set with the
+# SIMULATOR_MEMORY_MB environment variable (default: no limit). Configs
+# estimated to need more (see the engines' estimate_bytes) are refused.
+memory_budget = env_int('SIMULATOR_MEMORY_MB')
+
 # Returns the index html page
 @app.route('/')
 def index():
@@ -32,8 +56,36 @@ def index_js():
   with open('web_app/index.js') as f:
     return f.read()
 
-# Runs the simulator with the config provided by the client. Sends a simple
-# progress update each day - just the current period/day.
+# Returns the status of the simulation jobs: the number of workers, the limit
+# on queued jobs, and every queued and running job
+@app.route('/jobs')
+def jobs_status():
+  return flask.jsonify(job_queue.status())
+
+# Runs the simulator with the config provided by the client, as a job (see
+# jobs.py). While the job waits in the queue, sends {'queued': number of jobs
+# ahead}. If the queue is full, replies {'results': 'server busy'}. If the
+# client disconnects, the job is cancelled. If the config is seeded and its
+# results are cached, replays them instead of simulating.
+#
+# The config may have a "sampling" cadence (see jobs.sampler(), default
+# "monthly"): the results are only computed and sent on those days. Every other
+# day, sends a lightweight progress tick instead. Each message has the
+# progress:
+# {'period': ..., 'day': ..., 'ndays': days simulated so far, 'total_ndays': ...}
+# and results messages also have the results as 'data'.
+#
+# If the config's "format" is "binary" (default "json"), the results are sent
+# in the compact binary format instead (see util/wire.py): the schema once, as
+# JSON, and then each snapshot as binary, delta-encoded if "delta" is true and
+# compressed if "compress" is true. Progress ticks are still JSON.
+#
+# If the config's "profile" is true, the run is profiled, and the time spent in
+# each phase of the simulation so far (see simulator.Profiler) is also sent as
+# {'timing': {phase: stats}} after each sampled day, and at the end.
+#
+# If the config is estimated to need more memory than SIMULATOR_MEMORY_MB,
+# replies {'results': 'config too large'}.
 @sockets.route('/run-simulator')
 def run_simulator(ws):
   config = json.loads(ws.receive())
@@ -42,6 +94,22 @@ def run_simulator(ws):
   def replyInvalid(ws):
     ws.send(json.dumps({'results': 'invalid config'}))
     ws.close()
+  options = {
+    'engine': engine,
+    'sampling': config.pop('sampling', 'monthly'),
+    'format': config.pop('format', 'json'),
+    'delta': bool(config.pop('delta', False)),
+    'compress': bool(config.pop('compress', False)),
+    'profile': bool(config.pop('profile', False))
+  }
+  try:
+    jobs.sampler(options['sampling'])
+  except ValueError:
+    replyInvalid(ws)
+    return
+  if options['format'] not in ['json', 'binary']:
+    replyInvalid(ws)
+    return
   for _, v in config.items():
     if v == None:
       replyInvalid(ws)
@@ -51,21 +119,45 @@ def run_simulator(ws):
     replyInvalid(ws)
     return
 
+  if config.get('money_dtype', 'float64') not in vectorized.money_dtypes:
+    replyInvalid(ws)
+    return
+
   for p in config['periods']:
     for _, v in p.items():
       if v == None:
         replyInvalid(ws)
         return
 
-  # Callback computes results from the day and sends to the client
-  def on_day(period, day, people, companies):
-    data = util.results(people, companies)
-    msg = json.dumps({'data': data, 'period': period, 'day': day})
+  # Refuse configs that won't fit in memory
+  if memory_budget is not None and util.engines[engine].estimate_bytes(config)['total'] > memory_budget * 2**20:
+    ws.send(json.dumps({'results': 'config too large'}))
+    ws.close()
+    return
+
+  # Replay the cached results, if there are any
+  messages = job_queue.cached_messages(config, options)
+  if messages is not None:
     try:
-      ws.send(msg)
+      for msg in messages:
+        ws.send(msg)
     except Exception:
       pass
+    ws.close()
+    return
 
-  # Run the simulator
-  simulator.run(config, on_day=on_day)
+  # Run the simulator as a job, and forward its messages to the client
+  try:
+    job = job_queue.submit(config, options)
+  except jobs.QueueFull:
+    ws.send(json.dumps({'results': 'server busy'}))
+    ws.close()
+    return
+  try:
+    for msg in job_queue.messages(job):
+      ws.send(msg)
+  except Exception:
+    pass
+  finally:
+    job_queue.cancel(job)
   ws.close()
@@ -0,0 +1,113 @@
+'''
+Tests for the web app's jobs. Run from the repo root with:
+python -m web_app.test
+'''
+
+from simulator import simulator
+from web_app import jobs
+import json
+
+# Returns the days (as numbers of days simulated before them) a sampler picks
+# over a run of periods of the given numbers of months
+def sampled_days(sample, durations):
+  days = []
+  ndays = 0
+  for period, duration in enumerate(durations):
+    for day in range(duration * simulator.days_per_month):
+      if sample(period, day, ndays):
+        days.append(ndays)
+      ndays += 1
+  return days
+
+def test_sampler():
+  print('Check that results are sampled daily, monthly, every n days or every period, as requested')
+  month = simulator.days_per_month
+  cases = [
+    (1, list(range(3 * month))),
+    (7, list(range(0, 3 * month, 7))),
+    ('monthly', [0, month, 2 * month]),
+    ('periods', [0, 2 * month])
+  ]
+  for sampling, expected in cases:
+    actual = sampled_days(jobs.sampler(sampling), [2, 1])
+    if actual != expected:
+      print('Failed: sampling %s picks the wrong days' % sampling)
+      print('Expected: %s' % expected)
+      print('Actual:   %s' % actual)
+      return
+  for sampling in [0, -1, 1.5, '7', 'weekly', True, None]:
+    try:
+      jobs.sampler(sampling)
+    except ValueError:
+      continue
+    print('Failed: invalid sampling %s was accepted' % repr(sampling))
+    print('Expected: ValueError')
+    return
+  print('Passed')
+
+# Returns the options of a JSON results job on an engine
+def job_options(engine='vectorized'):
+  return {'engine': engine, 'sampling': 'monthly', 'format': 'json', 'delta': False, 'compress': False}
+
+# Returns a config that runs for the given number of months
+def job_config(nmonths=1, ncompanies=10):
+  return dict(simulator.defaults, ncompanies=ncompanies, periods=[dict(simulator.defaults['periods'][0], duration=nmonths)], seed=1)
+
+def test_job_queue():
+  print('Check that the job queue turns jobs away when full, cancels queued and running jobs, and reuses its workers')
+  queue = jobs.JobQueue(nworkers=1, max_queued=1)
+  long_job = queue.submit(job_config(nmonths=1000, ncompanies=1000), job_options('legacy'))
+  queued_job = queue.submit(job_config(), job_options())
+  try:
+    queue.submit(job_config(), job_options())
+    print('Failed: a job was queued beyond max_queued')
+    print('Expected: QueueFull')
+    return
+  except jobs.QueueFull:
+    pass
+  status = queue.status()
+  expected = [(long_job.id, 'running'), (queued_job.id, 'queued')]
+  actual = [(job['id'], job['status']) for job in status['jobs']]
+  if actual != expected or status['nworkers'] != 1 or status['max_queued'] != 1:
+    print('Failed: status of the queue is wrong')
+    print('Expected: %s' % expected)
+    print('Actual:   %s' % status)
+    return
+
+  # Cancel the queued job, then the running one, which kills its worker
+  queue.cancel(queued_job)
+  killed = long_job.worker.process
+  queue.cancel(long_job)
+  status = queue.status()
+  if queued_job.status != 'cancelled' or long_job.status != 'cancelled' or killed.is_alive() or status['jobs'] != []:
+    print('Failed: jobs were not cancelled')
+    print('Expected: both jobs cancelled, the worker killed, no jobs left')
+    print('Actual:   %s, %s, worker alive %s, %s' % (queued_job.status, long_job.status, killed.is_alive(), status))
+    return
+
+  # Jobs run to the end, one after the other on the same new worker
+  workers = []
+  for i in range(2):
+    job = queue.submit(job_config(nmonths=2), job_options())
+    workers.append(job.worker.process)
+    messages = [json.loads(m) for m in queue.messages(job, poll_interval=0.01)]
+    nresults = len([m for m in messages if 'data' in m])
+    if job.status != 'done' or nresults != 2 or len(messages) != 2 * simulator.days_per_month:
+      print('Failed: job %d did not run to the end' % i)
+      print('Expected: done, 2 results in %d messages' % (2 * simulator.days_per_month))
+      print('Actual:   %s, %d results in %d messages' % (job.status, nresults, len(messages)))
+      return
+  if workers[0] is not workers[1] or workers[0] is killed or not workers[0].is_alive() or queue.status()['nidle'] != 1:
+    print('Failed: the worker was not reused')
+    print('Expected: both jobs on the same live worker, idle after them')
+    print('Actual:   same worker %s, alive %s, %s' % (workers[0] is workers[1], workers[0].is_alive(), queue.status()))
+    return
+  print('Passed')
+
+# Run all tests
+def main():
+  test_sampler()
+  test_job_queue()
+
+if __name__ == '__main__':
+  main()